@@ -3,31 +3,55 @@
 # Texas Tech University
 
 import numpy as np
-from netCDF4 import Dataset, date2num
+import os
+from netCDF4 import Dataset, date2num, num2date
 from datetime import datetime
-from wrf import getvar, ALL_TIMES
+from wrf import getvar, ALL_TIMES, is_moving_domain
+from metpy.units import units
 import warnings
-from .variable_def import get_variables
-from .calc import (get_isobaric_variables, get_precip, get_temp_2m, get_q_2m, get_u_10m,
-                   get_v_10m, get_mslp, get_uh, get_cape, get_dbz, get_dewpt_2m)
+from .cache import DiagnosticCache
+from .output import OutputFile
+from .instrument import Instrument, JSONLinesEmitter, print_progress
+from .parallel import get_executor, submit_group
+from .subset import get_window
+from .regrid import Regridder, get_regular_grid
+from .stations import StationIndex, read_stations, write_stations
+from .sections import PathIndex, read_paths, write_paths
+from .storage import get_storage_profiles, get_storage, storage_report
+from .util import parse_bytes, get_slab_size, get_slabs
+from .planner import parse_variables, make_plan, get_node_bytes
+from .variable_def import get_vertical_coordinates, get_reduced_fields, get_variable
+from .calc import get_wrf_var, write_var
+from .precip import get_valid_seconds
+from .reduction import Reducer
+from .checkpoint import Checkpoint, get_signature
+from .pipeline import Reader, Writer
+from .compress import ChunkCompressor
+from .backends import open_output, is_zarr
 
 
 def wrfpost(inname, outname, variables, plevs=None, compression=True, complevel=4,
-            format='NETCDF4'):
+            format='NETCDF4', max_memory=None, cache_size='1GB', append=False, storage=None,
+            storage_vars=None, report=False, workers=None, tiles=None, verbose=True, log=None,
+            hooks=None, dry_run=False, bbox=None, index_window=None, stride=1, regrid=None,
+            regrid_method='bilinear', weights_dir=None, stations=None, hlevels=None,
+            thlevels=None, reduced_only=False, resume=False, pipeline=False, paths=None,
+            spacing=None, model_levels=False, compress_workers=None):
     """
     Runs the WRF Post Processor
     :param inname: string of input file path
     :param outname: string of output file path
     :param variables: list of desired variable strings
         Supported diagnostic variable strings:
-            uwnd: U-component of wind on isobaric levels
-            vwnd: V-component of wind on isobaric levels
-            wwnd: W-component of wind on isobaric levels
-            temp: Temperature on isobaric levels
-            dewpt: Dewpoint temperature on isobaric levels
-            avor: Absolute vorticity on isobaric levels
-            height: Geopotential height of isobaric levels
-            pres: Pressure on model levels
+            uwnd: U-component of wind on vertical levels
+            vwnd: V-component of wind on vertical levels
+            wwnd: W-component of wind on vertical levels
+            temp: Temperature on vertical levels
+            dewpt: Dewpoint temperature on vertical levels
+            avor: Absolute vorticity on vertical levels
+            height: Geopotential height of vertical levels
+            theta: Potential temperature on vertical levels
+            pres: Pressure on vertical levels
             mslp: Pressure reduced to mean sea level
             temp_2m: Temperature at 2m
             dewpt_2m: Dewpoint temperature at 2m
@@ -36,27 +60,206 @@ def wrfpost(inname, outname, variables, plevs=None, compression=True, complevel=
             v_10m: V-component of wind at 10m
             tot_pcp: Total accumulated precipitation
             timestep_pcp: Total timestep accumulated precipitation
+            pcp_<N>h: Total precipitation accumulated over the previous N hours, such as
+                pcp_1h, pcp_3h, pcp_6h, or pcp_24h
             UH: Updraft helicity
             cape: 2D convective available potetial energy
             cin: 2D convective inhibition
             refl: Maximum reflectivity
+            wspd_10m: Wind speed at 10m
+            <variable>_max, <variable>_min: Maximum or minimum over the run of UH, refl,
+                wspd_10m, mslp, cape, cin, or the 2m and 10m fields, such as UH_max
+            <variable>_max_<N>h, <variable>_min_<N>h: Maximum or minimum over the previous
+                N hours, such as UH_max_1h, refl_max_1h, or mslp_min_3h
 
     :param plevs: optional array of desired output pressure levels
-    :param compression: True or False : netCDF variable level compression
-    :param complevel: level of variable compression
-    :param format: Output netCDF file format. Default is netCDF4.
-    :return: File of post-processed WRF output
+    :param compression: True or False : netCDF variable level compression. Ignored if a
+        storage profile is given.
+    :param complevel: level of variable compression. Ignored if a storage profile is given.
+    :param format: Output netCDF file format, or 'ZARR' to write a Zarr directory store
+        with the same variables, dimensions, and attributes, read with xarray.open_zarr.
+        Arrays along time are created with all the times of the run, and times not written
+        yet are missing, so the store can be read while the run writes it, with
+        consolidated=False until the metadata is consolidated at the end. With worker
+        processes, each worker writes the chunks of its variables into the store itself,
+        unless reductions or regridding are requested. Needs zarr. Default is netCDF4.
+    :param max_memory: optional memory budget such as '4GB'. When given, the input is
+        processed in slabs of time steps sized to fit the budget and each slab is appended
+        to the output. Default is None, processing all times at once.
+    :param cache_size: byte limit of the cache of raw fields and diagnostics shared by all
+        variables, integer or string such as '1GB'. Default is '1GB'.
+    :param append: True to continue an existing output file of the same input, processing
+        only the input times after its last valid_time and appending them. The variables
+        and plevs should match the run that created the file. Default is False.
+    :param storage: optional storage profile name or dictionary of profile settings
+        controlling chunk shapes, shuffle, quantization, int16 packing, and static 2D
+        latitude and longitude. See storage.get_storage_profiles. Default is None, using
+        compression and complevel with library chunking.
+    :param storage_vars: optional dictionary of output variable name to dictionary of
+        storage settings overriding the profile
+    :param report: True to print the bytes stored and compression ratio of each variable
+    :param workers: optional number of worker processes. When greater than 1, the
+        independent groups of variables are computed at the same time in a process pool
+        and this process writes all of their output. Default is None, computing the
+        groups one after another.
+    :param tiles: optional number of horizontal tiles, or tuple of (south_north, west_east)
+        tile counts. When given, mslp, cape, cin, and refl are computed one tile per task
+        in a pool of workers processes writing into one shared array, and the groups of
+        variables are computed one after another. Results are identical to the untiled
+        computation. Needs Python 3.8 or later. Default is None, computing the whole domain
+        at once.
+    :param verbose: True to print progress messages and a table of the time spent in each
+        stage at the end of the run. Default is True.
+    :param log: optional path of a JSON-lines file to append one event per line to, with
+        the wall and CPU time, peak memory, and bytes of each input open, read, compute,
+        write, and output close. See instrument.Instrument.
+    :param hooks: optional list of callables, each called with every event dictionary
+    :param dry_run: True to only print the plan of the run, with the raw fields each step
+        reads, the intermediates it computes and frees, and the estimated bytes held,
+        without writing any output. Default is False.
+    :param bbox: optional (lat_min, lat_max, lon_min, lon_max) bounding box. Only the
+        smallest index window holding the grid points inside it is read and written.
+    :param index_window: optional (south_north start, stop, west_east start, stop) index
+        window to read and write instead of a bounding box
+    :param stride: integer step between the grid points kept in each horizontal direction.
+        Default is 1, keeping every point. Values at the kept points equal those of the
+        full grid. The window is recorded in the window_south_north and window_west_east
+        attributes of the output as start, stop, and stride.
+    :param regrid: optional (lat_min, lat_max, lon_min, lon_max, resolution) regular grid in
+        degrees. When given, every output field is remapped to the grid, with 1D latitude
+        and longitude coordinates and missing values outside the WRF domain.
+    :param regrid_method: 'nearest' or 'bilinear' regridding. Default is 'bilinear'.
+    :param weights_dir: directory of the regridding weights and station indices cached for
+        each domain, so later runs on the same domain skip computing them. Default is
+        ~/.cache/PWPP.
+    :param stations: optional path of a CSV file of id, lat, lon rows, or list of (id, lat,
+        lon) tuples. When given, the variables are computed at the nearest grid column of
+        each station only and written as a CF discrete sampling geometry file of station
+        time series. Stations farther than the grid spacing DX from any column are
+        missing. On moving domains, accumulations over time steps follow each station
+        between columns. Cannot be combined with tiles, a window, or regridding.
+    :param hlevels: optional array of desired output height above ground levels, such as
+        [10., 80., 100.] * units.m. Variables on these levels are named with the suffix
+        _agl, such as uwnd_agl.
+    :param thlevels: optional array of desired output isentropic levels, such as
+        [300., 310.] * units.K. Variables on these levels are named with the suffix _isen.
+        The vertical variables, such as temp and uwnd, are computed once and interpolated
+        to the levels of every vertical coordinate given, and each coordinate is computed
+        once for all of them.
+    :param reduced_only: True to write only the maximum and minimum reductions of the
+        variables they reduce, even if the variables are requested. The reductions are
+        updated as each slab is written, so no second pass is needed. Default is False,
+        writing reduced variables that are requested.
+    :param resume: True to resume an interrupted run of the same input and options into
+        outname. Every run marks each group of variables done for each slab in the sidecar
+        file <outname>.progress.json as it is written, and removes it when the run
+        completes. A resumed run computes only the groups and slabs not marked done, or
+        whose variables are missing from the output. Without markers of the same run, the
+        run starts over. Ignored when appending. Default is False.
+    :param pipeline: True, or a number of slabs to read ahead, to overlap reading,
+        computing, and writing. A reader process reads the raw fields of the slabs ahead
+        of the one being computed, and a writer process owns the output file and writes
+        the variables computed in order, so this process only computes. The number of
+        slabs read ahead and of writes waiting are bounded, capping the memory in flight.
+        Use with max_memory to split the run into slabs. Without worker processes for
+        the groups, the read ahead is 1 slab when True, and cache_size is raised to hold
+        the fields of a slab read ahead. Default is False.
+    :param paths: optional cross-section paths and sounding sites, as a path of a CSV file
+        of id, lat, lon rows, the rows of an id being the vertices of its path in order, or
+        a list of (id, list of (lat, lon) vertices) tuples. When given, the variables are
+        computed at the 4 grid columns around points spaced evenly along each path, or at
+        the single point of a site, and interpolated bilinearly to the points. The output
+        has a point dimension, with the path of each point and its distance along the
+        path. Points outside the grid are missing. Cannot be combined with stations,
+        tiles, a window, or regridding.
+    :param spacing: distance in meters between the points of a path. Default is the grid
+        spacing DX.
+    :param model_levels: True to also write the variables on vertical levels on the model
+        levels, named with the suffix _ml, such as temp_ml and pres_ml, without vertical
+        interpolation. Default is False.
+    :param compress_workers: optional number of processes compressing the output. When
+        greater than 1, the chunks of the deflated variables are compressed in a pool of
+        worker processes instead of by the netCDF4 library in this process, and written
+        into the HDF5 datasets of the variables as they are after each slab, which needs
+        h5py. The output is the same netCDF4 file. Variables quantized or packed by their
+        storage settings are compressed by the library. Chunks spanning slabs are held in
+        memory until they are completed, so groups are not marked done for resuming.
+        Cannot be combined with append, resume, or pipeline, and needs a
+        netCDF4 format. Default is None, compressing in the library.
+    :return: File of post-processed WRF output, or the planner.Plan of a dry run
     """
-    # open the input file
-    data = Dataset(inname)
+    # check the memory budget before opening any files
+    if max_memory is not None:
+        max_memory = parse_bytes(max_memory)
 
-    # get out time, lat, lon from original data
-    times = getvar(data, 'times', ALL_TIMES, meta=False)
-    lat = getvar(data, 'lat', ALL_TIMES)
-    lon = getvar(data, 'lon', ALL_TIMES)
+    if storage is None:
+        storage = dict(get_storage_profiles()['default'], zlib=compression,
+                       complevel=complevel)
+    coord_storage = get_storage(storage, storage_vars, 'valid_time')
+    if stations is not None and paths is not None:
+        raise ValueError('Give stations or paths, not both')
+    if (stations is not None or paths is not None) and (
+            tiles is not None or regrid is not None or bbox is not None or
+            index_window is not None or stride != 1):
+        raise ValueError('Stations and paths cannot be combined with tiles, a window, or '
+                         'regridding')
+    if compress_workers is not None and compress_workers > 1 and (
+            append or resume or pipeline or not format.startswith('NETCDF4')):
+        raise ValueError('Compression workers need a new netCDF4 output, without append, '
+                         'resume, or pipeline')
+    regridder = None
+    if regrid is not None:
+        regridder = Regridder(*get_regular_grid(regrid), method=regrid_method,
+                              cache_dir=weights_dir)
+
+    # record the time and memory of each stage of the run
+    instrument = Instrument(hooks)
+    if verbose:
+        instrument.hooks.insert(0, print_progress)
+    if log is not None:
+        emitter = JSONLinesEmitter(log)
+        instrument.hooks.append(emitter)
+
+    # open the input file, reading through a cache shared by all variables
+    with instrument.stage('open', inname):
+        dataset = Dataset(inname)
+        try:
+            window = get_window(dataset, bbox, index_window, stride)
+            station_index = None
+            if stations is not None:
+                station_index = StationIndex(*read_stations(stations),
+                                             max_distance=getattr(dataset, 'DX', None),
+                                             cache_dir=weights_dir)
+            elif paths is not None:
+                station_index = PathIndex(read_paths(paths),
+                                          spacing or getattr(dataset, 'DX', None),
+                                          cache_dir=weights_dir)
+            if station_index is not None:
+                station_index.set_grids(dataset.variables['XLAT'][:],
+                                        dataset.variables['XLONG'][:])
+            data = DiagnosticCache(dataset, max_bytes=cache_size, tiles=tiles,
+                                   workers=workers, instrument=instrument, window=window,
+                                   stations=station_index)
+        except ValueError:
+            dataset.close()
+            raise
+    # sizes of the horizontal output dimensions
+    if station_index is not None:
+        grid_sizes = {station_index.dim: len(station_index)}
+    elif regridder is not None:
+        grid_sizes = {'lat': regridder.shape[0], 'lon': regridder.shape[1]}
+    elif window is not None:
+        grid_sizes = {'lat': window.shape[0], 'lon': window.shape[1]}
+    else:
+        grid_sizes = {'lat': data.dimensions['south_north'].size,
+                      'lon': data.dimensions['west_east'].size}
+
+    # get out times from original data
+    times = np.atleast_1d(getvar(data.dataset, 'times', ALL_TIMES, meta=False))
+    ntimes = data.dimensions['Time'].size
 
     # Check what the input data type is and set output
-    in_type = lat.dtype
+    in_type = data.variables['XLAT'].dtype
     if in_type == 'float32':
         dtype = 'f4'
     else:
@@ -66,119 +269,337 @@ def wrfpost(inname, outname, variables, plevs=None, compression=True, complevel=
     for i in range(times.shape[0]):
         vtimes.append(datetime.strptime(str(times[i]), '%Y-%m-%dT%H:%M:%S.000000000'))
 
-    # open the output file
-    outfile = Dataset(outname, 'w', format=format)
-
-    # copy original global attributes
-    for name in data.ncattrs():
-        setattr(outfile, name, getattr(data, name))
+    # parse input variable list against the variable definitions to pull out isobaric
+    # and other variables, and plan the computations
+    try:
+        iso_vars, other_vars = parse_variables(variables)
+    except KeyError:
+        data.close()
+        raise
+    levels = {name: values for name, values in
+              (('pressure', plevs), ('height', hlevels), ('theta', thlevels))
+              if values is not None}
+    if model_levels:
+        levels['model'] = np.arange(1, data.dimensions['bottom_top'].size + 1) * units('1')
+    plan = make_plan(data, variables, levels=levels)
+    reducer = get_reducer(data, other_vars, reduced_only)
+    for name in plan.skipped:
+        warnings.warn('No calculation for '+name+', skipped')
+    slab_size = get_slab_size(data, len(iso_vars) * max(len(levels), 1), max_memory)
+    if dry_run:
+        instrument.message(plan.describe(min(slab_size, ntimes)))
+        data.close()
+        return plan
 
-    # create output dimensions
-    outfile.createDimension('time', None)
-    outfile.createDimension('lat', data.dimensions['south_north'].size)
-    outfile.createDimension('lon', data.dimensions['west_east'].size)
-
-    # parse input variable list against dictionary to pull out isobaric,
-    # wrf-python, and other variables
-    iso_vars = []
-    other_vars = []
-    for variable in variables:
-        var_def = get_variables()
+    # markers of the groups written for each slab, so an interrupted run can be resumed
+    checkpoint = Checkpoint(outname, get_signature(
+        inname, variables=list(variables), levels=levels, slab_size=slab_size, format=format,
+        storage=storage, storage_vars=storage_vars, bbox=bbox, index_window=index_window,
+        stride=stride, regrid=regrid, regrid_method=regrid_method, stations=stations,
+        reduced_only=reduced_only, paths=paths, spacing=spacing))
+    resumed = None
+    if resume and not append and os.path.exists(outname) and checkpoint.load():
         try:
-            var_def[variable]
-            if var_def[variable][1] == 1:
-                iso_vars.append(variable)
-            else:
-                other_vars.append(variable)
-        except KeyError:
+            resumed = open_output(outname, 'a', format, ntimes)
+        except OSError:
+            warnings.warn('Cannot open '+outname+' to resume, starting over')
+
+    # open the output file, continuing after the times already written when appending
+    start = 0
+    if resumed is not None:
+        instrument.message('Resuming '+outname)
+        outfile = OutputFile(resumed, storage, storage_vars, ntimes, instrument, regridder,
+                             station_index, reducer)
+        checkpoint.validate(outfile.dataset)
+        valid_times = outfile.variables['valid_time']
+        if reducer is not None and checkpoint.load_state() is not None:
+            reducer.set_state(checkpoint.load_state())
+        # the output already has its dimensions and coordinates
+        append = True
+    elif append and os.path.exists(outname):
+        outfile = OutputFile(open_output(outname, 'a', format, ntimes), storage,
+                             storage_vars, ntimes, instrument, regridder, station_index,
+                             reducer)
+        valid_times = outfile.variables['valid_time']
+        # the times of a Zarr store extended to the run are missing until written
+        start = int(np.ma.count(valid_times[:]))
+        done = num2date(valid_times[:start], valid_times.units,
+                        only_use_cftime_datetimes=False, only_use_python_datetimes=True)
+        if list(done) != vtimes[:start]:
             outfile.close()
-            raise KeyError('Definition for '+variable+' not found.')
-    # create dimension for isobaric levels
-    if plevs is not None:
-        outfile.createDimension('pressure_levels', plevs.size)
-        p_lev = outfile.createVariable('plevels', dtype, ('pressure_levels'))
-        p_lev.units = 'Pascal'
-        p_lev.description = 'Isobaric Pressure Levels'
-        p_lev[:] = plevs.to('Pa').m
-        if len(iso_vars) < 1:
-            warnings.warn('Pressure levels specified but no isobaric variables requested')
-    elif len(iso_vars) > 0:
-        raise ValueError('Isobaric variables requested, no pressure levels given')
+            data.close()
+            raise ValueError('Times in '+outname+' do not match the input file')
+        if any(dim not in outfile.dimensions or outfile.dimensions[dim].size != size
+               for dim, size in grid_sizes.items()):
+            outfile.close()
+            data.close()
+            raise ValueError('Grid of '+outname+' does not match the run')
+        if reducer is not None:
+            if regridder is not None or station_index is not None:
+                outfile.close()
+                data.close()
+                raise ValueError('Reductions cannot be appended to regridded or station '
+                                 'output')
+            reducer.preload(outfile.dataset, start)
+    else:
+        append = False
+        # the workers start before the output is opened, so they do not hold its handle
+        compressor = None
+        if compress_workers is not None and compress_workers > 1:
+            compressor = ChunkCompressor(compress_workers)
+        outfile = OutputFile(open_output(outname, 'w', format, ntimes), storage,
+                             storage_vars, ntimes, instrument, regridder, station_index,
+                             reducer, compressor)
+
+        # copy original global attributes
+        for name in data.ncattrs():
+            outfile.setncattr(name, data.getncattr(name))
+        if window is not None:
+            for name, value in window.attributes().items():
+                outfile.setncattr(name, value)
+        if regridder is not None:
+            outfile.setncattr('regrid_method', regridder.method)
+
+        # create output dimensions
+        outfile.createDimension('time', None)
+        for dim, size in grid_sizes.items():
+            outfile.createDimension(dim, size)
+        if isinstance(station_index, PathIndex):
+            write_paths(outfile.dataset, station_index)
+        elif station_index is not None:
+            write_stations(outfile.dataset, station_index, len(levels) > 0)
+
+    # create dimensions for the levels of each vertical coordinate
+    coordinates = get_vertical_coordinates()
+    for name, values in levels.items():
+        coordinate = coordinates[name]
+        if append:
+            if (coordinate['dim'] not in outfile.dimensions or
+                    outfile.dimensions[coordinate['dim']].size != values.size):
+                outfile.close()
+                data.close()
+                raise ValueError(coordinate['description']+' do not match those in '+outname)
+            continue
+        outfile.createDimension(coordinate['dim'], values.size)
+        level_var = outfile.createVariable(coordinate['levels_var'], dtype,
+                                           (coordinate['dim'],))
+        level_var.units = coordinate['units']
+        level_var.description = coordinate['description']
+        level_var[:] = values.to(coordinate.get('convert_units', coordinate['units'])).m
+    if len(levels) > 0 and len(iso_vars) < 1:
+        warnings.warn('Vertical levels specified but no variables on levels requested')
+    elif len(levels) == 0 and len(iso_vars) > 0:
         outfile.close()
+        data.close()
+        raise ValueError('Variables on vertical levels requested, no levels given')
+
+    # split the run into slabs of time steps that fit in the memory budget
+    slabs = get_slabs(ntimes, slab_size, start)
+    if start >= ntimes:
+        instrument.message('No new times to process')
 
     # write times, lats, lons, and plevs to output file
-    valid_times = outfile.createVariable('valid_time', dtype, ('time',),
-                                         zlib=compression, complevel=complevel)
-    valid_times.units = 'seconds since '+str(vtimes[0])
-    valid_times.description = 'Model Forecast Times'
-    valid_times[:] = date2num(vtimes, valid_times.units)
-    del vtimes
-
-    latitude = outfile.createVariable('latitude', dtype, ('time', 'lat', 'lon'),
-                                      zlib=compression, complevel=complevel)
-    latitude.units = lat.units
-    latitude.description = lat.description
-    latitude[:] = np.array(lat)
-    del lat
-
-    longitude = outfile.createVariable('longitude', dtype, ('time', 'lat', 'lon'),
-                                       zlib=compression, complevel=complevel)
-    longitude.units = lon.units
-    longitude.description = lon.description
-    longitude[:] = np.array(lon)
-    del lon
-
-    # interpolate to isobaric levels and save to file
-    if len(iso_vars) > 0:
-        print('Processing isobaric variables')
-        get_isobaric_variables(data, iso_vars, plevs, outfile, dtype, compression, complevel)
-
-    # get precipitation variables if requested
-    if ('tot_pcp' in other_vars) or ('timestep_pcp' in other_vars):
-        print('Processing Precipitation Variables')
-        if ('tot_pcp' in other_vars) and ('timestep_pcp' in other_vars):
-            get_precip(data, outfile, dtype, compression, complevel, timestep=True, total=True)
-        elif 'tot_pcp' in other_vars:
-            get_precip(data, outfile, dtype, compression, complevel, total=True)
-        elif 'timestep_pcp' in other_vars:
-            get_precip(data, outfile, dtype, compression, complevel, timestep=True)
-
-    # get surface variables if requested
-    if 'temp_2m' in other_vars:
-        print('Processing variable: temp_2m')
-        get_temp_2m(data, outfile, dtype, compression, complevel)
-
-    if 'dewpt_2m' in other_vars:
-        print('Processing variable: dewpt_2m')
-        get_dewpt_2m(data, outfile, dtype, compression, complevel)
-
-    if 'q_2m' in other_vars:
-        print('Processing variable: q_2m')
-        get_q_2m(data, outfile, dtype, compression, complevel)
-
-    if 'u_10m' in other_vars:
-        print('Processing variable: u_10m')
-        get_u_10m(data, outfile, dtype, compression, complevel)
-
-    if 'v_10m' in other_vars:
-        print('Processing variable: v_10m')
-        get_v_10m(data, outfile, dtype, compression, complevel)
-
-    if 'mslp' in other_vars:
-        print('Processing variable: mslp')
-        get_mslp(data, outfile, dtype, compression, complevel)
-
-    if 'UH' in other_vars:
-        print('Processing variable: UH')
-        get_uh(data, outfile, dtype, compression, complevel)
-
-    if ('cape' in other_vars) or ('cin' in other_vars):
-        print('Processing variable: cape and cin')
-        get_cape(data, outfile, dtype, compression, complevel)
-
-    if 'refl' in other_vars:
-        print('Processing variable: relf')
-        get_dbz(data, outfile, dtype, compression, complevel)
-
-    outfile.close()
-    print('Success Complete WRF Post-Processing')
+    if not append:
+        valid_times = outfile.createVariable('valid_time', dtype, ('time',),
+                                             zlib=coord_storage['zlib'],
+                                             complevel=coord_storage['complevel'])
+        valid_times.units = 'seconds since '+str(vtimes[0])
+        valid_times.description = 'Model Forecast Times'
+    vtimes = date2num(vtimes, valid_times.units)
+
+    executor = None
+    if workers is not None and workers > 1 and len(plan) > 1 and tiles is None:
+        # workers write their own chunks of a Zarr store, when no write needs this process
+        output = None
+        if is_zarr(outname, format) and reducer is None and regridder is None:
+            output = (outname, storage, storage_vars, ntimes)
+        executor = get_executor(inname, min(workers, len(plan)), cache_size, window,
+                                station_index, output)
+
+    # latitude and longitude of a fixed domain only need to be written once
+    static_coords = coord_storage['static_coords'] and not is_moving_domain(data.dataset)
+    if static_coords:
+        coord_dims = ('lat', 'lon')
+    else:
+        coord_dims = ('time', 'lat', 'lon')
+    if regridder is not None and not append:
+        # the regular grid has 1D coordinates
+        write_var(outfile, 'latitude', regridder.target_lats, dtype, ('lat',),
+                  'degrees_north', 'Latitude of the regular grid', compression, complevel)
+        write_var(outfile, 'longitude', regridder.target_lons, dtype, ('lon',),
+                  'degrees_east', 'Longitude of the regular grid', compression, complevel)
+
+    # in pipeline mode, a reader process reads the fields of the slabs ahead and a writer
+    # process writes the output while this process computes. The output is closed first,
+    # so neither process inherits its open handle.
+    reader = None
+    if pipeline:
+        outfile.detach(lambda: Writer(outname, storage, storage_vars, ntimes, checkpoint,
+                                      format))
+        if executor is None:
+            reads = [(tslice, get_slab_reads(data, plan, checkpoint, tslice))
+                     for tslice in slabs]
+            # the fields read ahead for a slab are all held until it is computed
+            for tslice, slab_reads in reads:
+                steps = ntimes if tslice is None else tslice.stop - tslice.start
+                data.max_bytes = max(data.max_bytes, sum(get_node_bytes(data, name, steps)
+                                                         for name, _ in slab_reads))
+            reader = Reader(inname, reads, window, station_index, depth=int(pipeline))
+
+    # an interrupted run closes its files, keeping the groups marked done
+    try:
+        for tslice in slabs:
+            if tslice is None:
+                outfile.assign('valid_time', None, vtimes)
+                instrument.context['times'] = [0, ntimes]
+            else:
+                instrument.message('Processing time steps '+str(tslice.start)+' to ' +
+                                   str(tslice.stop - 1))
+                outfile.assign('valid_time', tslice, vtimes[tslice])
+                instrument.context['times'] = [tslice.start, tslice.stop]
+            if reader is not None:
+                # the wait for fields the reader has not finished reading
+                with instrument.stage('read ahead', 'slab'):
+                    reader.load(data, tslice)
+
+            if regridder is not None:
+                with instrument.stage('weights', 'regrid'):
+                    regridder.set_grids(np.array(get_wrf_var(data, 'lat', tslice)),
+                                        np.array(get_wrf_var(data, 'lon', tslice)), tslice)
+
+            for name, coord in (('latitude', 'lat'), ('longitude', 'lon')):
+                if (regridder is not None or station_index is not None or
+                        (static_coords and outfile.has(name))):
+                    continue
+                with instrument.stage('coordinates', name):
+                    if static_coords:
+                        start_time = 0 if tslice is None else tslice.start
+                        coord_data = get_wrf_var(data, coord,
+                                                 slice(start_time, start_time + 1))
+                        values = np.array(coord_data)[0]
+                        coord_slice = None
+                    else:
+                        coord_data = get_wrf_var(data, coord, tslice)
+                        values = np.array(coord_data)
+                        coord_slice = tslice
+                    write_var(outfile, name, values, dtype, coord_dims, coord_data.units,
+                              coord_data.description, compression, complevel, coord_slice)
+                del coord_data, values
+
+            # compute each group of variables and save to file
+            if executor is None:
+                for step in plan:
+                    if checkpoint.is_done(tslice, step['label']):
+                        continue
+                    written = dict(outfile.written)
+                    with instrument.stage('compute', step['label']):
+                        step['func'](data, *step['args'], outfile, dtype, compression,
+                                     complevel, tslice=tslice, **step['kwargs'])
+                    # free what no later step uses
+                    data.release(step['release'], tslice)
+                    mark_done(checkpoint, outfile, tslice, step['label'], written, reducer)
+            else:
+                steps = [step for step in plan
+                         if not checkpoint.is_done(tslice, step['label'])]
+                futures = [submit_group(executor, step['func'], step['args'], step['kwargs'],
+                                        dtype, tslice) for step in steps]
+                # the groups compute concurrently, this process writes what the workers
+                # did not write themselves
+                for step, future in zip(steps, futures):
+                    # compute time here is the wait for the worker process
+                    with instrument.stage('compute', step['label'], parallel=True):
+                        records, stored = future.result()
+                    written = dict(outfile.written)
+                    for name, nbytes in stored.items():
+                        outfile.written[name] = outfile.written.get(name, 0) + nbytes
+                    for record in records:
+                        write_var(outfile, *record[:6], compression, complevel, record[6])
+                    mark_done(checkpoint, outfile, tslice, step['label'], written, reducer)
+
+            # nothing computed for this slab is needed by the next one
+            data.clear()
+            # the compressed chunks the slab completed are not held until the end
+            outfile.write_chunks()
+    except BaseException:
+        if executor is not None:
+            executor.shutdown()
+        if reader is not None:
+            reader.close()
+        outfile.close(abort=True)
+        data.close()
+        raise
+
+    if executor is not None:
+        executor.shutdown()
+    if reader is not None:
+        reader.close()
+    with instrument.stage('close', outname):
+        outfile.close()
+    if outfile.writer is not None:
+        instrument.message('Writer seconds: {:.2f}'.format(outfile.writer.stats['seconds']))
+    checkpoint.remove()
+    data.close()
+    if report:
+        storage_report(outname)
+    stats = data.stats()
+    instrument.message('Cache hits: '+str(stats['hits'])+', misses: '+str(stats['misses']) +
+                       ', evictions: '+str(stats['evictions']))
+    if verbose:
+        instrument.print_summary()
+    instrument.message('Success Complete WRF Post-Processing')
+    if log is not None:
+        emitter.close()
+
+
+def get_reducer(data, variables, reduced_only=False):
+    """
+    Gets the reducer of the maximum and minimum reductions of a run
+    :param data: input netCDF4 Dataset
+    :param variables: list of requested variables other than vertical variables
+    :param reduced_only: True to write only the reductions of the variables they reduce
+    :return: reduction.Reducer, or None if no reductions are requested
+    """
+    reductions = [(name,) + get_variable(name)['reduction'] for name in variables
+                  if 'reduction' in get_variable(name)]
+    if len(reductions) == 0:
+        return None
+    reduced = get_reduced_fields()
+    write_fields = [] if reduced_only else [reduced[name] for name in variables
+                                            if name in reduced]
+    return Reducer(reductions, get_valid_seconds(data), write_fields)
+
+
+def mark_done(checkpoint, outfile, tslice, label, written, reducer=None):
+    """
+    Marks a group of variables done for a slab
+    :param checkpoint: checkpoint.Checkpoint of the run
+    :param outfile: output.OutputFile
+    :param tslice: slice of time steps, or None for all times
+    :param label: name of the group
+    :param written: copy of the bytes written of each variable before the group
+    :param reducer: optional reduction.Reducer, whose state is saved with the marker
+    """
+    if outfile.compressor is not None:
+        # chunks spanning slabs are only written when the output is closed
+        return
+    names = [name for name, nbytes in outfile.written.items() if written.get(name) != nbytes]
+    state = None if reducer is None else reducer.get_state()
+    if outfile.writer is not None:
+        # marked by the writer process once the variables are written
+        outfile.writer.mark(tslice, label, names, state)
+    else:
+        checkpoint.mark(outfile, tslice, label, names, state)
+
+
+def get_slab_reads(data, plan, checkpoint, tslice):
+    """
+    Gets the raw fields the groups of a slab still to compute read
+    :param data: input netCDF4 Dataset
+    :param plan: planner.Plan of the run
+    :param checkpoint: checkpoint.Checkpoint of the run
+    :param tslice: slice of time steps, or None for all times
+    :return: list of (raw WRF field name, halo) reads, see cache.DiagnosticCache.read
+    """
+    reads = [read for step in plan if not checkpoint.is_done(tslice, step['label'])
+             for read in data.get_reads(step['needs'], step['fields'])]
+    return list(dict.fromkeys(reads))
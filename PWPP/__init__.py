@@ -1 +1,29 @@
-from .PWPP import wrfpost
+# Python WRF Post Processor. Entry points needing optional dependencies, such as dask for
+# wrfpost_dataset, are imported on first use. Before Python 3.7, import them from their
+# modules, such as PWPP.lazy.
+
+import importlib
+from .PWPP import wrfpost  # noqa: F401
+from .batch import wrfpost_batch  # noqa: F401
+from .ensemble import wrfpost_ensemble  # noqa: F401
+
+# optional entry point name to the module defining it
+_OPTIONAL_ENTRY_POINTS = {
+    'wrfpost_dataset': 'lazy',
+}
+
+__all__ = ['wrfpost', 'wrfpost_batch', 'wrfpost_ensemble'] + list(_OPTIONAL_ENTRY_POINTS)
+
+
+def __getattr__(name):
+    """Imports an optional entry point on first access"""
+    if name not in _OPTIONAL_ENTRY_POINTS:
+        raise AttributeError('module '+__name__+' has no attribute '+name)
+    value = getattr(importlib.import_module('.' + _OPTIONAL_ENTRY_POINTS[name], __name__),
+                    name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(list(globals()) + __all__))
@@ -0,0 +1,323 @@
+# Output file backends, netCDF4 files and Zarr directory stores
+
+import os
+import numpy as np
+from netCDF4 import Dataset, default_fillvals
+
+# format name of Zarr directory stores
+ZARR = 'ZARR'
+
+
+def is_zarr(outname, format=None):
+    """
+    Checks if an output is a Zarr store
+    :param outname: output path
+    :param format: output format name, or None to check the path of an existing output
+    :return: True for Zarr stores
+    """
+    if format is not None:
+        return format.upper() == ZARR
+    return os.path.isdir(outname)
+
+
+def open_output(outname, mode='r', format=None, ntimes=None):
+    """
+    Opens an output file with the backend of its format
+    :param outname: output path
+    :param mode: 'r' to read, 'w' to create, or 'a' to write an existing output
+    :param format: netCDF format name such as 'NETCDF4', or 'ZARR' for a Zarr directory
+        store. Default is None, the format of an existing output, or NETCDF4.
+    :param ntimes: number of times of the run, the size of unlimited dimensions in Zarr
+    :return: netCDF4 Dataset or ZarrDataset
+    """
+    if is_zarr(outname, format if mode == 'w' or format is not None else None):
+        return ZarrDataset(outname, mode, ntimes)
+    if mode == 'w':
+        return Dataset(outname, 'w', format=format or 'NETCDF4')
+    return Dataset(outname, mode)
+
+
+def quantize(values, digits):
+    """
+    Rounds values to keep a number of decimal digits, as the netCDF4 library does for the
+    least_significant_digit of a variable, so they compress better
+    :param values: array of values
+    :param digits: number of decimal digits to keep
+    :return: array of rounded values
+    """
+    exp = np.log10(10. ** -digits)
+    exp = int(np.floor(exp)) if exp < 0 else int(np.ceil(exp))
+    scale = 2. ** np.ceil(np.log2(10. ** -exp))
+    return np.around(scale * values) / scale
+
+
+def _to_json(value):
+    """Converts an attribute value to a type stored in Zarr metadata"""
+    if isinstance(value, bytes):
+        return value.decode()
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    return value
+
+
+class ZarrDimension(object):
+    """Size of a dimension of a ZarrDataset, like a netCDF4 Dimension"""
+    def __init__(self, name, size, unlimited):
+        self.name = name
+        self.size = size
+        self._unlimited = unlimited
+
+    def __len__(self):
+        return self.size
+
+    def isunlimited(self):
+        return self._unlimited
+
+
+class ZarrVariable(object):
+    """
+    Array of a ZarrDataset with the interface of a netCDF4 Variable. Values are masked
+    where they equal the fill value, and packed with the scale_factor and add_offset
+    attributes, as the netCDF4 library does.
+    """
+    def __init__(self, dataset, array):
+        """
+        :param dataset: ZarrDataset of the array
+        :param array: zarr Array
+        """
+        self._dataset = dataset
+        self._array = array
+
+    @property
+    def name(self):
+        return self._array.basename
+
+    @property
+    def dimensions(self):
+        return tuple(self._array.attrs['_ARRAY_DIMENSIONS'])
+
+    @property
+    def shape(self):
+        return self._array.shape
+
+    @property
+    def ndim(self):
+        return self._array.ndim
+
+    @property
+    def dtype(self):
+        return self._array.dtype
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            return self._array.attrs[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        if name.startswith('_'):
+            object.__setattr__(self, name, value)
+        else:
+            self.setncattr(name, value)
+
+    def ncattrs(self):
+        return [name for name in self._array.attrs if name != '_ARRAY_DIMENSIONS']
+
+    def getncattr(self, name):
+        return self._array.attrs[name]
+
+    def setncattr(self, name, value):
+        self._array.attrs[name] = _to_json(value)
+
+    def filters(self):
+        """Gets the compression settings, like netCDF4 Variable.filters"""
+        compressors = self._array.compressors
+        level = compressors[0].get_config().get('level', 0) if compressors else 0
+        return {'zlib': len(compressors) > 0, 'shuffle': any(
+            codec.codec_id == 'shuffle' for codec in self._array.filters),
+            'complevel': level, 'fletcher32': False}
+
+    def chunking(self):
+        return list(self._array.chunks)
+
+    def nbytes_stored(self):
+        """Gets the bytes of the stored chunks and metadata of the array"""
+        return self._array.nbytes_stored()
+
+    def _fill(self):
+        return None if self.dtype.kind == 'S' else self._array.fill_value
+
+    def __getitem__(self, index):
+        values = np.asarray(self._array[index])
+        if self.dtype.kind == 'S':
+            return values
+        values = np.ma.masked_equal(values, self._fill(), copy=False)
+        if 'scale_factor' in self._array.attrs:
+            values = (values * np.float32(self.scale_factor) +
+                      np.float32(self._array.attrs.get('add_offset', 0.)))
+        return values
+
+    def __setitem__(self, index, values):
+        if self.dtype.kind != 'S':
+            values = np.ma.asarray(values)
+            if 'least_significant_digit' in self._array.attrs:
+                values = quantize(values, self.least_significant_digit)
+            if 'scale_factor' in self._array.attrs:
+                values = ((values - self._array.attrs.get('add_offset', 0.)) /
+                          self.scale_factor)
+                if self.dtype.kind in 'iu':
+                    values = np.around(values)
+            values = np.ma.filled(values, self._fill()).astype(self.dtype)
+        self._dataset.grow(self, index, np.shape(values))
+        self._array[index] = values
+
+
+class ZarrDataset(object):
+    """
+    Zarr directory store with the interface of a netCDF4 Dataset used by the output, so it
+    can take the place of the output netCDF4 Dataset. Arrays are stored in the Zarr
+    version 2 format with their dimension names in the _ARRAY_DIMENSIONS attribute, as
+    read by xarray.open_zarr, and the metadata is consolidated when the store is closed.
+
+    Arrays along unlimited dimensions are created with the number of times of the run, so
+    no write changes the metadata of an array and processes can write their own chunks
+    of the store at the same time without a lock, as long as they do not share chunks.
+    Times not written yet are missing, so the store can be read during the run.
+    """
+    def __init__(self, path, mode='r', ntimes=None):
+        """
+        :param path: path of the directory store
+        :param mode: 'r' to read, 'w' to create, or 'a' to write an existing store
+        :param ntimes: number of times of the run. Arrays along unlimited dimensions are
+            extended to it when an existing store is opened to write.
+        """
+        import zarr
+        self._path = path
+        self._writable = mode != 'r'
+        try:
+            if mode == 'w':
+                self._group = zarr.open_group(path, mode='w', zarr_format=2)
+                self._group.attrs['_dimensions'] = {}
+            else:
+                # arrays created since the metadata was consolidated are read as well
+                self._group = zarr.open_group(path, mode='r+' if self._writable else 'r',
+                                              zarr_format=2,
+                                              use_consolidated=None if mode == 'r' else False)
+        except (FileNotFoundError, ValueError) as err:
+            raise OSError('Cannot open Zarr store '+str(path)+': '+str(err))
+        self._ntimes = ntimes
+        self._sizes = dict(self._group.attrs.get('_dimensions', {}))
+        self.variables = {name: ZarrVariable(self, self._group[name])
+                          for name in sorted(self._group.array_keys())}
+        if self._writable and ntimes is not None:
+            for var in self.variables.values():
+                self.grow(var, None, None)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            return self._group.attrs[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        if name.startswith('_') or name == 'variables':
+            object.__setattr__(self, name, value)
+        else:
+            self.setncattr(name, value)
+
+    @property
+    def dimensions(self):
+        dimensions = {}
+        for name, size in self._sizes.items():
+            if size is None:
+                # the current size of an unlimited dimension is that of its arrays
+                size = max([var.shape[var.dimensions.index(name)] for var in
+                            self.variables.values() if name in var.dimensions] +
+                           [self._ntimes or 0])
+            dimensions[name] = ZarrDimension(name, size, self._sizes[name] is None)
+        return dimensions
+
+    def ncattrs(self):
+        return [name for name in self._group.attrs if name != '_dimensions']
+
+    def getncattr(self, name):
+        return self._group.attrs[name]
+
+    def setncattr(self, name, value):
+        self._group.attrs[name] = _to_json(value)
+
+    def filepath(self):
+        return self._path
+
+    def createDimension(self, name, size=None):
+        """
+        Creates a dimension
+        :param name: dimension name
+        :param size: dimension size, or None for an unlimited dimension
+        """
+        self._sizes[name] = size
+        self._group.attrs['_dimensions'] = self._sizes
+
+    def createVariable(self, name, dtype, dims, zlib=False, complevel=4, shuffle=True,
+                       chunksizes=None, fill_value=None, least_significant_digit=None):
+        """
+        Creates an array with the arguments of netCDF4 Dataset.createVariable
+        :return: ZarrVariable
+        """
+        import numcodecs
+        dtype = np.dtype(dtype)
+        dimensions = self.dimensions
+        shape = tuple(dimensions[dim].size for dim in dims)
+        if chunksizes is None:
+            # one time step per chunk, so the writes of slabs never share chunks
+            chunksizes = tuple(1 if dimensions[dim].isunlimited() and len(dims) > 1
+                               else max(size, 1) for dim, size in zip(dims, shape))
+        filters = []
+        if zlib and shuffle and dtype.itemsize > 1:
+            filters.append(numcodecs.Shuffle(dtype.itemsize))
+        if fill_value is None:
+            fill_value = b'' if dtype.kind == 'S' else default_fillvals[dtype.str[1:]]
+        attributes = {'_ARRAY_DIMENSIONS': list(dims)}
+        if least_significant_digit is not None:
+            attributes['least_significant_digit'] = least_significant_digit
+        array = self._group.create_array(
+            name, shape=shape, chunks=tuple(chunksizes), dtype=dtype,
+            compressors=numcodecs.Zlib(complevel) if zlib else None, filters=filters or None,
+            fill_value=np.asarray(fill_value, dtype=dtype)[()], attributes=attributes)
+        self.variables[name] = ZarrVariable(self, array)
+        return self.variables[name]
+
+    def grow(self, var, index, shape):
+        """
+        Extends an array along its unlimited dimensions to the number of times of the
+        run, or to the index written past its end
+        :param var: ZarrVariable
+        :param index: index written, or None
+        :param shape: shape of the values written, or None
+        """
+        index = index if isinstance(index, tuple) else (index,)
+        new_shape = list(var.shape)
+        for axis, dim in enumerate(var.dimensions):
+            if self._sizes.get(dim, 0) is not None:
+                continue
+            new_shape[axis] = max(new_shape[axis], self._ntimes or 0)
+            item = index[axis] if axis < len(index) else None
+            if isinstance(item, slice) and item.stop is not None:
+                new_shape[axis] = max(new_shape[axis], item.stop)
+            elif isinstance(item, slice) and shape is not None and len(shape) == var.ndim:
+                new_shape[axis] = max(new_shape[axis], (item.start or 0) + shape[axis])
+        if tuple(new_shape) != var.shape:
+            var._array.resize(tuple(new_shape))
+
+    def sync(self):
+        """Writes are stored as they are made"""
+
+    def close(self):
+        """Consolidates the metadata of the arrays, so readers open the store at once"""
+        if self._writable:
+            import zarr
+            zarr.consolidate_metadata(self._path, zarr_format=2)
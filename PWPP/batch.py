@@ -0,0 +1,169 @@
+# Batch post processing of many WRF output files
+
+import glob
+import os
+import shutil
+import tempfile
+from multiprocessing import Pool
+import numpy as np
+from netCDF4 import Dataset, num2date, date2num
+from .PWPP import wrfpost
+
+
+def _init_worker():
+    """Imports the heavy dependencies once per worker process"""
+    import wrf  # noqa: F401
+    import metpy.calc  # noqa: F401
+    import netCDF4  # noqa: F401
+
+
+def _run_wrfpost(args):
+    """Runs wrfpost for one file inside a worker process"""
+    inname, outname, variables, plevs, kwargs = args
+    if plevs is not None:
+        from metpy.units import units
+        plevs = units.Quantity(plevs, 'Pa')
+    wrfpost(inname, outname, variables, plevs=plevs, **kwargs)
+    return outname
+
+
+def run_wrfpost_files(innames, outnames, variables, plevs=None, processes=None,
+                      ordered=True, **kwargs):
+    """
+    Runs wrfpost on each input file in a pool of worker processes, one file per task
+    :param innames: list of input file paths
+    :param outnames: list of output file paths, one per input file
+    :param variables: list of desired variable strings, see wrfpost
+    :param plevs: optional array of desired output pressure levels
+    :param processes: number of worker processes. Default is the number of CPUs.
+    :param ordered: True to yield the outputs in the order of the input files, False to
+        yield each output as soon as it finishes
+    :param kwargs: other keyword arguments passed to wrfpost
+    :return: generator of output file paths
+    """
+    # pass pressure levels as plain Pascal values to the workers
+    if plevs is not None:
+        plevs = plevs.to('Pa').m
+    tasks = [(inname, outname, variables, plevs, kwargs)
+             for inname, outname in zip(innames, outnames)]
+    with Pool(processes, initializer=_init_worker) as pool:
+        # one file per task, since each file is much more work than the dispatch
+        run = pool.imap if ordered else pool.imap_unordered
+        for outname in run(_run_wrfpost, tasks, chunksize=1):
+            yield outname
+
+
+def get_output_name(inname, outdir):
+    """
+    Gets the per-file output path for an input file
+    :param inname: input file path
+    :param outdir: output directory
+    :return: output file path
+    """
+    name = os.path.basename(inname)
+    if not name.endswith('.nc'):
+        name += '.nc'
+    return os.path.join(outdir, name)
+
+
+def wrfpost_batch(innames, outname, variables, plevs=None, processes=None, merge=False,
+                  **kwargs):
+    """
+    Runs the WRF Post Processor on many files in a pool of worker processes
+    :param innames: glob pattern string or list of input file paths
+    :param outname: output directory for per-file outputs, or output file path if merge
+    :param variables: list of desired variable strings, see wrfpost
+    :param plevs: optional array of desired output pressure levels
+    :param processes: number of worker processes. Default is the number of CPUs.
+    :param merge: True to merge all outputs along time into the single file outname.
+        All input files must be from the same domain. Merging timestep_pcp needs tot_pcp.
+    :param kwargs: other keyword arguments passed to wrfpost
+    :return: list of output file paths, in the order of the input files
+    """
+    if isinstance(innames, str):
+        innames = sorted(glob.glob(innames))
+    if len(innames) < 1:
+        raise ValueError('No input files given')
+    if merge and 'timestep_pcp' in variables and 'tot_pcp' not in variables:
+        raise ValueError('Merging timestep_pcp needs tot_pcp to accumulate across files')
+
+    if merge:
+        outdir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(outname)))
+        # per-file outputs are numbered since input files may share a base name
+        outnames = [os.path.join(outdir, str(i) + '.nc') for i in range(len(innames))]
+    else:
+        outdir = outname
+        if not os.path.isdir(outdir):
+            os.makedirs(outdir)
+        outnames = [get_output_name(inname, outdir) for inname in innames]
+
+    try:
+        outnames = list(run_wrfpost_files(innames, outnames, variables, plevs=plevs,
+                                          processes=processes, **kwargs))
+        if merge:
+            merge_outputs(outnames, outname)
+            outnames = [outname]
+    finally:
+        if merge:
+            shutil.rmtree(outdir, ignore_errors=True)
+    return outnames
+
+
+def merge_outputs(innames, outname):
+    """
+    Merges post-processed output files along time in order of their valid times
+    :param innames: list of wrfpost output file paths
+    :param outname: merged output file path
+    """
+    inputs = [Dataset(name) for name in innames]
+    try:
+        for data in inputs:
+            # the first step of each file is accumulated from the previous total
+            if 'timestep_pcp' in data.variables and 'tot_pcp' not in data.variables:
+                raise ValueError('Merging timestep_pcp needs tot_pcp to accumulate across '
+                                 'files')
+        starts = [num2date(data.variables['valid_time'][0], data.variables['valid_time'].units)
+                  for data in inputs]
+        inputs = [inputs[i] for i in np.argsort(starts, kind='stable')]
+        first = inputs[0]
+        for data in inputs[1:]:
+            if ((data.dimensions['lat'].size != first.dimensions['lat'].size) or
+                    (data.dimensions['lon'].size != first.dimensions['lon'].size)):
+                raise ValueError('Cannot merge outputs from different domains')
+
+        outfile = Dataset(outname, 'w', format=first.data_model)
+        outfile.setncatts(first.__dict__)
+        for name, dim in first.dimensions.items():
+            outfile.createDimension(name, None if dim.isunlimited() else dim.size)
+        for name, var in first.variables.items():
+            filters = var.filters() or {}
+            out_var = outfile.createVariable(name, var.dtype, var.dimensions,
+                                             zlib=filters.get('zlib', False),
+                                             complevel=filters.get('complevel', 4),
+                                             shuffle=filters.get('shuffle', True))
+            out_var.setncatts(var.__dict__)
+            if 'time' not in var.dimensions:
+                out_var[:] = var[:]
+
+        # append each file along time, rebasing the valid times to the first file
+        t = 0
+        units = outfile.variables['valid_time'].units
+        for data in inputs:
+            ntimes = data.dimensions['time'].size
+            tslice = slice(t, t + ntimes)
+            for name, var in data.variables.items():
+                if 'time' not in var.dimensions:
+                    continue
+                values = var[:]
+                if name == 'valid_time':
+                    values = date2num(num2date(values, var.units), units)
+                elif name == 'timestep_pcp' and t > 0:
+                    # accumulate the first step from the end of the previous file
+                    values[0] = (data.variables['tot_pcp'][0] -
+                                 outfile.variables['tot_pcp'][t - 1])
+                outfile.variables[name][tslice] = values
+            t += ntimes
+        outfile.close()
+    finally:
+        for data in inputs:
+            data.close()
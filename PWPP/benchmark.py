@@ -0,0 +1,390 @@
+# Benchmarks of the post processor on synthetic WRF output files
+
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+import numpy as np
+from netCDF4 import Dataset
+
+# physical constants used to build the synthetic atmosphere
+_RD = 287.04
+_G = 9.81
+_P_TOP = 5000.
+_EARTH_RADIUS = 6370000.
+
+# calc functions timed by the benchmark, with the arguments they take before the output file
+_CASES = (
+    ('get_isobaric_variables', True, {}),
+    ('get_precip', False, {'timestep': True, 'total': True}),
+    ('get_temp_2m', False, {}),
+    ('get_dewpt_2m', False, {}),
+    ('get_q_2m', False, {}),
+    ('get_u_10m', False, {}),
+    ('get_v_10m', False, {}),
+    ('get_mslp', False, {}),
+    ('get_uh', False, {}),
+    ('get_cape', False, {}),
+    ('get_dbz', False, {}),
+)
+
+# variables processed by the whole-run benchmark
+_VARIABLES = ['uwnd', 'vwnd', 'wwnd', 'temp', 'dewpt', 'avor', 'height', 'mslp', 'temp_2m',
+              'dewpt_2m', 'q_2m', 'u_10m', 'v_10m', 'tot_pcp', 'timestep_pcp', 'UH', 'cape',
+              'cin', 'refl']
+_ISOBARIC = ['uwnd', 'vwnd', 'wwnd', 'temp', 'dewpt', 'avor', 'height']
+_PLEVS = [850., 700., 500., 300.]
+
+
+def _mercator(nx, ny, dx, cen_lat, cen_lon):
+    """Gets latitude and longitude of a Mercator grid true at the equator"""
+    x = (np.arange(nx) - (nx - 1) / 2.) * dx
+    y = (np.arange(ny) - (ny - 1) / 2.) * dx
+    y0 = _EARTH_RADIUS * np.log(np.tan(np.pi / 4. + np.radians(cen_lat) / 2.))
+    lon = cen_lon + np.degrees(x / _EARTH_RADIUS)
+    lat = np.degrees(2. * np.arctan(np.exp((y + y0) / _EARTH_RADIUS)) - np.pi / 2.)
+    lon, lat = np.meshgrid(lon, lat)
+    return lat.astype('f4'), lon.astype('f4')
+
+
+def _saturation_mixing_ratio(temp, pres):
+    """Gets the saturation mixing ratio in kg/kg from temperature in K and pressure in Pa"""
+    es = 611.2 * np.exp(17.67 * (temp - 273.15) / (temp - 29.65))
+    return 0.622 * es / (pres - es)
+
+
+def make_wrfout(outname, nx=100, ny=100, nz=40, nt=6, dx=3000., seed=0):
+    """
+    Writes a synthetic WRF output file with a physically plausible atmosphere: a standard
+    atmosphere over a terrain ridge, a westerly jet, and a moist convective region that
+    moves across the domain and rains.
+    :param outname: output file path
+    :param nx: number of west_east points
+    :param ny: number of south_north points
+    :param nz: number of bottom_top levels
+    :param nt: number of hourly time steps
+    :param dx: grid spacing in m
+    :param seed: seed of the random perturbations
+    """
+    rng = np.random.RandomState(seed)
+    cen_lat, cen_lon = 35., -97.
+    start = datetime(2017, 5, 18, 0)
+
+    data = Dataset(outname, 'w')
+    start_date = start.strftime('%Y-%m-%d_%H:%M:%S')
+    data.setncatts({
+        'TITLE': ' OUTPUT FROM WRF V3.7 MODEL', 'START_DATE': start_date,
+        'SIMULATION_START_DATE': start_date,
+        'WEST-EAST_GRID_DIMENSION': nx + 1, 'SOUTH-NORTH_GRID_DIMENSION': ny + 1,
+        'BOTTOM-TOP_GRID_DIMENSION': nz + 1, 'DX': dx, 'DY': dx, 'DT': 18., 'GRIDTYPE': 'C',
+        'MP_PHYSICS': 8, 'BUCKET_MM': -1., 'BUCKET_J': -1., 'GRID_ID': 1, 'PARENT_ID': 0,
+        'I_PARENT_START': 1, 'J_PARENT_START': 1, 'PARENT_GRID_RATIO': 1,
+        'CEN_LAT': cen_lat, 'CEN_LON': cen_lon, 'TRUELAT1': 0., 'TRUELAT2': 0.,
+        'MOAD_CEN_LAT': cen_lat, 'STAND_LON': cen_lon, 'POLE_LAT': 90., 'POLE_LON': 0.,
+        'MAP_PROJ': 3, 'MAP_PROJ_CHAR': 'Mercator', 'MMINLU': 'USGS'})
+    for name, size in (('Time', None), ('DateStrLen', 19), ('west_east', nx),
+                       ('south_north', ny), ('bottom_top', nz), ('bottom_top_stag', nz + 1),
+                       ('west_east_stag', nx + 1), ('south_north_stag', ny + 1)):
+        data.createDimension(name, size)
+
+    mass = ('Time', 'south_north', 'west_east')
+    level = ('Time', 'bottom_top', 'south_north', 'west_east')
+    stag = ('Time', 'bottom_top_stag', 'south_north', 'west_east')
+    u_mass = ('Time', 'south_north', 'west_east_stag')
+    v_mass = ('Time', 'south_north_stag', 'west_east')
+    lat_desc, lon_desc = 'LATITUDE, SOUTH IS NEGATIVE', 'LONGITUDE, WEST IS NEGATIVE'
+    fields = {
+        'XLAT': (mass, 'degree_north', lat_desc), 'XLONG': (mass, 'degree_east', lon_desc),
+        'XLAT_U': (u_mass, 'degree_north', lat_desc),
+        'XLONG_U': (u_mass, 'degree_east', lon_desc),
+        'XLAT_V': (v_mass, 'degree_north', lat_desc),
+        'XLONG_V': (v_mass, 'degree_east', lon_desc),
+        'U': (('Time', 'bottom_top', 'south_north', 'west_east_stag'), 'm s-1',
+              'x-wind component'),
+        'V': (('Time', 'bottom_top', 'south_north_stag', 'west_east'), 'm s-1',
+              'y-wind component'),
+        'W': (stag, 'm s-1', 'z-wind component'),
+        'PH': (stag, 'm2 s-2', 'perturbation geopotential'),
+        'PHB': (stag, 'm2 s-2', 'base-state geopotential'),
+        'T': (level, 'K', 'perturbation potential temperature (theta-t0)'),
+        'P': (level, 'Pa', 'perturbation pressure'),
+        'PB': (level, 'Pa', 'BASE STATE PRESSURE'),
+        'QVAPOR': (level, 'kg kg-1', 'Water vapor mixing ratio'),
+        'QCLOUD': (level, 'kg kg-1', 'Cloud water mixing ratio'),
+        'QRAIN': (level, 'kg kg-1', 'Rain water mixing ratio'),
+        'Q2': (mass, 'kg kg-1', 'QV at 2 M'), 'T2': (mass, 'K', 'TEMP at 2 M'),
+        'PSFC': (mass, 'Pa', 'SFC PRESSURE'), 'U10': (mass, 'm s-1', 'U at 10 M'),
+        'V10': (mass, 'm s-1', 'V at 10 M'),
+        'MAPFAC_M': (mass, '', 'Map scale factor on mass grid'),
+        'MAPFAC_U': (u_mass, '', 'Map scale factor on u-grid'),
+        'MAPFAC_V': (v_mass, '', 'Map scale factor on v-grid'),
+        'F': (mass, 's-1', 'Coriolis sine latitude term'),
+        'HGT': (mass, 'm', 'Terrain Height'),
+        'RAINC': (mass, 'mm', 'ACCUMULATED TOTAL CUMULUS PRECIPITATION'),
+        'RAINSH': (mass, 'mm', 'ACCUMULATED SHALLOW CUMULUS PRECIPITATION'),
+        'RAINNC': (mass, 'mm', 'ACCUMULATED TOTAL GRID SCALE PRECIPITATION'),
+    }
+    times = data.createVariable('Times', 'S1', ('Time', 'DateStrLen'))
+    xtime = data.createVariable('XTIME', 'f4', ('Time',))
+    xtime.units = 'minutes since ' + start.strftime('%Y-%m-%d %H:%M:%S')
+    xtime.description = xtime.units
+    for name, (dims, units, description) in fields.items():
+        var = data.createVariable(name, 'f4', dims)
+        stagger = ('X' if 'west_east_stag' in dims else 'Y' if 'south_north_stag' in dims
+                   else 'Z' if 'bottom_top_stag' in dims else '')
+        var.setncatts({'FieldType': 104, 'MemoryOrder': 'XYZ' if len(dims) == 4 else 'XY ',
+                       'description': description, 'units': units, 'stagger': stagger})
+
+    # fixed domain coordinates and map factors
+    lat, lon = _mercator(nx, ny, dx, cen_lat, cen_lon)
+    lat_u, lon_u = _mercator(nx + 1, ny, dx, cen_lat, cen_lon)
+    lat_v, lon_v = _mercator(nx, ny + 1, dx, cen_lat, cen_lon)
+    jj, ii = np.meshgrid(np.arange(ny), np.arange(nx), indexing='ij')
+
+    # terrain ridge running south to north, and surface pressure over it
+    hgt = 1200. * np.exp(-((ii - 0.25 * nx) / (0.1 * nx)) ** 2) + 200.
+    psfc_base = 101325. * np.exp(-hgt / 8000.)
+
+    # terrain-following eta levels stretched toward the surface
+    znw = 1. - np.linspace(0., 1., nz + 1) ** 1.4
+    znu = (znw[:-1] + znw[1:]) / 2.
+    rain_total = np.zeros((ny, nx))
+
+    for t in range(nt):
+        valid = start + timedelta(hours=t)
+        times[t] = np.array(list(valid.strftime('%Y-%m-%d_%H:%M:%S')), dtype='S1')
+        xtime[t] = 60. * t
+
+        # convective region moving east along the middle of the domain
+        cx = nx * (0.3 + 0.4 * t / max(nt - 1, 1))
+        blob = np.exp(-((ii - cx) ** 2 + (jj - ny / 2.) ** 2) / (2. * (0.12 * nx) ** 2))
+        psfc = psfc_base - 300. * blob + 50. * rng.standard_normal((ny, nx))
+
+        # hydrostatic pressure, temperature, and geopotential of a standard atmosphere
+        pres = _P_TOP + znu[:, None, None] * (psfc - _P_TOP)
+        pres_stag = _P_TOP + znw[:, None, None] * (psfc - _P_TOP)
+        sigma = (pres - _P_TOP) / (psfc - _P_TOP)
+        temp = np.maximum(288.15 * (pres / 101325.) ** 0.190263, 216.65)
+        temp += 4. * blob * sigma ** 4 - 0.0065 * (hgt - 200.) * sigma ** 2
+        rh = np.clip(0.25 + 0.55 * sigma ** 2 + 0.2 * blob * sigma, 0.05, 0.98)
+        qvapor = rh * _saturation_mixing_ratio(temp, pres)
+        tv = temp * (1. + 0.61 * qvapor)
+        geopt = np.empty((nz + 1, ny, nx))
+        geopt[0] = _G * hgt
+        geopt[1:] = _G * hgt + np.cumsum(_RD * tv * np.log(pres_stag[:-1] / pres_stag[1:]),
+                                         axis=0)
+        theta = temp * (100000. / pres) ** (_RD / 1004.5)
+
+        # cloud and rain in the convective region, heaviest in the middle troposphere
+        cloud_shape = blob * np.exp(-((sigma - 0.5) / 0.25) ** 2)
+        qrain = 4e-3 * cloud_shape * (blob > 0.3)
+        qcloud = 1e-3 * cloud_shape
+
+        # westerly jet increasing with height with a wave in the meridional wind
+        shear = (1. - pres / 101325.) * 40.
+        u = 5. + shear + 2. * rng.standard_normal((nz, ny, nx))
+        v = 5. * np.sin(2. * np.pi * (ii - 0.1 * t * nx) / nx) * (1. + shear / 40.)
+        w = np.zeros((nz + 1, ny, nx))
+        w[1:-1] = 10. * blob * np.sin(np.pi * znw[1:-1, None, None]) ** 2
+
+        rain_total += 20. * blob ** 2 * (t > 0)
+
+        values = {
+            'XLAT': lat, 'XLONG': lon, 'XLAT_U': lat_u, 'XLONG_U': lon_u, 'XLAT_V': lat_v,
+            'XLONG_V': lon_v, 'HGT': hgt, 'PSFC': psfc,
+            'U': np.concatenate([u, u[:, :, -1:]], axis=2),
+            'V': np.concatenate([v, v[:, -1:, :]], axis=1),
+            'W': w, 'PHB': geopt * 0.98, 'PH': geopt * 0.02,
+            'T': theta - 300., 'PB': pres * 0.99, 'P': pres * 0.01,
+            'QVAPOR': qvapor, 'QCLOUD': qcloud, 'QRAIN': qrain,
+            'T2': temp[0] + 1., 'Q2': qvapor[0], 'U10': 0.7 * u[0], 'V10': 0.7 * v[0],
+            'MAPFAC_M': 1. / np.cos(np.radians(lat)),
+            'MAPFAC_U': 1. / np.cos(np.radians(lat_u)),
+            'MAPFAC_V': 1. / np.cos(np.radians(lat_v)),
+            'F': 2. * 7.2921e-5 * np.sin(np.radians(lat)),
+            'RAINNC': 0.7 * rain_total, 'RAINC': 0.2 * rain_total,
+            'RAINSH': 0.1 * rain_total,
+        }
+        for name, value in values.items():
+            data.variables[name][t] = value
+    data.close()
+
+
+def _io_counters():
+    """Gets the bytes read and written by this process, or None where not available"""
+    try:
+        with open('/proc/self/io') as io:
+            counters = dict(line.split(':') for line in io)
+    except (IOError, OSError):
+        return None, None
+    return int(counters['rchar']), int(counters['wchar'])
+
+
+def _measure(target, args):
+    """Runs a function in a fresh worker process and measures its cost"""
+    read_start, write_start = _io_counters()
+    rss_start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        target(*args)
+    # ru_maxrss is in kilobytes on Linux
+    rss_end = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result = {'wall': time.perf_counter() - wall_start,
+              'cpu': time.process_time() - cpu_start,
+              'peak_rss': rss_end * 1024, 'rss_increase': (rss_end - rss_start) * 1024}
+    read_end, write_end = _io_counters()
+    result['read_bytes'] = None if read_start is None else read_end - read_start
+    result['write_bytes'] = None if write_start is None else write_end - write_start
+    return result
+
+
+def _run_calc(inname, outname, func_name, iso, kwargs):
+    """Runs one calc function on the input file with a plain output file"""
+    from . import calc
+    from metpy.units import units
+    data = Dataset(inname)
+    outfile = Dataset(outname, 'w')
+    outfile.createDimension('time', None)
+    outfile.createDimension('lat', data.dimensions['south_north'].size)
+    outfile.createDimension('lon', data.dimensions['west_east'].size)
+    outfile.createDimension('pressure_levels', len(_PLEVS))
+    args = (_ISOBARIC, _PLEVS * units.hPa) if iso else ()
+    getattr(calc, func_name)(data, *args, outfile, 'f4', True, 4, **kwargs)
+    outfile.close()
+    data.close()
+
+
+def _run_wrfpost(inname, outname, kwargs):
+    """Runs the post processor with every variable"""
+    from .PWPP import wrfpost
+    from metpy.units import units
+    wrfpost(inname, outname, _VARIABLES, plevs=_PLEVS * units.hPa, **kwargs)
+
+
+def run_benchmark(inname, cases=None, repeat=1, wrfpost_kwargs=None):
+    """
+    Times each calc function and the whole wrfpost run on an input file. Each measurement
+    runs in a new process, so its peak RSS and I/O counts are its own.
+    :param inname: input WRF output file path
+    :param cases: optional list of calc function names and 'wrfpost' to run. Default is all.
+    :param repeat: number of runs of each case, keeping the fastest
+    :param wrfpost_kwargs: optional dictionary of keyword arguments passed to wrfpost
+    :return: results dictionary with the grid size, environment, and a dictionary of case
+        name to dictionary of wall and cpu seconds, peak_rss and rss_increase over the
+        process after imports, and read_bytes and write_bytes
+    """
+    if cases is None:
+        cases = [name for name, iso, kwargs in _CASES] + ['wrfpost']
+    data = Dataset(inname)
+    grid = {'nx': data.dimensions['west_east'].size, 'ny': data.dimensions['south_north'].size,
+            'nz': data.dimensions['bottom_top'].size, 'nt': data.dimensions['Time'].size}
+    data.close()
+
+    workdir = tempfile.mkdtemp()
+    context = multiprocessing.get_context('spawn')
+    results = {}
+    try:
+        for name in cases:
+            outname = os.path.join(workdir, name + '.nc')
+            if name == 'wrfpost':
+                target, args = _run_wrfpost, (inname, outname, wrfpost_kwargs or {})
+            else:
+                try:
+                    iso, kwargs = [case[1:] for case in _CASES if case[0] == name][0]
+                except IndexError:
+                    raise KeyError('Benchmark case '+name+' not found.')
+                target, args = _run_calc, (inname, outname, name, iso, kwargs)
+            runs = []
+            for i in range(repeat):
+                with context.Pool(1) as pool:
+                    runs.append(pool.apply(_measure, (target, args)))
+            results[name] = min(runs, key=lambda run: run['wall'])
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return {'grid': grid, 'python': platform.python_version(),
+            'date': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S'), 'results': results}
+
+
+def compare_results(results, baseline, tolerance=0.2, metrics=('wall', 'peak_rss')):
+    """
+    Compares benchmark results against a baseline
+    :param results: results dictionary from run_benchmark
+    :param baseline: results dictionary of an earlier run on the same grid size
+    :param tolerance: allowed fractional increase of each metric
+    :param metrics: names of the metrics to compare
+    :return: list of (case, metric, baseline value, new value) regressions
+    """
+    if results['grid'] != baseline['grid']:
+        raise ValueError('Cannot compare benchmarks of different grid sizes')
+    regressions = []
+    for name, result in results['results'].items():
+        if name not in baseline['results']:
+            continue
+        for metric in metrics:
+            old = baseline['results'][name].get(metric)
+            new = result.get(metric)
+            if old is None or new is None:
+                continue
+            if new > old * (1. + tolerance):
+                regressions.append((name, metric, old, new))
+    return regressions
+
+
+def main(argv=None):
+    """Command line entry point, returning 1 if any regression is found"""
+    parser = argparse.ArgumentParser(description='Benchmark the WRF post processor')
+    parser.add_argument('--input', help='existing WRF output file to benchmark')
+    parser.add_argument('--nx', type=int, default=100)
+    parser.add_argument('--ny', type=int, default=100)
+    parser.add_argument('--nz', type=int, default=40)
+    parser.add_argument('--nt', type=int, default=6)
+    parser.add_argument('--cases', nargs='+', help='calc function names and wrfpost')
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--output', default='benchmark.json', help='results JSON path')
+    parser.add_argument('--baseline', help='baseline results JSON path to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    workdir = None
+    inname = args.input
+    if inname is None:
+        workdir = tempfile.mkdtemp()
+        inname = os.path.join(workdir, 'wrfout_synthetic.nc')
+        make_wrfout(inname, args.nx, args.ny, args.nz, args.nt)
+    try:
+        results = run_benchmark(inname, args.cases, args.repeat)
+    finally:
+        if workdir is not None:
+            shutil.rmtree(workdir, ignore_errors=True)
+    with open(args.output, 'w') as out:
+        json.dump(results, out, indent=2)
+
+    print('{:<24}{:>10}{:>10}{:>14}{:>14}{:>14}'.format(
+        'case', 'wall', 'cpu', 'peak_rss', 'read', 'written'))
+    for name, row in results['results'].items():
+        print('{:<24}{:>10.3f}{:>10.3f}{:>14}{:>14}{:>14}'.format(
+            name, row['wall'], row['cpu'], row['peak_rss'], str(row['read_bytes']),
+            str(row['write_bytes'])))
+
+    if args.baseline is not None:
+        with open(args.baseline) as base:
+            baseline = json.load(base)
+        regressions = compare_results(results, baseline, args.tolerance)
+        for name, metric, old, new in regressions:
+            print('Regression in '+name+' '+metric+': '+str(old)+' -> '+str(new))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,373 @@
+# Memory-bounded cache for raw WRF fields and wrf-python diagnostics
+
+import warnings
+from collections import OrderedDict
+import numpy as np
+import xarray as xr
+from wrf import getvar, ALL_TIMES
+from .util import parse_bytes
+from .instrument import timed
+from .variable_def import get_intermediates
+from .subset import is_staggered
+from .tiling import (TILED_DIAGNOSTICS, fill_masked, get_shared_memory, get_tile_executor,
+                     getvar_tiled)
+
+# diagnostics that wrf-python returns straight from a raw variable, which would lose their
+# metadata if the raw variable came from the cache
+_RAW_DIAGNOSTICS = ('lat', 'lon', 'ter', 'times', 'xtimes')
+
+# horizontal dimensions of fields on the mass grid
+_MASS_DIMS = ('south_north', 'west_east')
+
+
+class DiagnosticCache(object):
+    """
+    Wraps an input netCDF4 Dataset and memoizes raw variable reads and wrf-python
+    diagnostics with least-recently-used eviction under a byte limit.
+
+    Raw fields requested internally by wrf-python are served from the cache through
+    the getvar cache argument, so a field shared by several diagnostics is read from
+    disk only once. Attributes not defined here are passed through to the Dataset, so
+    the cache can be used wherever the calc functions expect the input Dataset.
+
+    With tiles set, the column diagnostics in TILED_DIAGNOSTICS are computed over
+    horizontal tiles in a pool of worker processes.
+
+    With a subset.Window, fields are read only over the window, thinned by its stride.
+    Diagnostics with horizontal stencils, and those destaggering thinned fields, are
+    computed at full resolution over the window and a halo, then cropped, so the results
+    equal those of the full grid at the kept points.
+
+    With a stations.StationIndex, fields on the mass grid are read as the station columns
+    gathered into its pseudo-grid, so column diagnostics are computed at the stations
+    only. Other diagnostics are computed over the window holding the stations and their
+    stencils, then gathered.
+    """
+    def __init__(self, dataset, max_bytes='1GB', tiles=None, workers=None, instrument=None,
+                 window=None, stations=None):
+        """
+        :param dataset: input netCDF4 Dataset
+        :param max_bytes: byte limit for cached arrays, integer or string such as '1GB'
+        :param tiles: optional number of tiles, or tuple of (south_north, west_east) tile
+            counts, for tiled column diagnostics
+        :param workers: number of worker processes for tiles. Default is the number of CPUs.
+        :param instrument: optional Instrument timing each disk read
+        :param window: optional subset.Window of the horizontal grid to read
+        :param stations: optional stations.StationIndex with the grids set, to compute
+            only the station columns
+        """
+        if tiles is not None and window is not None:
+            raise ValueError('Tiles cannot be used with a window')
+        if stations is not None and (tiles is not None or window is not None):
+            raise ValueError('Stations cannot be used with tiles or a window')
+        if tiles is not None:
+            # fail before the run rather than at the first tiled diagnostic
+            get_shared_memory()
+        self.dataset = dataset
+        self.max_bytes = parse_bytes(max_bytes)
+        self.tiles = tiles
+        self.workers = workers
+        self._executor = None
+        self.instrument = instrument
+        self.window = window
+        self.stations = stations
+        self._inner = None
+        if stations is not None:
+            halo = max(definition['halo'] for definition in get_intermediates().values())
+            self._inner = DiagnosticCache(dataset, max_bytes, instrument=instrument,
+                                          window=stations.get_window(halo))
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.reads = {}
+        self._items = OrderedDict()
+
+    def __getattr__(self, name):
+        return getattr(self.dataset, name)
+
+    def _get(self, key):
+        try:
+            value = self._items[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self._items.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def _put(self, key, value):
+        if key in self._items:
+            # a field read again replaces the cached one
+            self.nbytes -= self._items.pop(key).nbytes
+        size = value.nbytes
+        if size > self.max_bytes:
+            return
+        self._items[key] = value
+        self.nbytes += size
+        while self.nbytes > self.max_bytes:
+            _, old = self._items.popitem(last=False)
+            self.nbytes -= old.nbytes
+            self.evictions += 1
+
+    def read(self, name, tslice=None, halo=None):
+        """
+        Reads a raw WRF variable for all times or for a slab of times
+        :param name: WRF variable name
+        :param tslice: slice of time steps, sorted array of time steps, or None for all
+            times
+        :param halo: with a window, None to read thinned by its stride, or number of halo
+            points to read at full resolution, see subset.Window.index
+        :return: array of raw data, which must not be modified
+        """
+        key = ('raw', name, _slab_key(tslice), halo)
+        value = self._get(key)
+        if value is None:
+            with timed(self.instrument, 'read', name) as record:
+                var = self.dataset.variables[name]
+                if self.stations is not None and var.dimensions[-2:] == _MASS_DIMS:
+                    window = self._inner.window
+                    value = self.stations.gather(
+                        var[(_time_index(tslice),) + window.index(var.dimensions[1:])],
+                        tslice, window)
+                elif self.window is None:
+                    value = var[:] if tslice is None else var[tslice]
+                else:
+                    value = var[(_time_index(tslice),) +
+                                self.window.index(var.dimensions[1:], halo)]
+                record['nbytes'] = value.nbytes
+            value.flags.writeable = False
+            self.reads[name] = self.reads.get(name, 0) + 1
+            self._put(key, value)
+        return value
+
+    def add(self, name, tslice, values, halo=None):
+        """
+        Adds a raw WRF variable read ahead for a slab, as read would read it
+        :param name: WRF variable name
+        :param tslice: slice of time steps, or None for all times
+        :param values: array of raw data
+        :param halo: halo the values were read with, see read
+        """
+        if values.nbytes > self.max_bytes:
+            warnings.warn('Field '+name+' read ahead is larger than the cache, so it is '
+                          'read again')
+        values.flags.writeable = False
+        self.reads[name] = self.reads.get(name, 0) + 1
+        self._put(('raw', name, _slab_key(tslice), halo), values)
+
+    def get_reads(self, needs, fields=()):
+        """
+        Gets the reads of raw WRF variables that computing diagnostics makes, with the
+        keys read looks them up by, so they can be read ahead
+        :param needs: list of raw WRF field and wrf-python diagnostic names
+        :param fields: raw fields of needs read directly, rather than by the diagnostics
+        :return: list of (name, halo) tuples, see read
+        """
+        intermediates = get_intermediates()
+        reads = [(name, None) for name in fields]
+        for name in needs:
+            if name not in intermediates or name in _RAW_DIAGNOSTICS:
+                continue
+            if self.tiles is not None and name in TILED_DIAGNOSTICS:
+                # tiles read their fields in the worker processes
+                continue
+            if self.stations is not None and not self._is_columnar(name):
+                # computed over the window of the stations, which reads its own fields
+                continue
+            halo = self._halo(name) if self.window is not None else None
+            reads.extend((field, halo) for field in intermediates[name]['fields']
+                         if field in self.dataset.variables)
+        return list(dict.fromkeys(reads))
+
+    def _halo(self, name):
+        """
+        Gets the halo a diagnostic reads its fields with in a window
+        :param name: wrf-python variable name
+        :return: number of halo points to compute at full resolution, or None to compute
+            on fields thinned by the stride
+        """
+        definition = get_intermediates().get(name, {})
+        if definition.get('halo', 0) > 0:
+            return definition['halo']
+        if self.window.stride > 1:
+            # destaggering needs the neighbouring staggered points the stride skips
+            for field in definition.get('fields', ()):
+                if field in self.dataset.variables and is_staggered(
+                        self.dataset.variables[field].dimensions):
+                    return 0
+        return None
+
+    def _loader(self, name, tslice, timeidx, halo=None):
+        """Gets the raw field mapping handed to wrf-python for one diagnostic request"""
+        if name in _RAW_DIAGNOSTICS:
+            return None
+        loader = _FieldLoader(self, tslice, timeidx, halo)
+        # wrf-python copies the mapping into a plain dict when it adds metadata, so the
+        # fields a diagnostic reads are loaded up front to be in the copy
+        for field in get_intermediates().get(name, {}).get('fields', ()):
+            if field in self.dataset.variables:
+                loader[field]
+        return loader
+
+    def getvar(self, name, tslice=None, time_axis=0):
+        """
+        Gets a wrf-python diagnostic for all times or for a slab of times
+        :param name: wrf-python variable name
+        :param tslice: slice of time steps, or None for all times
+        :param time_axis: position of the time dimension in the wrf-python output
+        :return: wrf-python variable with data, units, and description
+        """
+        key = ('diag', name, _slab_key(tslice))
+        value = self._get(key)
+        if value is not None:
+            return value
+        ntimes = self.dataset.dimensions['Time'].size
+        if self.stations is not None:
+            value = self._getvar_stations(name, tslice, time_axis)
+        elif self.window is not None:
+            value = self._getvar_window(name, tslice, time_axis)
+        elif self.tiles is not None and name in TILED_DIAGNOSTICS:
+            if self._executor is None:
+                self._executor = get_tile_executor(self.workers)
+            value = getvar_tiled(self.dataset, name, self._executor, self.tiles, tslice,
+                                 time_axis)
+        elif tslice is None and ntimes > 1:
+            value = getvar(self.dataset, name, ALL_TIMES,
+                           cache=self._loader(name, None, ALL_TIMES))
+        else:
+            # wrf-python drops the time dimension of single time files, so they are
+            # assembled from single time steps like a slab
+            steps = range(*(tslice or slice(0, ntimes)).indices(ntimes))
+            first = getvar(self.dataset, name, steps[0],
+                           cache=self._loader(name, tslice, steps[0]))
+            values = [first.data]
+            for i in steps[1:]:
+                values.append(fill_masked(getvar(self.dataset, name, i, meta=False,
+                                                 cache=self._loader(name, tslice, i))))
+            value = xr.DataArray(np.stack(values, axis=time_axis), attrs=first.attrs)
+        self._put(key, value)
+        return value
+
+    def _getvar_window(self, name, tslice, time_axis):
+        """Gets a wrf-python diagnostic over the window, see getvar"""
+        if name in ('lat', 'lon'):
+            var = self.dataset.variables['XLAT' if name == 'lat' else 'XLONG']
+            return xr.DataArray(self.read(var.name, tslice),
+                                attrs={'units': var.units, 'description': var.description})
+        ntimes = self.dataset.dimensions['Time'].size
+        steps = range(*(tslice or slice(0, ntimes)).indices(ntimes))
+        halo = self._halo(name)
+        # metadata would describe the whole grid, so it comes from the intermediates
+        values = []
+        for i in steps:
+            value = fill_masked(getvar(self.dataset, name, i, meta=False,
+                                       cache=self._loader(name, tslice, i, halo)))
+            values.append(self.window.crop(value, halo))
+        definition = get_intermediates()[name]
+        return xr.DataArray(np.stack(values, axis=time_axis),
+                            attrs={'units': definition['units'],
+                                   'description': definition['description']})
+
+    def _is_columnar(self, name):
+        """Checks if a diagnostic is computed in each column of the mass grid alone"""
+        definition = get_intermediates().get(name)
+        return definition is not None and definition['halo'] == 0 and not any(
+            is_staggered(self.dataset.variables[field].dimensions)
+            for field in definition['fields'] if field in self.dataset.variables)
+
+    def _getvar_stations(self, name, tslice, time_axis):
+        """Gets a wrf-python diagnostic at the station columns, see getvar"""
+        if name in ('lat', 'lon'):
+            var = self.dataset.variables['XLAT' if name == 'lat' else 'XLONG']
+            return xr.DataArray(self.read(var.name, tslice),
+                                attrs={'units': var.units, 'description': var.description})
+        definition = get_intermediates().get(name)
+        if not self._is_columnar(name):
+            value = self._inner.getvar(name, tslice, time_axis)
+            return xr.DataArray(self.stations.gather(value.data, tslice, self._inner.window,
+                                                     time_axis), attrs=value.attrs)
+        ntimes = self.dataset.dimensions['Time'].size
+        steps = range(*(tslice or slice(0, ntimes)).indices(ntimes))
+        values = [fill_masked(getvar(self.dataset, name, i, meta=False,
+                                     cache=self._loader(name, tslice, i)))
+                  for i in steps]
+        return xr.DataArray(np.stack(values, axis=time_axis),
+                            attrs={'units': definition['units'],
+                                   'description': definition['description']})
+
+    def release(self, names, tslice=None):
+        """
+        Drops the cached raw fields and diagnostics of the given names for a slab
+        :param names: list of raw WRF field and wrf-python variable names
+        :param tslice: slice of time steps, or None for all times
+        """
+        slab = _slab_key(tslice)
+        names = set(names)
+        for key in list(self._items):
+            if key[1] in names and key[2] == slab:
+                self.nbytes -= self._items.pop(key).nbytes
+        if self._inner is not None:
+            self._inner.release(names, tslice)
+
+    def clear(self):
+        """Drops all cached arrays, keeping the statistics"""
+        self._items.clear()
+        self.nbytes = 0
+        if self._inner is not None:
+            self._inner.clear()
+
+    def close(self):
+        """Stops the tile worker processes and closes the input Dataset"""
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        self.dataset.close()
+
+    def stats(self):
+        """
+        Gets the cache statistics
+        :return: dictionary of hits, misses, evictions, cached bytes, and the number of
+            disk reads of each raw variable
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'nbytes': self.nbytes, 'reads': dict(self.reads)}
+
+
+class _FieldLoader(dict):
+    """Mapping of raw field name to array that reads through the cache on first lookup"""
+    def __init__(self, cache, tslice, timeidx, halo=None):
+        super(_FieldLoader, self).__init__()
+        self.cache = cache
+        self.tslice = tslice
+        self.timeidx = timeidx
+        self.halo = halo
+
+    def __missing__(self, name):
+        # let wrf-python handle fields that are not in the file
+        if name not in self.cache.dataset.variables:
+            raise KeyError(name)
+        var = self.cache.dataset.variables[name]
+        values = xr.DataArray(self.cache.read(name, self.tslice, self.halo),
+                              dims=var.dimensions, attrs=var.__dict__, name=name)
+        if self.timeidx is not ALL_TIMES:
+            start = 0 if self.tslice is None else self.tslice.start
+            values = values[self.timeidx - start]
+        # match the squeezed shape wrf-python extracts itself
+        values = values.squeeze()
+        self[name] = values
+        return values
+
+
+def _slab_key(tslice):
+    """Hashable key for a slab of times or an array of time steps"""
+    if tslice is None:
+        return None
+    if not isinstance(tslice, slice):
+        return ('steps',) + tuple(int(step) for step in tslice)
+    return tslice.start, tslice.stop
+
+
+def _time_index(tslice):
+    """Index of the time axis of a slab of times, an array of time steps, or all times"""
+    return slice(None) if tslice is None else tslice
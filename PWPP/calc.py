@@ -1,223 +1,301 @@
 # Calculations for output variables
 
 import numpy as np
+import xarray as xr
 from wrf import getvar, ALL_TIMES
-from metpy.interpolate import log_interpolate_1d
 from metpy.units import units
-from .variable_def import get_variables
-
-
-def get_isobaric_variables(data, var_list, plevs, outfile, dtype, compression, complevel):
+from .variable_def import get_variable, get_vertical_coordinates
+from .cache import DiagnosticCache
+from .output import OutputFile, OutputRecorder
+from .interp import get_interp_weights, interp_with_weights
+from .tiling import fill_masked
+from .precip import get_bucket, get_valid_seconds, get_window_starts, accumulate
+
+
+def get_wrf_var(data, name, tslice=None, time_axis=0):
+    """
+    Gets a wrf-python diagnostic for all times or for a slab of times
+    :param data: input netCDF4 Dataset
+    :param name: wrf-python variable name
+    :param tslice: slice of time steps, or None for all times
+    :param time_axis: position of the time dimension in the wrf-python output
+    :return: wrf-python variable with data, units, and description
+    """
+    if isinstance(data, DiagnosticCache):
+        return data.getvar(name, tslice, time_axis)
+    ntimes = data.dimensions['Time'].size
+    if tslice is None:
+        if ntimes > 1:
+            return getvar(data, name, ALL_TIMES)
+        # wrf-python drops the time dimension of single time files
+        tslice = slice(0, ntimes)
+    steps = range(*tslice.indices(ntimes))
+    first = getvar(data, name, steps[0])
+    values = [first.data]
+    for i in steps[1:]:
+        values.append(fill_masked(getvar(data, name, i, meta=False)))
+    return xr.DataArray(np.stack(values, axis=time_axis), attrs=first.attrs)
+
+
+def read_var(data, name, tslice=None):
+    """
+    Reads a raw WRF variable for all times, for a slab of times, or for a sorted array of
+    time steps
+    """
+    if isinstance(data, DiagnosticCache):
+        return data.read(name, tslice)
+    if tslice is None:
+        return data.variables[name][:]
+    return data.variables[name][tslice]
+
+
+def write_var(outfile, name, values, dtype, dims, units, description,
+              compression, complevel, tslice=None):
+    """
+    Writes a variable to the output file, creating it on the first slab
+    :param outfile: output netCDF4 Dataset
+    :param name: output variable name
+    :param values: array of data to write
+    :param dtype: output data type
+    :param dims: tuple of output dimension names
+    :param units: units attribute string
+    :param description: description attribute string
+    :param compression: True or False : netCDF variable level compression
+    :param complevel: level of variable compression
+    :param tslice: slice of time steps to write, or None for all times
+    """
+    if isinstance(outfile, (OutputFile, OutputRecorder)):
+        # compression comes from the storage settings of the output file
+        outfile.write(name, values, dtype, dims, units, description, tslice)
+        return
+    if name in outfile.variables:
+        out_data = outfile.variables[name]
+    else:
+        out_data = outfile.createVariable(name, dtype, dims,
+                                          zlib=compression, complevel=complevel)
+        out_data.units = units
+        out_data.description = description
+    if tslice is None:
+        out_data[:] = values
+    else:
+        out_data[tslice] = values
+
+
+def get_isobaric_variables(data, var_list, plevs, outfile, dtype, compression, complevel,
+                           tslice=None):
     """Gets isobaric variables from a list"""
-    # use wrf-python to get data for each of the variables
-    var_def = get_variables()
-    # get pressure array and attach units
-    p = getvar(data, 'p', ALL_TIMES)
-    p_np = np.array(p.data) * units(p.units)
-
-    for i in range(len(var_list)):
-        name = var_list[i]
-        var_data = getvar(data, var_def[name][2], ALL_TIMES)
-        iso_data = log_interpolate_1d(plevs, p_np, var_data.data, axis=1)
-
-        # write each of the variables to the output file
-
-        pres_data = outfile.createVariable(
-                    var_list[i],
-                    dtype,
-                    ('time', 'pressure_levels', 'lat', 'lon'),
-                    zlib=compression, complevel=complevel)
-        pres_data.units = var_data.units
-        if var_list[i] == 'height':
-            pres_data.decription = 'height [MSL] of isobaric surfaces'
-        elif var_list[i] == 'uwnd':
-            pres_data.description = 'u-wind component on isobaric surfaces'
-        elif var_list[i] == 'vwnd':
-            pres_data.description = 'v-wind component on isobaric surfaces'
-        elif var_list[i] == 'wwnd':
-            pres_data.description = 'w-wind component on isobaric surfaces'
-        elif var_list[i] == 'temp':
-            pres_data.description = 'temperature on isobaric surfaces'
-        elif var_list[i] == 'dewpt':
-            pres_data.description = 'dewpoint temperature on isobaric surfaces'
-        elif var_list[i] == 'avor':
-            pres_data.description = 'absolute vorticity on isobaric surfaces'
-        else:
-            pres_data.description = var_data.description
-        pres_data[:] = iso_data
-
-
-def get_precip(data, outfile, dtype, compression, complevel,
-               RAINNC_out=False, RAINSH_out=False, timestep=False, total=True):
-    """Gets the total precipitation from grid-scale and convective"""
-    # Get grid-scale and convective precip, add for total precip
-    grid_pcp = data.variables['RAINNC'][:].data * units(data.variables['RAINNC'].units)
-    conv_pcp = data.variables['RAINSH'][:].data * units(data.variables['RAINSH'].units)
+    get_vertical_variables(data, var_list, {'pressure': plevs}, outfile, dtype, compression,
+                           complevel, tslice)
+
+
+def get_vertical_coordinate(data, name, tslice=None):
+    """
+    Gets a vertical coordinate on model levels
+    :param data: input netCDF4 Dataset
+    :param name: vertical coordinate name, see get_vertical_coordinates
+    :param tslice: slice of time steps, or None for all times
+    :return: tuple of array of the coordinate and its units string
+    """
+    coordinate = get_vertical_coordinates()[name]
+    values = get_wrf_var(data, coordinate['intermediate'], tslice)
+    units = values.units
+    values = np.array(values.data)
+    if coordinate['above_ground']:
+        values = values - np.asarray(read_var(data, 'HGT', tslice))[:, np.newaxis]
+    return values, units
+
+
+def get_vertical_variables(data, var_list, levels, outfile, dtype, compression, complevel,
+                           tslice=None):
+    """
+    Gets variables on the levels of one or more vertical coordinates. Each coordinate and
+    its interpolation weights are computed once, and each variable is computed once and
+    interpolated to the levels of every coordinate.
+    :param levels: dictionary of vertical coordinate name to levels, see
+        get_vertical_coordinates. Variables on a coordinate are named with its suffix.
+    """
+    coordinates = get_vertical_coordinates()
+    weights = {}
+    for name in levels:
+        if coordinates[name]['intermediate'] is None:
+            # variables on model levels are written as computed
+            continue
+        values, coord_units = get_vertical_coordinate(data, name, tslice)
+        weights[name] = get_interp_weights(levels[name].to(coord_units).m, values, axis=1,
+                                           log=coordinates[name]['log'])
+        del values
+    descriptions = {
+        'height': 'height [MSL] of {}',
+        'uwnd': 'u-wind component on {}',
+        'vwnd': 'v-wind component on {}',
+        'wwnd': 'w-wind component on {}',
+        'temp': 'temperature on {}',
+        'dewpt': 'dewpoint temperature on {}',
+        'avor': 'absolute vorticity on {}',
+        'theta': 'potential temperature on {}',
+        'pres': 'pressure on {}',
+    }
+
+    for name in var_list:
+        var_data = get_wrf_var(data, get_variable(name)['wrf_name'], tslice)
+        for coord_name in levels:
+            coordinate = coordinates[coord_name]
+            if coord_name in weights:
+                level_data = interp_with_weights(var_data.data, weights[coord_name], axis=1)
+            else:
+                level_data = var_data.data
+            description = descriptions.get(name, var_data.description + ' on {}').format(
+                coordinate['surfaces'])
+
+            # write each of the variables to the output file
+            write_var(outfile, name + coordinate['suffix'], level_data, dtype,
+                      ('time', coordinate['dim'], 'lat', 'lon'), var_data.units,
+                      description, compression, complevel, tslice)
+
+
+def read_precip(data, name, tslice=None):
+    """Reads a cumulative precipitation field, adding back the buckets it has emptied"""
+    values = read_var(data, name, tslice)
+    bucket, counter = get_bucket(data, name)
+    if counter is not None:
+        values = values + read_var(data, counter, tslice) * values.dtype.type(bucket)
+    return values
+
+
+def read_precip_rows(data, name, tslice, earlier):
+    """
+    Reads a cumulative precipitation field for a slab and for earlier time steps
+    :param data: input netCDF4 Dataset
+    :param name: WRF variable name
+    :param tslice: slice of time steps, or None for all times
+    :param earlier: sorted array of time steps before the slab
+    :return: array of the earlier time steps, then those of the slab
+    """
+    values = read_precip(data, name, tslice)
+    if earlier.size == 0:
+        return values
+    return np.ma.concatenate((read_precip(data, name, earlier), values))
+
+
+def get_precip(data, outfile, dtype, compression, complevel, RAINNC_out=False,
+               RAINSH_out=False, timestep=False, total=True, windows=(), tslice=None):
+    """
+    Gets the total precipitation from grid-scale and convective, and its accumulation over
+    each time step and over windows of hours, in one pass over the cumulative fields.
+    Fields emptied into buckets of BUCKET_MM are restored from their bucket counters.
+    :param windows: list of accumulation windows in hours, written as pcp_<hours>h. Windows
+        starting before the first input time are missing.
+    """
+    ntimes = data.dimensions['Time'].size
+    steps = np.arange(ntimes)[tslice or slice(None)]
+    seconds = get_valid_seconds(data)
+    pcp_units = str(units(data.variables['RAINNC'].units).units)
+    dims = ('time', 'lat', 'lon')
+
+    # only the earlier time steps accumulations start from are read besides the slab, so
+    # the steps between them are never held
+    prev = np.maximum(steps - 1, 0)
+    starts = [get_window_starts(seconds, steps, hours * 3600) for hours in windows]
+    earlier = np.setdiff1d(np.concatenate([prev] + [start[start >= 0] for start in starts]),
+                           steps)
+    rows = np.concatenate((earlier, steps))
+    grid_pcp = read_precip_rows(data, 'RAINNC', tslice, earlier)
+    conv_pcp = read_precip_rows(data, 'RAINSH', tslice, earlier)
     tot_pcp = grid_pcp + conv_pcp
+    current = np.searchsorted(rows, steps)
 
     if total:
-        pcp_data = outfile.createVariable(
-                    'tot_pcp',
-                    dtype,
-                    ('time', 'lat', 'lon'),
-                    zlib=compression, complevel=complevel)
-        pcp_data.units = str(tot_pcp.units)
-        pcp_data.description = 'Total Accumulated Precpitation'
-        pcp_data[:] = tot_pcp.m
+        write_var(outfile, 'tot_pcp', tot_pcp[current], dtype, dims, pcp_units,
+                  'Total Accumulated Precpitation', compression, complevel, tslice)
 
     if RAINNC_out:
-        grid_pcp_data = outfile.createVariable(
-                    'grid_pcp',
-                    dtype,
-                    ('time', 'lat', 'lon'),
-                    zlib=compression, complevel=complevel)
-        grid_pcp_data.units = str(grid_pcp.units)
-        grid_pcp_data.description = data.variables['RAINNC'].description
-        grid_pcp_data[:] = grid_pcp.m
+        write_var(outfile, 'grid_pcp', grid_pcp[current], dtype, dims, pcp_units,
+                  data.variables['RAINNC'].description, compression, complevel, tslice)
 
     if RAINSH_out:
-        conv_pcp_data = outfile.createVariable(
-                    'conv_pcp',
-                    dtype,
-                    ('time', 'lat', 'lon'),
-                    zlib=compression, complevel=complevel)
-        conv_pcp_data.units = str(conv_pcp.units)
-        conv_pcp_data.description = data.variables['RAINSH'].description
-        conv_pcp_data[:] = conv_pcp.m
-
-    # Calculate precip accumulation at each timestep
+        write_var(outfile, 'conv_pcp', conv_pcp[current], dtype, dims, pcp_units,
+                  data.variables['RAINSH'].description, compression, complevel, tslice)
+
+    # accumulation since the previous step, zero at the first step of the run
     if timestep:
-        ts_pcp = np.zeros(tot_pcp.shape)
-        for i in range(tot_pcp.shape[0] - 1):
-            ts_pcp[i + 1, ] = tot_pcp[i + 1, ] - tot_pcp[i, ]
-
-        # Save to file
-        pcp_data = outfile.createVariable(
-                    'timestep_pcp',
-                    dtype,
-                    ('time', 'lat', 'lon'),
-                    zlib=compression, complevel=complevel)
-        pcp_data.units = str(tot_pcp.units)
-        pcp_data.description = 'Total Timestep Accumulated Precpitation'
-        pcp_data[:] = ts_pcp.data
-
-
-def get_temp_2m(data, outfile, dtype, compression, complevel):
+        write_var(outfile, 'timestep_pcp', accumulate(tot_pcp, rows, steps, prev), dtype,
+                  dims, pcp_units, 'Total Timestep Accumulated Precpitation', compression,
+                  complevel, tslice)
+
+    for hours, start in zip(windows, starts):
+        write_var(outfile, 'pcp_'+str(hours)+'h', accumulate(tot_pcp, rows, steps, start),
+                  dtype, dims, pcp_units, str(hours)+' Hour Accumulated Precipitation',
+                  compression, complevel, tslice)
+
+
+def get_temp_2m(data, outfile, dtype, compression, complevel, tslice=None):
     """Gets the 2m temperature data"""
-    temp_2m = data.variables['T2'][:]
-    temp_data = outfile.createVariable(
-                'temp_2m',
-                dtype,
-                ('time', 'lat', 'lon'),
-                zlib=compression, complevel=complevel)
-    temp_data.units = data.variables['T2'].units
-    temp_data.description = data.variables['T2'].description
-    temp_data[:] = temp_2m.data
-
-
-def get_q_2m(data, outfile, dtype, compression, complevel):
-    q_2m = data.variables['Q2'][:]
-    q_data = outfile.createVariable(
-                'q_2m',
-                dtype,
-                ('time', 'lat', 'lon'),
-                zlib=compression, complevel=complevel)
-    q_data.units = data.variables['Q2'].units
-    q_data.description = data.variables['Q2'].description
-    q_data[:] = q_2m
-
-
-def get_v_10m(data, outfile, dtype, compression, complevel):
-    v_10m = data.variables['V10'][:]
-    v_data = outfile.createVariable(
-                'v_10m',
-                dtype,
-                ('time', 'lat', 'lon'),
-                zlib=compression, complevel=complevel)
-    v_data.units = data.variables['V10'].units
-    v_data.description = data.variables['V10'].description
-    v_data[:] = v_10m
-
-
-def get_u_10m(data, outfile, dtype, compression, complevel):
-    u_10m = data.variables['U10'][:]
-    u_data = outfile.createVariable(
-                'u_10m',
-                dtype,
-                ('time', 'lat', 'lon'),
-                zlib=compression, complevel=complevel)
-    u_data.units = data.variables['U10'].units
-    u_data.description = data.variables['U10'].description
-    u_data[:] = u_10m
-
-
-def get_mslp(data, outfile, dtype, compression, complevel):
-    slp = getvar(data, 'slp', ALL_TIMES)
-    slp_data = outfile.createVariable(
-                'mslp',
-                dtype,
-                ('time', 'lat', 'lon'),
-                zlib=compression, complevel=complevel)
-    slp_data.units = slp.units
-    slp_data.description = slp.description
-    slp_data[:] = slp.data
-
-
-def get_uh(data, outfile, dtype, compression, complevel):
-    uh = getvar(data, 'updraft_helicity', ALL_TIMES)
-    uh_data = outfile.createVariable(
-                'UH',
-                dtype,
-                ('time', 'lat', 'lon'),
-                zlib=compression, complevel=complevel)
-    uh_data.units = uh.units
-    uh_data.description = uh.description
-    uh_data[:] = uh.data
-
-
-def get_cape(data, outfile, dtype, compression, complevel):
-    capecin = getvar(data, 'cape_2d', ALL_TIMES)
+    temp_2m = read_var(data, 'T2', tslice)
+    write_var(outfile, 'temp_2m', temp_2m.data, dtype, ('time', 'lat', 'lon'),
+              data.variables['T2'].units, data.variables['T2'].description,
+              compression, complevel, tslice)
+
+
+def get_q_2m(data, outfile, dtype, compression, complevel, tslice=None):
+    q_2m = read_var(data, 'Q2', tslice)
+    write_var(outfile, 'q_2m', q_2m, dtype, ('time', 'lat', 'lon'),
+              data.variables['Q2'].units, data.variables['Q2'].description,
+              compression, complevel, tslice)
+
+
+def get_v_10m(data, outfile, dtype, compression, complevel, tslice=None):
+    v_10m = read_var(data, 'V10', tslice)
+    write_var(outfile, 'v_10m', v_10m, dtype, ('time', 'lat', 'lon'),
+              data.variables['V10'].units, data.variables['V10'].description,
+              compression, complevel, tslice)
+
+
+def get_u_10m(data, outfile, dtype, compression, complevel, tslice=None):
+    u_10m = read_var(data, 'U10', tslice)
+    write_var(outfile, 'u_10m', u_10m, dtype, ('time', 'lat', 'lon'),
+              data.variables['U10'].units, data.variables['U10'].description,
+              compression, complevel, tslice)
+
+
+def get_wspd_10m(data, outfile, dtype, compression, complevel, tslice=None):
+    """Gets the 10m wind speed"""
+    u_10m = read_var(data, 'U10', tslice)
+    v_10m = read_var(data, 'V10', tslice)
+    write_var(outfile, 'wspd_10m', np.ma.sqrt(u_10m ** 2 + v_10m ** 2), dtype,
+              ('time', 'lat', 'lon'), data.variables['U10'].units, 'wind speed at 10 M',
+              compression, complevel, tslice)
+
+
+def get_mslp(data, outfile, dtype, compression, complevel, tslice=None):
+    slp = get_wrf_var(data, 'slp', tslice)
+    write_var(outfile, 'mslp', slp.data, dtype, ('time', 'lat', 'lon'),
+              slp.units, slp.description, compression, complevel, tslice)
+
+
+def get_uh(data, outfile, dtype, compression, complevel, tslice=None):
+    uh = get_wrf_var(data, 'updraft_helicity', tslice)
+    write_var(outfile, 'UH', uh.data, dtype, ('time', 'lat', 'lon'),
+              uh.units, uh.description, compression, complevel, tslice)
+
+
+def get_cape(data, outfile, dtype, compression, complevel, tslice=None):
+    capecin = get_wrf_var(data, 'cape_2d', tslice, time_axis=1)
     cape = np.array(capecin[0, ]) * units('J/kg')
     cin = np.array(capecin[1, ]) * units('J/kg')
-    cape_data = outfile.createVariable(
-                'cape',
-                dtype,
-                ('time', 'lat', 'lon'),
-                zlib=compression, complevel=complevel)
-    cape_data.units = str(cape.units)
-    cape_data.description = '2D Convective Available Potential Energy'
-    cape_data[:] = cape.m
-
-    cin_data = outfile.createVariable(
-                'cin',
-                dtype,
-                ('time', 'lat', 'lon'),
-                zlib=compression, complevel=complevel)
-    cin_data.units = str(cin.units)
-    cin_data.description = '2D Convective Inhibition'
-    cin_data[:] = cin.m
-
-
-def get_dbz(data, outfile, dtype, compression, complevel):
-    dbz = getvar(data, 'mdbz', ALL_TIMES)
-    dbz_data = outfile.createVariable(
-                'DBZ',
-                dtype,
-                ('time', 'lat', 'lon'),
-                zlib=compression, complevel=complevel)
-    dbz_data.units = dbz.units
-    dbz_data.description = dbz.description
-    dbz_data[:] = dbz.data
-
-
-def get_dewpt_2m(data, outfile, dtype, compression, complevel):
+    write_var(outfile, 'cape', cape.m, dtype, ('time', 'lat', 'lon'), str(cape.units),
+              '2D Convective Available Potential Energy', compression, complevel, tslice)
+    write_var(outfile, 'cin', cin.m, dtype, ('time', 'lat', 'lon'), str(cin.units),
+              '2D Convective Inhibition', compression, complevel, tslice)
+
+
+def get_dbz(data, outfile, dtype, compression, complevel, tslice=None):
+    dbz = get_wrf_var(data, 'mdbz', tslice)
+    write_var(outfile, 'DBZ', dbz.data, dtype, ('time', 'lat', 'lon'),
+              dbz.units, dbz.description, compression, complevel, tslice)
+
+
+def get_dewpt_2m(data, outfile, dtype, compression, complevel, tslice=None):
     """Gets the 2m dewpoint data"""
-    dewpt_2m = getvar(data, 'td2', ALL_TIMES)
-    dewpt_data = outfile.createVariable(
-                'dewpt_2m',
-                dtype,
-                ('time', 'lat', 'lon'),
-                zlib=compression, complevel=complevel)
-    dewpt_data.units = dewpt_2m.units
-    dewpt_data.description = dewpt_2m.description
-    dewpt_data[:] = dewpt_2m.data
+    dewpt_2m = get_wrf_var(data, 'td2', tslice)
+    write_var(outfile, 'dewpt_2m', dewpt_2m.data, dtype, ('time', 'lat', 'lon'),
+              dewpt_2m.units, dewpt_2m.description, compression, complevel, tslice)
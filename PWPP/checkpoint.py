@@ -0,0 +1,118 @@
+# Completion markers of the groups and slabs of a run, for resuming interrupted runs
+
+import hashlib
+import json
+import os
+import numpy as np
+
+
+def get_signature(inname, **options):
+    """
+    Gets a key identifying a run, so markers are only used to resume the same run
+    :param inname: input file path
+    :param options: run options that change the output, such as variables and levels
+    :return: string key
+    """
+    info = os.stat(inname)
+    options = dict(options, inname=os.path.abspath(inname), size=info.st_size,
+                   mtime=info.st_mtime_ns)
+    return hashlib.sha1(json.dumps(options, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _slab_key(tslice):
+    """Gets the marker key of a slab"""
+    return 'all' if tslice is None else str(tslice.start)+':'+str(tslice.stop)
+
+
+class Checkpoint(object):
+    """
+    Completion markers of a run, kept in a sidecar file next to the output. After each
+    group of variables is written for a slab, the output is synced to disk and the group
+    is marked done with the output variables it wrote. A resumed run of the same input
+    and options skips the marked groups whose variables are in the output. The running
+    state of reductions is saved with the markers. The sidecar files are removed when the
+    run completes.
+    """
+    def __init__(self, outname, signature):
+        """
+        :param outname: output file path
+        :param signature: key of the run, see get_signature
+        """
+        self.path = outname + '.progress.json'
+        self.state_path = outname + '.progress.npz'
+        self.signature = signature
+        self.completed = {}
+
+    def load(self):
+        """
+        Loads the markers of an interrupted run
+        :return: True if markers of the same run were found
+        """
+        try:
+            with open(self.path) as f:
+                progress = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if progress.get('signature') != self.signature:
+            return False
+        self.completed = progress['completed']
+        return True
+
+    def validate(self, dataset):
+        """
+        Drops the markers of groups whose variables are missing from the output or do not
+        reach the end of their slab
+        :param dataset: output netCDF4 Dataset
+        """
+        for key, groups in self.completed.items():
+            stop = None if key == 'all' else int(key.split(':')[1])
+            for label in list(groups):
+                for name in groups[label]:
+                    var = dataset.variables.get(name)
+                    if var is None:
+                        missing = True
+                    elif stop is None or 'time' not in var.dimensions:
+                        missing = False
+                    else:
+                        missing = var.shape[var.dimensions.index('time')] < stop
+                    if missing:
+                        del groups[label]
+                        break
+
+    def is_done(self, tslice, label):
+        """Checks if a group is marked done for a slab"""
+        return label in self.completed.get(_slab_key(tslice), {})
+
+    def mark(self, outfile, tslice, label, names, state=None):
+        """
+        Syncs the output to disk and marks a group done for a slab
+        :param outfile: output Dataset
+        :param tslice: slice of time steps, or None for all times
+        :param label: name of the group
+        :param names: list of output variables the group wrote
+        :param state: optional dictionary of arrays of the reduction state to save
+        """
+        outfile.sync()
+        if state is not None:
+            tmp = self.state_path[:-len('.npz')] + '.' + str(os.getpid()) + '.npz'
+            np.savez(tmp, **state)
+            os.replace(tmp, self.state_path)
+        self.completed.setdefault(_slab_key(tslice), {})[label] = sorted(names)
+        # write then rename, so an interruption never leaves a partial file
+        tmp = self.path + '.' + str(os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump({'signature': self.signature, 'completed': self.completed}, f)
+        os.replace(tmp, self.path)
+
+    def load_state(self):
+        """Loads the saved reduction state, or None if there is none"""
+        if not os.path.exists(self.state_path):
+            return None
+        with np.load(self.state_path) as state:
+            return {key: state[key] for key in state.files}
+
+    def remove(self):
+        """Removes the sidecar files of a completed run"""
+        for path in (self.path, self.state_path):
+            if os.path.exists(path):
+                os.remove(path)
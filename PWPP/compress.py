@@ -0,0 +1,255 @@
+# Parallel compression of output chunks, written directly into the HDF5 output file
+
+import itertools
+import zlib
+from multiprocessing import Pool
+import numpy as np
+from netCDF4 import Dataset, default_fillvals
+
+# chunks waiting to be compressed per worker process, bounding the memory in flight
+_QUEUE_PER_WORKER = 4
+
+
+def shuffle_bytes(data, itemsize):
+    """
+    Applies the HDF5 shuffle filter, putting the bytes of each significance together
+    :param data: bytes of the elements of a chunk
+    :param itemsize: bytes of each element
+    :return: shuffled bytes
+    """
+    return np.frombuffer(data, dtype='u1').reshape(-1, itemsize).T.tobytes()
+
+
+def unshuffle_bytes(data, itemsize):
+    """
+    Reverts the HDF5 shuffle filter
+    :param data: shuffled bytes of the elements of a chunk
+    :param itemsize: bytes of each element
+    :return: bytes of the elements in order
+    """
+    return np.frombuffer(data, dtype='u1').reshape(itemsize, -1).T.tobytes()
+
+
+def compress_chunk(data, itemsize, shuffle, complevel):
+    """
+    Compresses a chunk with the filters of the netCDF4 zlib and shuffle settings
+    :param data: bytes of the elements of a full chunk
+    :param itemsize: bytes of each element
+    :param shuffle: True to apply the shuffle filter before deflating
+    :param complevel: deflate level
+    :return: compressed bytes
+    """
+    if shuffle and itemsize > 1:
+        data = shuffle_bytes(data, itemsize)
+    return zlib.compress(data, complevel)
+
+
+def decompress_chunk(data, itemsize, shuffle):
+    """
+    Decompresses a chunk compressed with compress_chunk
+    :param data: compressed bytes
+    :param itemsize: bytes of each element
+    :param shuffle: True if the shuffle filter was applied
+    :return: bytes of the elements of the chunk
+    """
+    data = zlib.decompress(data)
+    if shuffle and itemsize > 1:
+        data = unshuffle_bytes(data, itemsize)
+    return data
+
+
+def is_compressible(var):
+    """
+    Checks if the chunks of an output variable can be compressed outside the library
+    :param var: netCDF4 Variable
+    :return: True for chunked, deflated variables without quantization, packing, or
+        checksums, whose values are stored as given
+    """
+    filters = var.filters() or {}
+    return (filters.get('zlib', False) and not filters.get('fletcher32', False) and
+            not any(filters.get(name, False) for name in ('szip', 'zstd', 'bzip2',
+                                                          'blosc')) and
+            var.chunking() != 'contiguous' and var.dtype.kind in 'fiu' and
+            'least_significant_digit' not in var.ncattrs() and
+            'scale_factor' not in var.ncattrs())
+
+
+class ChunkCompressor(object):
+    """
+    Compresses the chunks of output variables in a pool of worker processes, in place of
+    the serial filter pipeline of the netCDF4 library. The variables are created by the
+    library with their zlib and shuffle filters, so the output is a standard netCDF4 file,
+    but their values are split into chunks as they are written and each chunk is deflated
+    by a worker once all of its values are known. The compressed chunks are written into the
+    HDF5 datasets of the variables as they are after each slab, and the chunks not
+    completed by then when the output is closed.
+
+    The pool is started when the compressor is created, so it should be created before
+    the output file is opened, keeping the workers from inheriting its handle.
+    """
+    def __init__(self, workers):
+        """
+        :param workers: number of worker processes
+        """
+        self.workers = max(int(workers), 1)
+        self._pool = Pool(self.workers)
+        self._vars = {}
+        self._pending = []
+        # output file opened again after the last chunks were written
+        self._dataset = None
+
+    def __contains__(self, name):
+        return name in self._vars
+
+    def add(self, var, shape):
+        """
+        Compresses the chunks of a variable from now on
+        :param var: netCDF4 Variable created with its filters and chunk sizes
+        :param shape: final shape of the variable, with the number of times of the run
+            along time
+        """
+        filters = var.filters()
+        fill = getattr(var, '_FillValue', default_fillvals.get(var.dtype.str[1:], 0))
+        self._vars[var.name] = {
+            'name': var.name, 'dtype': var.dtype, 'chunks': tuple(var.chunking()),
+            'shape': tuple(shape), 'shuffle': filters['shuffle'],
+            'complevel': filters['complevel'], 'fill': fill, 'extent': [0] * len(shape),
+            'buffers': {}, 'results': {}, 'stored': set()}
+
+    def write(self, name, index, values):
+        """
+        Stores values of a variable in its chunks, compressing the chunks completed
+        :param name: output variable name
+        :param index: slice or tuple of slices of the values in the variable, or None for
+            all of it
+        :param values: array of values
+        """
+        state = self._vars[name]
+        values = np.ma.filled(np.ma.asarray(values), state['fill']).astype(state['dtype'])
+        if index is None:
+            index = ()
+        elif not isinstance(index, tuple):
+            index = (index,)
+        index = index + (slice(None),) * (len(state['shape']) - len(index))
+        starts = [0 if item.start is None else item.start for item in index]
+        values = np.broadcast_to(values, [
+            stop - start for start, stop in zip(starts, (
+                item.stop if item.stop is not None else shape
+                for item, shape in zip(index, state['shape'])))])
+        stops = [start + size for start, size in zip(starts, values.shape)]
+        state['extent'] = [max(extent, stop) for extent, stop in zip(state['extent'], stops)]
+        ranges = [range(start // chunk, (stop - 1) // chunk + 1)
+                  for start, stop, chunk in zip(starts, stops, state['chunks'])]
+        for key in itertools.product(*ranges):
+            origin = [i * chunk for i, chunk in zip(key, state['chunks'])]
+            source = tuple(slice(max(start, o) - start, min(stop, o + chunk) - start)
+                           for start, stop, o, chunk in zip(starts, stops, origin,
+                                                            state['chunks']))
+            target = tuple(slice(max(start, o) - o, min(stop, o + chunk) - o)
+                           for start, stop, o, chunk in zip(starts, stops, origin,
+                                                            state['chunks']))
+            covered = all(item.start == 0 and item.stop >= min(chunk, size - o)
+                          for item, chunk, size, o in zip(target, state['chunks'],
+                                                          state['shape'], origin))
+            buffer, missing = self._get_buffer(state, key, origin, covered)
+            buffer[target] = values[source]
+            missing[target] = False
+            if not missing.any():
+                del state['buffers'][key]
+                self._submit(state, key, buffer)
+
+    def _get_buffer(self, state, key, origin, covered):
+        """Gets the values of a chunk being filled, and which of them are not written yet"""
+        if key in state['buffers']:
+            return state['buffers'][key]
+        if covered:
+            # the chunk is written over whole, so the values compressed before are dropped
+            state['results'].pop(key, None)
+        buffer = np.full(state['chunks'], state['fill'], dtype=state['dtype'])
+        # values past the end of the variable only pad the chunk
+        missing = np.zeros(state['chunks'], dtype=bool)
+        missing[tuple(slice(0, max(size - o, 0)) for size, o in
+                      zip(state['shape'], origin))] = True
+        if key in state['results']:
+            # a chunk written again keeps the values compressed before
+            data = decompress_chunk(state['results'].pop(key).get(),
+                                    state['dtype'].itemsize, state['shuffle'])
+            buffer = np.frombuffer(data, dtype=state['dtype']).reshape(state['chunks'])
+            buffer = buffer.copy()
+            missing[:] = False
+        elif key in state['stored']:
+            # a chunk written again keeps the values stored in the file before
+            region = tuple(slice(o, min(o + chunk, size)) for o, chunk, size in
+                           zip(origin, state['chunks'], state['shape']))
+            values = self._dataset.variables[state['name']][region]
+            target = tuple(slice(0, item.stop - item.start) for item in region)
+            buffer[target] = np.ma.filled(values, state['fill'])
+            missing[:] = False
+        state['buffers'][key] = (buffer, missing)
+        return buffer, missing
+
+    def _submit(self, state, key, buffer):
+        """Queues a chunk for compression, waiting if too many are in flight"""
+        pending = [result for result in self._pending if not result.ready()]
+        if len(pending) >= self.workers * _QUEUE_PER_WORKER:
+            pending.pop(0).wait()
+        result = self._pool.apply_async(compress_chunk, (
+            buffer.tobytes(), state['dtype'].itemsize, state['shuffle'], state['complevel']))
+        state['results'][key] = result
+        self._pending = pending + [result]
+
+    def write_completed(self, dataset):
+        """
+        Writes the chunks compressed so far into the output file, so they are not held
+        until it is closed. The file is closed for the write and opened again.
+        :param dataset: output netCDF4 Dataset
+        :return: output netCDF4 Dataset opened again, or dataset if no chunks were written
+        """
+        if not any(state['results'] for state in self._vars.values()):
+            return dataset
+        outname = dataset.filepath()
+        dataset.close()
+        self._write(outname)
+        self._dataset = Dataset(outname, 'a')
+        return self._dataset
+
+    def flush(self, outname):
+        """
+        Writes the compressed chunks into the closed output file and stops the pool.
+        Chunks only partly written are compressed with the missing values as fill values.
+        :param outname: output file path
+        """
+        try:
+            for state in self._vars.values():
+                for key, (buffer, _) in list(state['buffers'].items()):
+                    self._submit(state, key, buffer)
+                state['buffers'] = {}
+            self._write(outname)
+        finally:
+            self.close()
+
+    def _write(self, outname):
+        """Writes the compressed chunks into the closed output file and drops them"""
+        import h5py
+        with h5py.File(outname, 'r+') as f:
+            for name, state in self._vars.items():
+                dataset = f[name]
+                shape = tuple(max(size, extent) if maxsize is None else size
+                              for size, extent, maxsize in zip(
+                                  dataset.shape, state['extent'], dataset.maxshape))
+                if shape != dataset.shape:
+                    dataset.resize(shape)
+                for key, result in sorted(state['results'].items()):
+                    offset = tuple(i * chunk for i, chunk in zip(key, state['chunks']))
+                    dataset.id.write_direct_chunk(offset, result.get())
+                    state['stored'].add(key)
+                state['results'] = {}
+        self._pending = []
+
+    def close(self):
+        """Stops the worker processes, dropping the chunks not written"""
+        self._pool.terminate()
+        self._pool.join()
+        self._vars = {}
+        self._pending = []
+        self._dataset = None
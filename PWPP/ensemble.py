@@ -0,0 +1,181 @@
+# Streaming ensemble statistics of many WRF ensemble members
+
+import glob
+import os
+import shutil
+import tempfile
+import numpy as np
+from netCDF4 import Dataset
+from .batch import run_wrfpost_files
+
+# output variables that are coordinates rather than fields
+_COORDINATES = ('valid_time', 'plevels', 'hlevels', 'thlevels', 'mlevels', 'latitude',
+                'longitude', 'station_id', 'path_id', 'point_path', 'distance')
+
+
+class RunningStats(object):
+    """
+    Running count, mean, variance, minimum, maximum, and threshold exceedance counts of a
+    field over ensemble members, updated one member at a time with Welford's algorithm.
+    Missing values are left out of the statistics of their points.
+    """
+    def __init__(self, thresholds=()):
+        """
+        :param thresholds: list of thresholds to count exceedances of
+        """
+        self.thresholds = list(thresholds)
+        self.count = None
+        self._mean = None
+        self._m2 = None
+        self.min = None
+        self.max = None
+        self.exceed = None
+
+    def update(self, values):
+        """
+        Adds one member to the statistics
+        :param values: array of the field of the member
+        """
+        values = np.ma.filled(np.ma.asarray(values, dtype='f8'), np.nan)
+        if self.count is None:
+            self.count = np.zeros(values.shape, dtype='i4')
+            self._mean = np.zeros(values.shape)
+            self._m2 = np.zeros(values.shape)
+            self.min = np.full(values.shape, np.nan)
+            self.max = np.full(values.shape, np.nan)
+            self.exceed = np.zeros((len(self.thresholds),) + values.shape, dtype='i4')
+        elif values.shape != self.count.shape:
+            raise ValueError('Member shape '+str(values.shape)+' does not match ' +
+                             str(self.count.shape))
+        valid = np.isfinite(values)
+        self.count += valid
+        delta = np.where(valid, values - self._mean, 0.)
+        self._mean += delta / np.maximum(self.count, 1)
+        self._m2 += np.where(valid, delta * (values - self._mean), 0.)
+        self.min = np.fmin(self.min, values)
+        self.max = np.fmax(self.max, values)
+        with np.errstate(invalid='ignore'):
+            for i, threshold in enumerate(self.thresholds):
+                self.exceed[i] += values > threshold
+
+    @property
+    def mean(self):
+        """Mean, NaN where no member has a value"""
+        return np.where(self.count > 0, self._mean, np.nan)
+
+    @property
+    def spread(self):
+        """Standard deviation with one degree of freedom, NaN with fewer than two values"""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.count > 1, np.sqrt(self._m2 / (self.count - 1)), np.nan)
+
+    def probability(self, i):
+        """Fraction of members exceeding threshold i, NaN where no member has a value"""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.count > 0, self.exceed[i] / self.count, np.nan)
+
+
+def get_probability_name(name, threshold):
+    """Gets the output variable name of the exceedance probability of a threshold"""
+    return name + '_prob_gt_' + '{:g}'.format(threshold)
+
+
+def wrfpost_ensemble(innames, outname, variables, plevs=None, thresholds=None,
+                     processes=None, **kwargs):
+    """
+    Runs the WRF Post Processor on every member of an ensemble and writes only the
+    ensemble statistics. Members are post-processed in a pool of worker processes and
+    the running statistics are updated as each member finishes, so memory does not grow
+    with the number of members.
+    :param innames: glob pattern string or list of member input file paths. All members
+        must be from the same domain and times.
+    :param outname: output file path
+    :param variables: list of desired variable strings, see wrfpost
+    :param plevs: optional array of desired output pressure levels
+    :param thresholds: optional dictionary of output variable name, such as 'DBZ', to
+        list of thresholds. The fraction of members exceeding each threshold is written as
+        <name>_prob_gt_<threshold>.
+    :param processes: number of worker processes. Default is the number of CPUs.
+    :param kwargs: other keyword arguments passed to wrfpost
+    :return: number of members
+    """
+    if isinstance(innames, str):
+        innames = sorted(glob.glob(innames))
+    if len(innames) < 1:
+        raise ValueError('No input files given')
+    thresholds = thresholds or {}
+
+    tmpdir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(outname)))
+    outnames = [os.path.join(tmpdir, str(i) + '.nc') for i in range(len(innames))]
+    stats = {}
+    try:
+        # update the statistics with each member as it finishes, then delete it
+        template = None
+        for name in run_wrfpost_files(innames, outnames, variables, plevs=plevs,
+                                      processes=processes, ordered=False, **kwargs):
+            member = Dataset(name)
+            try:
+                for var_name, var in member.variables.items():
+                    if var_name in _COORDINATES:
+                        continue
+                    if var_name not in stats:
+                        stats[var_name] = RunningStats(thresholds.get(var_name, ()))
+                    stats[var_name].update(var[:])
+            finally:
+                member.close()
+            # the first member is kept for its coordinates and attributes
+            if template is None:
+                template = name
+            else:
+                os.remove(name)
+        for name in thresholds:
+            if name not in stats:
+                raise ValueError('No output variable '+name+' for thresholds')
+        _write_statistics(template, outname, stats, len(innames))
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    return len(innames)
+
+
+def _write_statistics(template, outname, stats, members):
+    """Writes the ensemble statistics of each field with the coordinates of a member output"""
+    src = Dataset(template)
+    out = Dataset(outname, 'w', format=src.data_model)
+    try:
+        out.setncatts(src.__dict__)
+        out.ensemble_members = members
+        for name, dim in src.dimensions.items():
+            out.createDimension(name, None if dim.isunlimited() else dim.size)
+        for name, var in src.variables.items():
+            filters = var.filters() or {}
+            options = {'zlib': filters.get('zlib', False),
+                       'complevel': filters.get('complevel', 4),
+                       'shuffle': filters.get('shuffle', True)}
+            attrs = {key: value for key, value in var.__dict__.items()
+                     if key not in ('scale_factor', 'add_offset', '_FillValue')}
+            if name in _COORDINATES:
+                out_var = out.createVariable(name, var.dtype, var.dimensions, **options)
+                out_var.setncatts(attrs)
+                out_var[:] = var[:]
+                continue
+            # packed members are written unpacked
+            dtype = 'f4' if var.dtype.kind in 'iu' else var.dtype
+            stat = stats[name]
+            products = [('_mean', stat.mean, ' ensemble mean', attrs.get('units')),
+                        ('_spread', stat.spread, ' ensemble spread', attrs.get('units')),
+                        ('_min', stat.min, ' ensemble minimum', attrs.get('units')),
+                        ('_max', stat.max, ' ensemble maximum', attrs.get('units'))]
+            for i, threshold in enumerate(stat.thresholds):
+                products.append((get_probability_name(name, threshold)[len(name):],
+                                 stat.probability(i),
+                                 ' probability of exceeding {:g}'.format(threshold), '1'))
+            for suffix, values, description, units in products:
+                out_var = out.createVariable(name + suffix, dtype, var.dimensions, **options)
+                out_var.setncatts(attrs)
+                out_var.description = attrs.get('description', name) + description
+                if units is not None:
+                    out_var.units = units
+                out_var[tuple(slice(0, size) for size in values.shape)] = values
+    finally:
+        out.close()
+        src.close()
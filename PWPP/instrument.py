@@ -0,0 +1,159 @@
+# Per-stage timing and memory instrumentation of post processor runs
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import json
+import sys
+import time
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def get_peak_rss():
+    """Gets the peak resident memory of this process in bytes, or None where not available"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class Instrument(object):
+    """
+    Records the wall and CPU time of each stage of a run and passes an event dictionary to
+    every hook when a stage starts and ends. Stages nest, and the times of a stage exclude
+    those of the stages inside it, so the compute time of a variable does not include its
+    reads and writes.
+
+    Every event has the keys event ('start', 'end', or 'message') and, for stages, stage
+    and name. End events add wall and cpu seconds, total_wall including inner stages,
+    peak_rss in bytes, the entries of context, and anything the caller added to the
+    stage record, such as nbytes.
+    """
+    def __init__(self, hooks=None):
+        """
+        :param hooks: optional list of callables taking one event dictionary
+        """
+        self.hooks = list(hooks) if hooks is not None else []
+        self.context = {}
+        self.totals = OrderedDict()
+        self._stack = []
+        self._start = time.perf_counter()
+
+    def emit(self, event):
+        """Passes an event to every hook"""
+        for hook in self.hooks:
+            hook(event)
+
+    def message(self, text):
+        """Emits a free text message"""
+        self.emit({'event': 'message', 'text': text})
+
+    @contextmanager
+    def stage(self, stage, name, **info):
+        """
+        Times a stage of the run
+        :param stage: stage type, such as 'read', 'compute', or 'write'
+        :param name: name of the variable or item the stage works on
+        :param info: other entries of the stage events
+        :return: context manager yielding the stage record, to which the caller may add
+            entries such as nbytes before the stage ends
+        """
+        record = dict(info, stage=stage, name=name)
+        self.emit(dict(record, event='start'))
+        inner = [0., 0.]
+        self._stack.append(inner)
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield record
+        finally:
+            wall = time.perf_counter() - wall
+            cpu = time.process_time() - cpu
+            self._stack.pop()
+            if self._stack:
+                self._stack[-1][0] += wall
+                self._stack[-1][1] += cpu
+            record.update(self.context)
+            record.update(event='end', wall=wall - inner[0], cpu=cpu - inner[1],
+                          total_wall=wall, peak_rss=get_peak_rss())
+            key = (stage, name)
+            total = self.totals.setdefault(key, {'count': 0, 'wall': 0., 'cpu': 0.,
+                                                 'nbytes': 0})
+            total['count'] += 1
+            total['wall'] += record['wall']
+            total['cpu'] += record['cpu']
+            total['nbytes'] += record.get('nbytes', 0)
+            self.emit(record)
+
+    def summary(self):
+        """
+        Gets the totals of each stage
+        :return: list of dictionaries of stage, name, count, wall and cpu seconds, and
+            nbytes, in the order the stages first ran
+        """
+        return [dict(total, stage=stage, name=name)
+                for (stage, name), total in self.totals.items()]
+
+    def print_summary(self):
+        """Prints a table of the totals of each stage and the run"""
+        print('{:<12}{:<28}{:>7}{:>11}{:>11}{:>14}'.format(
+            'stage', 'name', 'count', 'wall', 'cpu', 'bytes'))
+        for row in self.summary():
+            print('{:<12}{:<28}{:>7}{:>11.3f}{:>11.3f}{:>14}'.format(
+                row['stage'], row['name'][:27], row['count'], row['wall'], row['cpu'],
+                row['nbytes']))
+        peak = get_peak_rss()
+        print('Total wall time: {:.3f} s, peak memory: {}'.format(
+            time.perf_counter() - self._start, '-' if peak is None else str(peak)+' bytes'))
+
+
+@contextmanager
+def _no_stage():
+    yield {}
+
+
+def timed(instrument, stage, name, **info):
+    """Times a stage with an Instrument, doing nothing if instrument is None"""
+    if instrument is None:
+        return _no_stage()
+    return instrument.stage(stage, name, **info)
+
+
+class JSONLinesEmitter(object):
+    """Hook writing events to a file as one JSON object per line"""
+    def __init__(self, path, events=('end', 'message')):
+        """
+        :param path: output file path, or open text file object
+        :param events: types of events to write
+        """
+        if isinstance(path, str):
+            self.file = open(path, 'a')
+            self._owned = True
+        else:
+            self.file = path
+            self._owned = False
+        self.events = events
+
+    def __call__(self, event):
+        if event['event'] in self.events:
+            self.file.write(json.dumps(event, default=str) + '\n')
+
+    def close(self):
+        """Closes the file if it was opened by the emitter"""
+        if self._owned:
+            self.file.close()
+        else:
+            self.file.flush()
+
+
+def print_progress(event):
+    """Hook printing the progress messages of the post processor"""
+    if event['event'] == 'message':
+        print(event['text'])
+    elif event['event'] == 'start' and event['stage'] == 'compute':
+        print('Processing variable: '+event['name'])
+    elif event['event'] == 'start' and event['stage'] == 'slab':
+        print('Processing time steps '+event['name'])
@@ -0,0 +1,68 @@
+# Vertical interpolation using precomputed weights
+
+import warnings
+import numpy as np
+
+
+def get_interp_weights(levels, coordinate, axis=1, log=True):
+    """
+    Computes the bracketing indices and weights for interpolating to levels of a vertical
+    coordinate, such as pressure, height, or potential temperature. The weights depend
+    only on the coordinate field, so they are computed once and shared by every variable
+    interpolated to the same levels.
+    :param levels: 1D array of target levels, in the same units as coordinate
+    :param coordinate: array of the vertical coordinate on model levels
+    :param axis: vertical axis of the coordinate array
+    :param log: True to interpolate linearly in the log of the coordinate, as for pressure
+    :return: tuple of (below, above, weight, out_of_bounds) arrays with the target levels
+        on the first axis
+    """
+    transform = np.log if log else np.asarray
+    levels = np.atleast_1d(np.asarray(levels, dtype='f8'))
+    coord = transform(np.moveaxis(np.asarray(coordinate), axis, 0))
+    nz = coord.shape[0]
+
+    # sort the model levels by increasing coordinate
+    order = np.argsort(coord, axis=0)
+    coord = np.take_along_axis(coord, order, axis=0)
+
+    # count the model levels below each target, which is the searchsorted insertion
+    # point for every column at once
+    target = transform(levels).reshape((-1,) + (1,) * coord.ndim)
+    idx = (coord[np.newaxis] < target).sum(axis=1)
+    above = np.clip(idx, 1, nz - 1)
+    below = above - 1
+
+    coord_below = np.take_along_axis(coord, below, axis=0)
+    coord_above = np.take_along_axis(coord, above, axis=0)
+    target = target[..., 0]
+    out_of_bounds = (idx == nz) | (target < coord_below)
+    if np.any(out_of_bounds):
+        warnings.warn('Interpolation point out of data bounds encountered')
+
+    # columns with equal coordinates on adjacent levels, as isentropes in a well mixed
+    # layer, take the lower level
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weight = (target - coord_below) / (coord_above - coord_below)
+    weight[~np.isfinite(weight)] = 0.
+    below = np.take_along_axis(order, below, axis=0)
+    above = np.take_along_axis(order, above, axis=0)
+    return below, above, weight, out_of_bounds
+
+
+def interp_with_weights(values, weights, axis=1):
+    """
+    Interpolates a variable to the levels described by precomputed weights
+    :param values: array of data on model levels, the same shape as the pressure used for
+        the weights
+    :param weights: tuple returned by get_interp_weights
+    :param axis: vertical axis of the data array
+    :return: array of data on the target levels, NaN where the levels are out of bounds
+    """
+    below, above, weight, out_of_bounds = weights
+    values = np.moveaxis(np.asarray(values), axis, 0)
+    var_below = np.take_along_axis(values, below, axis=0)
+    var_above = np.take_along_axis(values, above, axis=0)
+    var_interp = var_below + (var_above - var_below) * weight
+    var_interp[out_of_bounds] = np.nan
+    return np.moveaxis(var_interp, 0, axis)
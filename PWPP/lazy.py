@@ -0,0 +1,412 @@
+# Lazy xarray Datasets of post-processed fields, computed by dask as they are accessed
+
+import itertools
+import os
+import threading
+from datetime import datetime
+import numpy as np
+import dask
+import dask.array as da
+import xarray as xr
+from netCDF4 import Dataset, Dimension, Variable, date2num
+from wrf import getvar, ALL_TIMES, is_moving_domain
+from metpy.units import units
+from . import calc
+from .cache import DiagnosticCache
+from .output import OutputRecorder, _PACKED_FILL
+from .planner import parse_variables, make_plan
+from .reduction import Reducer
+from .storage import get_storage, get_chunksizes, get_packing, get_significant_digits
+from .subset import Window, get_window
+from .variable_def import get_vertical_coordinates
+from .PWPP import get_reducer
+
+# netCDF4 and HDF5 are not thread safe, so the handles of each input file are used in turn
+_LOCKS = {}
+
+# wrf-python diagnostics reading a lookup table through a fixed Fortran unit, which are
+# computed by one thread at a time
+_SERIAL_DIAGNOSTICS = ('cape_2d', 'cape_3d')
+_SERIAL_LOCK = threading.Lock()
+
+
+def _get_lock(inname):
+    """Gets the lock of the handles of an input file in this process"""
+    return _LOCKS.setdefault(os.path.abspath(inname), threading.RLock())
+
+
+def _wrap(value, lock):
+    """Wraps netCDF4 objects and methods returned by a _Locked object in the same lock"""
+    if isinstance(value, (Variable, Dimension)):
+        return _Locked(value, lock)
+    if isinstance(value, dict):
+        return {key: _wrap(item, lock) for key, item in value.items()}
+    if callable(value):
+        def call(*args, **kwargs):
+            with lock:
+                return _wrap(value(*args, **kwargs), lock)
+        return call
+    return value
+
+
+class _Locked(object):
+    """
+    netCDF4 Dataset, Variable, or Dimension whose calls into the library hold the lock of
+    its file, so the diagnostics of a chunk are computed while other threads read
+    """
+    __slots__ = ('_obj', '_lock')
+
+    def __init__(self, obj, lock):
+        self._obj = obj
+        self._lock = lock
+
+    def __getattr__(self, name):
+        with self._lock:
+            return _wrap(getattr(self._obj, name), self._lock)
+
+    @property
+    def __dict__(self):
+        with self._lock:
+            return self._obj.__dict__
+
+    def __len__(self):
+        with self._lock:
+            return len(self._obj)
+
+    def __getitem__(self, index):
+        with self._lock:
+            return self._obj[index]
+
+
+def _open(inname, window):
+    """Opens the input file for one chunk, reading under the lock of its file"""
+    lock = _get_lock(inname)
+    with lock:
+        dataset = Dataset(inname)
+    return DiagnosticCache(_Locked(dataset, lock), window=window)
+
+
+def _compute_group(inname, window, func_name, args, kwargs, dtype, tslice, serial=False):
+    """
+    Computes one group of variables over a chunk and returns its writes by name
+    :param serial: True if the group computes one of _SERIAL_DIAGNOSTICS
+    """
+    recorder = OutputRecorder()
+    data = _open(inname, window)
+    if serial:
+        _SERIAL_LOCK.acquire()
+    try:
+        getattr(calc, func_name)(data, *args, recorder, dtype, None, None, tslice=tslice,
+                                 **kwargs)
+    finally:
+        if serial:
+            _SERIAL_LOCK.release()
+        data.close()
+    return {record[0]: record for record in recorder.records}
+
+
+def _compute_coordinate(inname, window, name, tslice):
+    """Computes the latitude or longitude over a chunk, with its attributes"""
+    data = _open(inname, window)
+    try:
+        values = calc.get_wrf_var(data, name, tslice)
+    finally:
+        data.close()
+    return {name: (name, np.array(values), None, None, values.units, values.description,
+                   tslice)}
+
+
+def _reduce(records, field, reduction, seconds):
+    """Reduces a field computed over all times and returns the writes of the reduction"""
+    recorder = OutputRecorder()
+    Reducer([reduction], seconds).update(recorder, *records[field])
+    return {record[0]: record for record in recorder.records}
+
+
+def _pick(records, name, dtype, ndim, packing=None):
+    """Gets the values of one variable from the writes of a chunk"""
+    values = np.ma.filled(np.ma.asarray(records[name][1], dtype=dtype), np.nan)
+    if values.ndim > ndim:
+        # a field without time computed at the first time step of the chunk
+        values = values[0]
+    if packing is not None:
+        # clipped to the packing range as the output file stores it
+        values = np.clip(values, packing[2], packing[3])
+    return values
+
+
+def get_chunk_ranges(size, chunk=None, min_size=1):
+    """
+    Splits a dimension into chunks
+    :param size: dimension size
+    :param chunk: chunk size, or None for one chunk
+    :param min_size: smallest size of the last chunk, which is otherwise joined to the one
+        before it. Horizontal chunks keep at least 2 points, as diagnostics need them.
+    :return: list of (start, stop) tuples
+    """
+    chunk = size if chunk is None else max(int(chunk), min_size)
+    ranges = [(start, min(start + chunk, size)) for start in range(0, size, chunk)]
+    if len(ranges) > 1 and ranges[-1][1] - ranges[-1][0] < min_size:
+        ranges[-2:] = [(ranges[-2][0], size)]
+    return ranges
+
+
+def get_slice(time):
+    """Gets the slice of time steps of a time range, or None for all times"""
+    return None if time is None else slice(*time)
+
+
+def get_encoding(storage, overrides, name, dims, shape, ntimes):
+    """
+    Gets the netCDF encoding of a variable from its storage settings, so to_netcdf stores
+    it as wrfpost does
+    :param storage: storage profile name or dictionary of profile settings
+    :param overrides: optional dictionary of variable name to dictionary of settings
+    :param name: output variable name
+    :param dims: tuple of output dimension names
+    :param shape: tuple of output dimension sizes
+    :param ntimes: number of times in the run
+    :return: dictionary of xarray encoding settings
+    """
+    settings = get_storage(storage, overrides, name)
+    encoding = {'zlib': settings['zlib'], 'complevel': settings['complevel'],
+                'shuffle': settings['shuffle'], '_FillValue': None}
+    chunksizes = get_chunksizes(settings['chunks'], dims, shape, ntimes)
+    if chunksizes is not None:
+        encoding['chunksizes'] = chunksizes
+    packing = get_packing(settings['pack'], name)
+    if packing is not None:
+        encoding.update(dtype='i2', scale_factor=np.float32(packing[0]),
+                        add_offset=np.float32(packing[1]), _FillValue=_PACKED_FILL)
+    else:
+        digits = get_significant_digits(settings['least_significant_digit'], name)
+        if digits is not None:
+            encoding['least_significant_digit'] = digits
+    return encoding
+
+
+class _Chunks(object):
+    """Chunk layout of the output grid and the delayed computations of each chunk"""
+    def __init__(self, inname, ntimes, window, ny, nx, chunks):
+        self.inname = inname
+        self.ranges = {'time': get_chunk_ranges(ntimes, chunks.get('time', 1))}
+        if window is None:
+            self.window = Window(slice(0, ny), slice(0, nx), 1, ny, nx)
+            self.full = True
+        else:
+            self.window = window
+            self.full = False
+        shape = self.window.shape
+        self.ranges['lat'] = get_chunk_ranges(shape[0], chunks.get('lat'), 2)
+        self.ranges['lon'] = get_chunk_ranges(shape[1], chunks.get('lon'), 2)
+        self._tasks = {}
+
+    def get_window(self, lat, lon):
+        """Gets the input window of a horizontal chunk, or None for the full grid"""
+        if self.full and len(self.ranges['lat']) == 1 and len(self.ranges['lon']) == 1:
+            return None
+        ys, xs, stride = self.window.ys, self.window.xs, self.window.stride
+        return Window(slice(ys.start + lat[0] * stride, ys.start + (lat[1] - 1) * stride + 1),
+                      slice(xs.start + lon[0] * stride, xs.start + (lon[1] - 1) * stride + 1),
+                      stride, self.window.ny, self.window.nx)
+
+    def task(self, key, func, *args):
+        """Gets a delayed computation, shared by the variables it computes"""
+        if key not in self._tasks:
+            self._tasks[key] = dask.delayed(func)(*args)
+        return self._tasks[key]
+
+    def probe(self, key, func, *args):
+        """
+        Computes a chunk at once, to find what it writes, and keeps its result as the
+        computation of the chunk, so it is not computed again when accessed
+        """
+        value = func(*args)
+        self._tasks[key] = dask.delayed(value, traverse=False)
+        return value
+
+    def array(self, make_task, name, dims, sizes, dtype, times=None, packing=None,
+              static=False):
+        """
+        Assembles a dask array of a variable from its chunks
+        :param make_task: callable of (time range or None for all times, window, lat
+            range, lon range) getting the delayed writes of a chunk
+        :param name: output variable name
+        :param dims: tuple of output dimension names
+        :param sizes: dictionary of dimension name to size
+        :param dtype: output data type
+        :param times: list of time ranges, or None for the chunk layout
+        :param packing: optional packing of the variable, see storage.get_packing
+        :param static: True for a field without time computed at the first time step
+        :return: dask array
+        """
+        ranges = [(times or self.ranges['time']) if dim == 'time' else
+                  self.ranges.get(dim, [(0, sizes[dim])]) for dim in dims]
+        blocks = np.empty([len(dim_ranges) for dim_ranges in ranges], dtype=object)
+        for index in itertools.product(*[range(len(dim_ranges)) for dim_ranges in ranges]):
+            chunk = {dim: ranges[axis][i] for axis, (dim, i) in enumerate(zip(dims, index))}
+            time = chunk.get('time', (0, 1))
+            full = time == (0, sizes['time']) and not static
+            lat = chunk.get('lat', (0, sizes['lat']))
+            lon = chunk.get('lon', (0, sizes['lon']))
+            records = make_task(None if full else time, self.get_window(lat, lon),
+                                lat, lon)
+            shape = tuple(stop - start for start, stop in
+                          (chunk.get(dim, (0, sizes[dim])) for dim in dims))
+            blocks[index] = da.from_delayed(
+                dask.delayed(_pick)(records, name, dtype, len(dims), packing),
+                shape, dtype=np.dtype(dtype))
+        return da.block(blocks.tolist())
+
+
+def wrfpost_dataset(inname, variables, plevs=None, hlevels=None, thlevels=None, chunks=None,
+                    storage='default', storage_vars=None, bbox=None, index_window=None,
+                    stride=1, reduced_only=False, model_levels=False):
+    """
+    Post processes a WRF output file into a lazy xarray Dataset. Each variable is a dask
+    array chunked along time and the horizontal grid, and each chunk of a group of
+    variables is computed the first time any variable of the group needs it, so only the
+    chunks of a selection are computed. The Dataset has the variables, dimensions, and
+    attributes of the wrfpost output, and to_netcdf writes it with the same storage
+    settings.
+
+    The first chunk of each group is computed on opening, to find the variables the group
+    writes, and kept until the chunk is accessed. Reductions over time are computed over
+    all times of a horizontal chunk. As netCDF4 is not thread safe, the chunks computed by
+    threads read the input in turn, but compute their diagnostics at once.
+    :param inname: string of input file path
+    :param variables: list of desired variable strings
+    :param plevs: optional array of pressure levels with units
+    :param hlevels: optional array of heights above ground level with units
+    :param thlevels: optional array of potential temperature levels with units
+    :param chunks: optional dictionary of 'time', 'lat', and 'lon' to chunk sizes. Default
+        is one time step of the full grid per chunk.
+    :param storage: storage profile name or dictionary of profile settings, giving the
+        encoding of each variable
+    :param storage_vars: optional dictionary of variable name to storage settings
+    :param bbox: optional (lat_min, lat_max, lon_min, lon_max) bounding box
+    :param index_window: optional (south_north start, stop, west_east start, stop) indices
+    :param stride: integer step between kept grid points
+    :param reduced_only: True to include only the reductions of the variables they reduce
+    :param model_levels: True to also include the variables on vertical levels on the model
+        levels, see wrfpost
+    :return: xarray Dataset
+    """
+    chunks = dict(chunks or {})
+    data = Dataset(inname)
+    try:
+        window = get_window(data, bbox, index_window, stride)
+        ny = data.dimensions['south_north'].size
+        nx = data.dimensions['west_east'].size
+        ntimes = data.dimensions['Time'].size
+        dtype = 'f4' if data.variables['XLAT'].dtype == 'float32' else 'f8'
+        times = np.atleast_1d(getvar(data, 'times', ALL_TIMES, meta=False))
+        vtimes = [datetime.strptime(str(time), '%Y-%m-%dT%H:%M:%S.000000000')
+                  for time in times]
+        iso_vars, other_vars = parse_variables(variables)
+        levels = {name: values for name, values in
+                  (('pressure', plevs), ('height', hlevels), ('theta', thlevels))
+                  if values is not None}
+        if model_levels:
+            levels['model'] = np.arange(1, data.dimensions['bottom_top'].size + 1) * units('1')
+        if len(levels) == 0 and len(iso_vars) > 0:
+            raise ValueError('Variables on vertical levels requested, no levels given')
+        plan = make_plan(data, variables, levels=levels)
+        reducer = get_reducer(data, other_vars, reduced_only)
+        moving = is_moving_domain(data)
+        attrs = {name: data.getncattr(name) for name in data.ncattrs()}
+    finally:
+        data.close()
+    if window is not None:
+        attrs.update(window.attributes())
+
+    layout = _Chunks(inname, ntimes, window, ny, nx, chunks)
+    sizes = {'time': ntimes, 'lat': sum(stop - start for start, stop in layout.ranges['lat']),
+             'lon': sum(stop - start for start, stop in layout.ranges['lon'])}
+    # the first chunk, which is computed on opening
+    lat, lon = layout.ranges['lat'][0], layout.ranges['lon'][0]
+    first_window = layout.get_window(lat, lon)
+    first_time = layout.ranges['time'][0]
+    if first_time == (0, ntimes):
+        first_time = None
+    variables = {}
+
+    # levels of each vertical coordinate and the valid times
+    coordinates = get_vertical_coordinates()
+    for name, values in levels.items():
+        coordinate = coordinates[name]
+        sizes[coordinate['dim']] = values.size
+        values = values.to(coordinate.get('convert_units', coordinate['units']))
+        variables[coordinate['levels_var']] = xr.Variable(
+            (coordinate['dim'],), np.asarray(values.m, dtype=dtype),
+            {'units': coordinate['units'], 'description': coordinate['description']},
+            {'_FillValue': None})
+    time_units = 'seconds since '+str(vtimes[0])
+    coord_storage = get_storage(storage, storage_vars, 'valid_time')
+    variables['valid_time'] = xr.Variable(
+        ('time',), np.asarray(date2num(vtimes, time_units), dtype=dtype),
+        {'units': time_units, 'description': 'Model Forecast Times'},
+        {'zlib': coord_storage['zlib'], 'complevel': coord_storage['complevel'],
+         '_FillValue': None})
+
+    def add(name, record, array):
+        shape = tuple(sizes[dim] for dim in record[3])
+        variables[name] = xr.Variable(record[3], array,
+                                      {'units': record[4], 'description': record[5]},
+                                      get_encoding(storage, storage_vars, name, record[3],
+                                                   shape, ntimes))
+
+    # latitude and longitude of a fixed domain are 2D when the storage keeps them static
+    static = coord_storage['static_coords'] and not moving
+    for name, coord in (('latitude', 'lat'), ('longitude', 'lon')):
+        def make_task(time, chunk_window, lat, lon, coord=coord):
+            return layout.task(('coordinate', coord, time, lat, lon), _compute_coordinate,
+                               inname, chunk_window, coord, get_slice(time))
+        dims = ('lat', 'lon') if static else ('time', 'lat', 'lon')
+        time = (0, 1) if static else first_time
+        record = layout.probe(('coordinate', coord, time, lat, lon), _compute_coordinate,
+                              inname, first_window, coord, get_slice(time))[coord]
+        record = (name, None, dtype, dims) + record[4:]
+        add(name, record, layout.array(make_task, coord, dims, sizes, dtype, static=static))
+
+    # each group of variables, finding what it writes from one chunk
+    for step in plan:
+        func_name = step['func'].__name__
+        serial = any(name in _SERIAL_DIAGNOSTICS for name in step['needs'])
+
+        def make_task(time, chunk_window, lat, lon, step=step, func_name=func_name,
+                      serial=serial):
+            return layout.task((step['label'], time, lat, lon), _compute_group, inname,
+                               chunk_window, func_name, step['args'], step['kwargs'], dtype,
+                               get_slice(time), serial)
+        probe = layout.probe((step['label'], first_time, lat, lon), _compute_group, inname,
+                             first_window, func_name, step['args'], step['kwargs'], dtype,
+                             get_slice(first_time), serial)
+        for name, record in probe.items():
+            if reducer is not None and name in reducer.fields:
+                for reduction in reducer.reductions:
+                    if reduction[1] != name:
+                        continue
+                    reduced = _reduce(probe, name, reduction, reducer.seconds)[reduction[0]]
+
+                    def reduce_task(time, chunk_window, lat, lon, name=name,
+                                    reduction=reduction, make_task=make_task):
+                        return layout.task((reduction[0], lat, lon), _reduce,
+                                           make_task(None, chunk_window, lat, lon), name,
+                                           reduction, reducer.seconds)
+                    add(reduction[0], reduced, layout.array(
+                        reduce_task, reduction[0], reduced[3], sizes, reduced[2],
+                        [(0, ntimes)], get_packing(get_storage(
+                            storage, storage_vars, reduction[0])['pack'], reduction[0])))
+                if name not in reducer.write_fields:
+                    continue
+            for dim, size in zip(record[3], np.shape(record[1])):
+                sizes.setdefault(dim, size)
+            packing = get_packing(get_storage(storage, storage_vars, name)['pack'], name)
+            add(name, record, layout.array(make_task, name, record[3], sizes, record[2],
+                                           packing=packing,
+                                           static='time' not in record[3]))
+
+    dataset = xr.Dataset(variables, attrs=attrs)
+    dataset.encoding['unlimited_dims'] = {'time'}
+    return dataset
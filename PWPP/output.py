@@ -0,0 +1,253 @@
+# Output file handling
+
+import numpy as np
+from .storage import get_storage, get_chunksizes, get_packing, get_significant_digits
+from .compress import is_compressible
+from .instrument import timed
+
+# fill value of packed int16 variables
+_PACKED_FILL = -32768
+
+# coordinates attribute of variables along each sampling dimension
+_SAMPLING_COORDINATES = {
+    'station': 'valid_time latitude longitude station_id',
+    'point': 'valid_time latitude longitude distance',
+}
+
+
+class OutputFile(object):
+    """
+    Wraps the output netCDF4 Dataset, or backends.ZarrDataset, and applies the storage
+    settings of each variable when it is created. Attributes not defined here are passed
+    through to the Dataset, so the wrapper can be used wherever the calc functions expect
+    the output Dataset.
+    With a regridder, fields on the WRF grid are remapped to its regular grid as they are
+    written. With a station index, fields gathered at the stations are written as station
+    time series, and with a sections.PathIndex they are interpolated to the points of its
+    paths. With a reducer, the reductions of fields are updated as they are written.
+    Once detached, the writes go to a writer process owning the output file. With a
+    compress.ChunkCompressor, the chunks of deflated variables are compressed in its
+    worker processes and written into the file after each slab.
+    """
+    def __init__(self, dataset, storage='default', overrides=None, ntimes=1, instrument=None,
+                 regridder=None, stations=None, reducer=None, compressor=None):
+        """
+        :param dataset: output netCDF4 Dataset or backends.ZarrDataset
+        :param storage: storage profile name or dictionary of profile settings
+        :param overrides: optional dictionary of variable name to dictionary of settings
+        :param ntimes: number of times in the run, used for time-series chunk shapes
+        :param instrument: optional Instrument timing each write
+        :param regridder: optional regrid.Regridder with the grids of the slab written
+        :param stations: optional stations.StationIndex or sections.PathIndex the input is
+            gathered with
+        :param reducer: optional reduction.Reducer of the run
+        :param compressor: optional compress.ChunkCompressor of the variables created
+        """
+        self.dataset = dataset
+        self.storage = storage
+        self.overrides = overrides
+        self.ntimes = ntimes
+        self.written = {}
+        self._packing = {}
+        self.instrument = instrument
+        self.regridder = regridder
+        self.stations = stations
+        self.reducer = reducer
+        self.writer = None
+        self.compressor = compressor
+        self._names = set()
+
+    def __getattr__(self, name):
+        return getattr(self.dataset, name)
+
+    def create(self, name, dtype, dims, units, description):
+        """
+        Creates an output variable using its storage settings
+        :param name: output variable name
+        :param dtype: output data type of unpacked variables
+        :param dims: tuple of output dimension names
+        :param units: units attribute string
+        :param description: description attribute string
+        :return: netCDF4 Variable
+        """
+        settings = get_storage(self.storage, self.overrides, name)
+        shape = [self.ntimes if dim == 'time' else self.dataset.dimensions[dim].size
+                 for dim in dims]
+        kwargs = {'zlib': settings['zlib'], 'complevel': settings['complevel'],
+                  'shuffle': settings['shuffle'],
+                  'chunksizes': get_chunksizes(settings['chunks'], dims, shape, self.ntimes)}
+        packing = get_packing(settings['pack'], name)
+        if packing is not None:
+            dtype = 'i2'
+            kwargs['fill_value'] = _PACKED_FILL
+        else:
+            kwargs['least_significant_digit'] = get_significant_digits(
+                settings['least_significant_digit'], name)
+        out_data = self.dataset.createVariable(name, dtype, dims, **kwargs)
+        if packing is not None:
+            out_data.scale_factor = np.float32(packing[0])
+            out_data.add_offset = np.float32(packing[1])
+            self._packing[name] = packing
+        out_data.units = units
+        out_data.description = description
+        for dim, coordinates in _SAMPLING_COORDINATES.items():
+            if dim in dims:
+                out_data.coordinates = coordinates
+        if self.compressor is not None and is_compressible(out_data):
+            self.compressor.add(out_data, shape)
+        self.written[name] = 0
+        return out_data
+
+    def write(self, name, values, dtype, dims, units, description, tslice=None):
+        """
+        Writes a variable to the output file, creating it on the first slab
+        :param name: output variable name
+        :param values: array of data to write
+        :param dtype: output data type of unpacked variables
+        :param dims: tuple of output dimension names
+        :param units: units attribute string
+        :param description: description attribute string
+        :param tslice: slice of time steps to write, or None for all times. For fields
+            without time, the time step of the grid the field is on.
+        """
+        if self.reducer is not None and name in self.reducer.fields:
+            with timed(self.instrument, 'reduce', name):
+                self.reducer.update(self, name, values, dtype, dims, units, description,
+                                    tslice)
+            if name not in self.reducer.write_fields:
+                return
+        gridded = dims[-2:] == ('lat', 'lon')
+        static = gridded and dims[0] != 'time'
+        if static and (self.regridder is not None or self.stations is not None):
+            values = np.asarray(values)[np.newaxis]
+        if self.regridder is not None and gridded:
+            with timed(self.instrument, 'regrid', name):
+                values = self.regridder.apply(values, tslice)
+        index = tslice
+        if self.stations is not None and gridded:
+            # station time series have station first, then time
+            values = self.stations.apply(values, tslice)
+            dims = (self.stations.dim,) + dims[:-2]
+            index = (slice(None), tslice or slice(0, values.shape[1]))
+            if static:
+                values = values[:, 0]
+        elif static and self.regridder is not None:
+            values = values[0]
+        if static:
+            index = None
+        with timed(self.instrument, 'write', name) as record:
+            if self.writer is None:
+                nbytes = self.put(name, values, dtype, dims, units, description, index)
+            else:
+                # the bytes before packing, as the writer process creates the variable
+                self.writer.put(name, values, dtype, dims, units, description, index)
+                nbytes = np.size(values) * np.dtype(dtype).itemsize
+                self.written[name] = self.written.get(name, 0) + nbytes
+            record['nbytes'] = nbytes
+
+    def put(self, name, values, dtype, dims, units, description, index=None):
+        """
+        Stores output values, creating the variable if it is new
+        :param name: output variable name
+        :param values: array of data to write
+        :param dtype: output data type of unpacked variables
+        :param dims: tuple of output dimension names
+        :param units: units attribute string
+        :param description: description attribute string
+        :param index: index of the values in the variable, or None for all of it
+        :return: number of bytes written
+        """
+        if name in self.dataset.variables:
+            out_data = self.dataset.variables[name]
+        else:
+            out_data = self.create(name, dtype, dims, units, description)
+        if name in self._packing:
+            # clip to the packing range and store missing values as the fill value
+            vmin, vmax = self._packing[name][2:]
+            values = np.ma.masked_invalid(np.clip(values, vmin, vmax))
+            # masked points hold a value in range, so packing them casts no NaN
+            values = np.ma.array(values.filled(vmin), mask=np.ma.getmaskarray(values))
+        if self.compressor is not None and name in self.compressor:
+            self.compressor.write(name, index, values)
+        elif index is None:
+            out_data[:] = values
+        else:
+            out_data[index] = values
+        nbytes = np.size(values) * out_data.dtype.itemsize
+        self.written[name] = self.written.get(name, 0) + nbytes
+        return nbytes
+
+    def assign(self, name, index, values):
+        """
+        Writes values to an existing variable
+        :param name: output variable name
+        :param index: index of the values in the variable, or None for all of it
+        :param values: array of data to write
+        """
+        index = slice(None) if index is None else index
+        if self.writer is None:
+            self.dataset.variables[name][index] = values
+        else:
+            self.writer.assign(name, index, values)
+
+    def has(self, name):
+        """Checks if the output has a variable"""
+        if self.writer is None:
+            return name in self.dataset.variables
+        return name in self._names or name in self.written
+
+    def write_chunks(self):
+        """Writes the chunks the compressor completed into the output file"""
+        if self.compressor is not None:
+            self.dataset = self.compressor.write_completed(self.dataset)
+
+    def detach(self, make_writer):
+        """
+        Closes the output file, so a writer process owns it while slabs are computed
+        :param make_writer: callable starting the pipeline.Writer that opens the closed
+            file and writes the output in order
+        """
+        self._names = set(self.dataset.variables)
+        self.dataset.close()
+        self.writer = make_writer()
+
+    def close(self, abort=False):
+        """
+        Closes the output file, waiting for the writes queued in a writer process, or
+        writing the chunks of the compressor into it
+        :param abort: True when a run is interrupted, to keep the writes and markers queued
+            before the interruption without raising the errors of a writer process. The
+            chunks of the compressor are dropped.
+        """
+        if self.compressor is not None:
+            outname = self.dataset.filepath()
+            self.dataset.close()
+            if abort:
+                self.compressor.close()
+            else:
+                self.compressor.flush(outname)
+        elif self.writer is None:
+            self.dataset.close()
+        elif abort:
+            # stopping the writer in the middle of a write could corrupt the output
+            try:
+                self.writer.close()
+            except Exception:
+                self.writer.terminate()
+        else:
+            self.written.update(self.writer.close()['written'])
+
+
+class OutputRecorder(object):
+    """
+    Records writes in place of an output file, so variables can be computed in another
+    process and written by the single process that owns the output file
+    """
+    def __init__(self):
+        self.records = []
+        # nothing is stored yet, so reads fall back to the input file
+        self.variables = {}
+
+    def write(self, name, values, dtype, dims, units, description, tslice=None):
+        """Records a write with the arguments of OutputFile.write"""
+        self.records.append((name, values, dtype, dims, units, description, tslice))
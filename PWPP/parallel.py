@@ -0,0 +1,80 @@
+# Parallel computation of output variable groups
+
+from concurrent.futures import ProcessPoolExecutor
+from netCDF4 import Dataset
+from . import calc
+from .cache import DiagnosticCache
+from .backends import ZarrDataset
+from .output import OutputFile, OutputRecorder
+
+# input file, current time slab, and output store of a worker process
+_data = None
+_tslice = None
+_output = None
+
+
+def _init_worker(inname, cache_size, window, stations, output=None):
+    """Opens the input file once per worker process"""
+    global _data, _output
+    _data = DiagnosticCache(Dataset(inname), max_bytes=cache_size, window=window,
+                            stations=stations)
+    _output = output
+
+
+def _compute_group(func_name, args, kwargs, dtype, tslice):
+    """
+    Computes one group of variables in a worker process and returns its writes, or writes
+    them into the chunks of the output store itself
+    """
+    global _tslice
+    # cached fields are shared by the groups of one slab only
+    if tslice != _tslice:
+        _data.clear()
+        _tslice = tslice
+    if _output is None:
+        recorder = OutputRecorder()
+        getattr(calc, func_name)(_data, *args, recorder, dtype, None, None, tslice=tslice,
+                                 **kwargs)
+        return recorder.records, {}
+    outname, storage, overrides, ntimes = _output
+    # opened for each group, so the variables other processes created are known. Chunks
+    # are stored as they are written, and the process closing the run consolidates the
+    # metadata, so the store is not closed here.
+    outfile = OutputFile(ZarrDataset(outname, 'a', ntimes), storage, overrides, ntimes,
+                         stations=_data.stations)
+    getattr(calc, func_name)(_data, *args, outfile, dtype, None, None, tslice=tslice,
+                             **kwargs)
+    return [], outfile.written
+
+
+def get_executor(inname, workers, cache_size='1GB', window=None, stations=None,
+                 output=None):
+    """
+    Starts a pool of worker processes that each open the input file
+    :param inname: string of input file path
+    :param workers: number of worker processes
+    :param cache_size: byte limit of the cache in each worker
+    :param window: optional subset.Window of the horizontal grid to read
+    :param stations: optional stations.StationIndex with the grids set
+    :param output: optional (path, storage, overrides, ntimes) of a Zarr output store the
+        workers write their variables into, each process writing its own chunks
+    :return: concurrent.futures.ProcessPoolExecutor
+    """
+    return ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                               initargs=(inname, cache_size, window, stations, output))
+
+
+def submit_group(executor, func, args, kwargs, dtype, tslice=None):
+    """
+    Submits the computation of one group of variables to the worker pool
+    :param executor: executor from get_executor
+    :param func: calc function computing the group
+    :param args: tuple of arguments to func before the output file
+    :param kwargs: dictionary of keyword arguments to func
+    :param dtype: output data type
+    :param tslice: slice of time steps, or None for all times
+    :return: future of the list of (name, values, dtype, dims, units, description, tslice)
+        writes made by the group, and the dictionary of bytes of each variable the worker
+        wrote into the output store itself
+    """
+    return executor.submit(_compute_group, func.__name__, args, kwargs, dtype, tslice)
@@ -0,0 +1,193 @@
+# Pipelined post processing, overlapping input reads and output writes with compute
+
+import multiprocessing
+import queue
+import time
+from netCDF4 import Dataset
+from .backends import open_output
+from .cache import DiagnosticCache
+from .output import OutputFile
+
+# number of writes that may wait for the writer process
+WRITE_QUEUE = 8
+
+# seconds between checks of a stage process that may have died
+_POLL = 1.
+
+
+def _read_main(inname, slabs, window, stations, queue_out):
+    """Reads the raw fields of each slab in order into a bounded queue"""
+    try:
+        data = DiagnosticCache(Dataset(inname), max_bytes=0, window=window,
+                               stations=stations)
+        try:
+            for tslice, reads in slabs:
+                fields = {(name, halo): data.read(name, tslice, halo) for name, halo in reads}
+                queue_out.put((tslice, fields))
+        finally:
+            data.close()
+    except Exception as err:
+        queue_out.put((None, err))
+
+
+def _get(queue_in, process):
+    """Gets the next item of a stage, failing if its process died without sending one"""
+    while True:
+        try:
+            return queue_in.get(timeout=_POLL)
+        except queue.Empty:
+            if not process.is_alive():
+                raise RuntimeError('Pipeline process exited with code ' +
+                                   str(process.exitcode))
+
+
+class Reader(object):
+    """
+    Background process reading the raw fields of the slabs ahead of the one being
+    computed, with its own handle of the input file. At most depth slabs of fields wait
+    in its queue, bounding the memory read ahead.
+    """
+    def __init__(self, inname, slabs, window=None, stations=None, depth=1):
+        """
+        :param inname: input file path
+        :param slabs: list of (tslice, list of (raw field name, halo) reads) in the order
+            computed, see cache.DiagnosticCache.get_reads
+        :param window: optional subset.Window the input is read over
+        :param stations: optional stations.StationIndex the input is gathered with
+        :param depth: number of slabs of fields that may wait to be computed
+        """
+        self._queue = multiprocessing.Queue(max(int(depth), 1))
+        self._process = multiprocessing.Process(
+            target=_read_main, args=(inname, list(slabs), window, stations, self._queue),
+            daemon=True)
+        self._process.start()
+        self.wait = 0.
+
+    def load(self, cache, tslice):
+        """
+        Adds the fields read for the next slab to the cache
+        :param cache: cache.DiagnosticCache computing the slab
+        :param tslice: slice of time steps of the slab, or None for all times
+        """
+        start = time.perf_counter()
+        read_slice, fields = _get(self._queue, self._process)
+        self.wait += time.perf_counter() - start
+        if isinstance(fields, Exception):
+            raise fields
+        if read_slice != tslice:
+            raise RuntimeError('Reader is out of step with the slabs computed')
+        for (name, halo), values in fields.items():
+            cache.add(name, tslice, values, halo)
+
+    def close(self):
+        """Stops the reader process"""
+        if self._process.is_alive():
+            self._process.terminate()
+        self._process.join()
+        self._queue.close()
+
+
+def _write_main(outname, storage, overrides, ntimes, checkpoint, format, queue_in,
+                queue_out):
+    """Writes the requests of the queue to the output file until a None request"""
+    error = None
+    seconds = 0.
+    outfile = None
+    try:
+        outfile = OutputFile(open_output(outname, 'a', format, ntimes), storage, overrides,
+                             ntimes)
+    except Exception as err:
+        error = err
+    while True:
+        request = queue_in.get()
+        if request is None:
+            break
+        if error is not None:
+            # keep draining, so the compute stage never blocks on a full queue
+            continue
+        start = time.perf_counter()
+        try:
+            if request[0] == 'put':
+                outfile.put(*request[1:])
+            elif request[0] == 'assign':
+                name, index, values = request[1:]
+                outfile.dataset.variables[name][index] = values
+            else:
+                checkpoint.mark(outfile.dataset, *request[1:])
+        except Exception as err:
+            error = err
+        seconds += time.perf_counter() - start
+    try:
+        if outfile is not None:
+            outfile.dataset.close()
+    except Exception as err:
+        error = error or err
+    queue_out.put(error if error is not None else
+                  {'seconds': seconds, 'written': outfile.written})
+
+
+class Writer(object):
+    """
+    Background process owning the output file while slabs are computed. Writes wait in a
+    queue of WRITE_QUEUE requests, bounding the memory waiting to be written, and are
+    applied in order, so a group is marked done only after its variables are written.
+    """
+    def __init__(self, outname, storage, overrides, ntimes, checkpoint, format=None):
+        """
+        :param outname: output file path, closed by this process
+        :param storage: storage profile name or dictionary of profile settings
+        :param overrides: optional dictionary of variable name to dictionary of settings
+        :param ntimes: number of times in the run
+        :param checkpoint: checkpoint.Checkpoint of the run
+        :param format: output format, see backends.open_output
+        """
+        self._queue = multiprocessing.Queue(WRITE_QUEUE)
+        self._result = multiprocessing.Queue()
+        self._process = multiprocessing.Process(
+            target=_write_main, args=(outname, storage, overrides, ntimes, checkpoint,
+                                      format, self._queue, self._result),
+            daemon=True)
+        self._process.start()
+        self.stats = None
+
+    def _send(self, request):
+        """Queues a request, failing if the writer process died"""
+        while True:
+            try:
+                self._queue.put(request, timeout=_POLL)
+                return
+            except queue.Full:
+                if not self._process.is_alive():
+                    raise RuntimeError('Writer process exited with code ' +
+                                       str(self._process.exitcode))
+
+    def put(self, name, values, dtype, dims, units, description, index=None):
+        """Queues a write of a variable, with the arguments of output.OutputFile.put"""
+        self._send(('put', name, values, dtype, dims, units, description, index))
+
+    def assign(self, name, index, values):
+        """Queues a write of values to an existing variable"""
+        self._send(('assign', name, index, values))
+
+    def mark(self, tslice, label, names, state=None):
+        """Queues the marker of a group done, see checkpoint.Checkpoint.mark"""
+        self._send(('mark', tslice, label, names, state))
+
+    def close(self):
+        """
+        Waits for every queued write and closes the output file
+        :return: dictionary of the seconds spent writing and bytes written of each variable
+        """
+        self._send(None)
+        result = _get(self._result, self._process)
+        self._process.join()
+        if isinstance(result, Exception):
+            raise result
+        self.stats = result
+        return result
+
+    def terminate(self):
+        """Stops a writer process that failed, without waiting for the queued writes"""
+        if self._process.is_alive():
+            self._process.terminate()
+        self._process.join()
@@ -0,0 +1,218 @@
+# Dependency-aware planning of the computations of a post processor run
+
+import numpy as np
+from . import calc
+from .variable_def import get_variable, get_intermediates, get_vertical_coordinates
+from .precip import parse_window
+
+# calc function computing each group of output variables, in the default order
+_GROUPS = (
+    ('vertical variables', 'get_vertical_variables'),
+    ('precipitation variables', 'get_precip'),
+    ('temp_2m', 'get_temp_2m'),
+    ('dewpt_2m', 'get_dewpt_2m'),
+    ('q_2m', 'get_q_2m'),
+    ('u_10m', 'get_u_10m'),
+    ('v_10m', 'get_v_10m'),
+    ('wspd_10m', 'get_wspd_10m'),
+    ('mslp', 'get_mslp'),
+    ('UH', 'get_uh'),
+    ('cape and cin', 'get_cape'),
+    ('refl', 'get_dbz'),
+)
+
+
+def parse_variables(variables):
+    """
+    Splits a list of requested variables into variables on vertical levels and other
+    variables
+    :param variables: list of output variable names
+    :return: tuple of (vertical level variable list, other variable list)
+    """
+    iso_vars = []
+    other_vars = []
+    for variable in variables:
+        if get_variable(variable)['type'] == 1:
+            iso_vars.append(variable)
+        else:
+            other_vars.append(variable)
+    return iso_vars, other_vars
+
+
+def _group_arguments(label, outputs, levels):
+    """Gets the arguments of the calc function of a group"""
+    if label == 'vertical variables':
+        return (outputs, levels), {}
+    if label == 'precipitation variables':
+        return (), {'timestep': 'timestep_pcp' in outputs, 'total': 'tot_pcp' in outputs,
+                    'windows': [parse_window(name) for name in outputs
+                                if parse_window(name) is not None]}
+    return (), {}
+
+
+def get_node_bytes(data, name, ntimes=1):
+    """
+    Estimates the bytes of a raw field or intermediate held in memory
+    :param data: input netCDF4 Dataset
+    :param name: raw WRF field or wrf-python intermediate name
+    :param ntimes: number of time steps held
+    :return: integer number of bytes
+    """
+    intermediates = get_intermediates()
+    # fields and intermediates of a subset cover only its window
+    window = getattr(data, 'window', None)
+    ny = data.dimensions['south_north'].size
+    nx = data.dimensions['west_east'].size
+    fraction = 1. if window is None else np.prod(window.shape) / float(ny * nx)
+    if name in intermediates:
+        levels = intermediates[name]['levels']
+        if levels == 'model':
+            levels = data.dimensions['bottom_top'].size
+        # wrf-python diagnostics of float32 input are float32
+        return int(levels * ny * nx * 4 * ntimes * fraction)
+    var = data.variables[name]
+    return int(np.prod(var.shape[1:]) * var.dtype.itemsize * ntimes * fraction)
+
+
+class Plan(object):
+    """
+    Ordered steps of a post processor run. Each step is a dictionary of
+        label: name of the group of variables
+        func: calc function computing the group
+        args, kwargs: arguments of func before the output file, and keyword arguments
+        outputs: list of the requested output variables of the group
+        needs: list of the raw fields and intermediates the group uses
+        reads: list of the raw fields first read by the group
+        computes: list of the intermediates first computed by the group
+        release: list of the fields and intermediates no later step uses
+        live: estimated bytes per time step held after the step
+        peak: estimated bytes per time step held during the step
+    """
+    def __init__(self, steps, skipped=()):
+        self.steps = steps
+        self.skipped = list(skipped)
+
+    def __iter__(self):
+        return iter(self.steps)
+
+    def __len__(self):
+        return len(self.steps)
+
+    def peak_bytes(self, ntimes=1):
+        """Estimated peak bytes of fields and intermediates held for ntimes time steps"""
+        return max([step['peak'] for step in self.steps] + [0]) * ntimes
+
+    def describe(self, ntimes=1):
+        """
+        Describes the plan for printing
+        :param ntimes: number of time steps per slab
+        :return: string of one line per step and the estimated peak bytes
+        """
+        lines = ['Plan of {} steps for {} time steps per slab'.format(len(self.steps), ntimes)]
+        for i, step in enumerate(self.steps):
+            lines.append('{}. {}: {}'.format(i + 1, step['label'], ', '.join(step['outputs'])))
+            lines.append('    read: ' + (', '.join(step['reads']) or '-'))
+            lines.append('    compute: ' + (', '.join(step['computes']) or '-'))
+            lines.append('    free: ' + (', '.join(step['release']) or '-'))
+            lines.append('    estimated bytes: {} during, {} after'.format(
+                step['peak'] * ntimes, step['live'] * ntimes))
+        for name in self.skipped:
+            lines.append('No calculation for '+name+', skipped')
+        lines.append('Estimated peak bytes: {}'.format(self.peak_bytes(ntimes)))
+        return '\n'.join(lines)
+
+
+def make_plan(data, variables, plevs=None, order=True, levels=None):
+    """
+    Plans the computation of a list of variables. Each group of variables computed by one
+    calc function is a step, each raw field and intermediate is read or computed once by
+    the first step using it, and freed after the last step using it. Steps are ordered
+    greedily so the estimated bytes held at once stay low.
+    :param data: input netCDF4 Dataset
+    :param variables: list of output variable names
+    :param plevs: optional array of output pressure levels
+    :param order: True to reorder the steps, False to keep the default group order
+    :param levels: optional dictionary of vertical coordinate name to levels, see
+        variable_def.get_vertical_coordinates. plevs adds the pressure levels.
+    :return: Plan
+    """
+    intermediates = get_intermediates()
+    coordinates = get_vertical_coordinates()
+    levels = dict(levels or {})
+    if plevs is not None:
+        levels['pressure'] = plevs
+    # keep the coordinates in output order
+    levels = {name: levels[name] for name in coordinates if name in levels}
+    outputs = {}
+    skipped = []
+    for name in variables:
+        definition = get_variable(name)
+        if definition['group'] is None:
+            skipped.append(name)
+        else:
+            outputs.setdefault(definition['group'], []).append(name)
+
+    steps = []
+    for label, func_name in _GROUPS:
+        if label not in outputs:
+            continue
+        needs = []
+        # raw fields the calc function reads itself, rather than through an intermediate
+        fields = []
+        for name in outputs[label]:
+            definition = get_variable(name)
+            for inter in definition['intermediates']:
+                needs.extend(intermediates[inter]['fields'] + (inter,))
+            needs.extend(definition['fields'])
+            fields.extend(definition['fields'])
+        if label == 'vertical variables':
+            # every coordinate is computed once for all variables of the group
+            for name in levels:
+                inter = coordinates[name]['intermediate']
+                if inter is not None:
+                    needs.extend(intermediates[inter]['fields'] + (inter,) +
+                                 coordinates[name]['fields'])
+                    fields.extend(coordinates[name]['fields'])
+        # fields a file does not have, such as QSNOW, are never read
+        needs = [name for name in dict.fromkeys(needs)
+                 if name in intermediates or name in data.variables]
+        fields = [name for name in dict.fromkeys(fields) if name in data.variables]
+        args, kwargs = _group_arguments(label, outputs[label], levels)
+        steps.append({'label': label, 'func': getattr(calc, func_name), 'args': args,
+                      'kwargs': kwargs, 'outputs': outputs[label], 'needs': needs,
+                      'fields': fields})
+
+    sizes = {}
+    for step in steps:
+        for name in step['needs']:
+            if name not in sizes:
+                sizes[name] = get_node_bytes(data, name)
+
+    # pick each next step by the smallest bytes held during and after it
+    ordered = []
+    live = set()
+    remaining = list(steps)
+    while remaining:
+        best = None
+        for i, step in enumerate(remaining):
+            later = set(name for other in remaining if other is not step
+                        for name in other['needs'])
+            held = live | set(step['needs'])
+            after = set(name for name in held if name in later)
+            key = (sum(sizes[name] for name in held), sum(sizes[name] for name in after), i)
+            if best is None or key < best[0]:
+                best = (key, step, held, after)
+            if not order:
+                break
+        key, step, held, after = best
+        remaining.remove(step)
+        step['reads'] = [name for name in step['needs']
+                         if name not in live and name not in intermediates]
+        step['computes'] = [name for name in step['needs']
+                            if name not in live and name in intermediates]
+        step['release'] = sorted(held - after)
+        step['peak'] = key[0]
+        step['live'] = key[1]
+        live = after
+        ordered.append(step)
+    return Plan(ordered, skipped)
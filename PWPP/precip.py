@@ -0,0 +1,80 @@
+# Precipitation accumulation from the cumulative WRF precipitation fields
+
+import re
+import numpy as np
+
+# cumulative fields that reset to zero on passing bucket_mm, and their bucket counters
+_BUCKET_COUNTERS = {
+    'RAINNC': 'I_RAINNC',
+    'RAINC': 'I_RAINC',
+}
+
+
+def parse_window(variable):
+    """
+    Gets the accumulation window of a windowed precipitation variable name such as pcp_3h
+    :param variable: output variable name
+    :return: window length in hours, or None if the name is not a precipitation window
+    """
+    match = re.match(r'^pcp_([0-9]+)h$', variable)
+    if match is None or int(match.group(1)) < 1:
+        return None
+    return int(match.group(1))
+
+
+def get_bucket(data, name):
+    """
+    Gets the precipitation bucket of a cumulative field
+    :param data: input netCDF4 Dataset
+    :param name: WRF variable name
+    :return: tuple of bucket size in mm and bucket counter variable name, or (None, None)
+        if the field is not bucketed
+    """
+    counter = _BUCKET_COUNTERS.get(name)
+    if counter is None or counter not in data.variables or 'BUCKET_MM' not in data.ncattrs():
+        return None, None
+    bucket = float(data.getncattr('BUCKET_MM'))
+    if bucket <= 0:
+        return None, None
+    return bucket, counter
+
+
+def get_valid_seconds(data):
+    """Gets the valid times of the input as seconds since its first time"""
+    from netCDF4 import chartostring
+    times = chartostring(data.variables['Times'][:])
+    times = np.array([str(time).replace('_', 'T') for time in np.atleast_1d(times)],
+                     dtype='datetime64[s]')
+    return (times - times[0]).astype('i8')
+
+
+def get_window_starts(seconds, steps, window):
+    """
+    Gets the time step each window accumulation starts from
+    :param seconds: valid time of each input step in seconds
+    :param steps: array of output time step indices
+    :param window: window length in seconds
+    :return: array of start step indices, -1 where the window starts before the input
+        or at a time that is not an input time
+    """
+    target = seconds[steps] - window
+    starts = np.searchsorted(seconds, target)
+    starts = np.minimum(starts, len(seconds) - 1)
+    return np.where(seconds[starts] == target, starts, -1)
+
+
+def accumulate(cumulative, rows, steps, starts):
+    """
+    Differences a cumulative field over many windows in one vectorized pass
+    :param cumulative: array of cumulative values with time on axis 0
+    :param rows: sorted array of the input time step of each row of cumulative
+    :param steps: array of output time step indices
+    :param starts: array of start step indices, -1 for missing windows
+    :return: array of accumulations, NaN for missing windows
+    """
+    values = (cumulative[np.searchsorted(rows, steps)] -
+              cumulative[np.searchsorted(rows, np.maximum(starts, rows[0]))])
+    if (starts < 0).any():
+        values = values.astype(np.result_type(values.dtype, np.float32))
+        values[starts < 0] = np.nan
+    return values
@@ -0,0 +1,156 @@
+# Streaming maximum and minimum reductions of output fields over time
+
+import re
+import numpy as np
+
+# elementwise reductions, leaving out missing values
+_OPERATIONS = {'max': np.fmax, 'min': np.fmin}
+
+_DESCRIPTIONS = {'max': 'maximum', 'min': 'minimum'}
+
+
+def parse_reduction(variable):
+    """
+    Gets the variable, operation, and window of a reduction name such as UH_max_1h or
+    mslp_min
+    :param variable: output variable name
+    :return: tuple of (reduced variable, 'max' or 'min', window length in hours or None for
+        the whole run), or None if the name is not a reduction
+    """
+    match = re.match(r'^(.+)_(max|min)(?:_([0-9]+)h)?$', variable)
+    if match is None:
+        return None
+    if match.group(3) is None:
+        return match.group(1), match.group(2), None
+    if int(match.group(3)) < 1:
+        return None
+    return match.group(1), match.group(2), int(match.group(3))
+
+
+class Reducer(object):
+    """
+    Running maximum and minimum of fields as the slabs of a run are written, so the
+    reductions need no second pass over the output. Window reductions are time series
+    of the reduction over the output times of the previous window hours, missing where
+    the window starts before the first time. Run reductions are 2D fields over every time
+    written so far.
+
+    The reductions are taken at each grid point, so on a moving domain they follow the
+    grid rather than fixed locations.
+    """
+    def __init__(self, reductions, seconds, write_fields=()):
+        """
+        :param reductions: list of (output name, reduced field name, operation, hours)
+            tuples, with hours None for run reductions
+        :param seconds: array of the valid time of each input step in seconds
+        :param write_fields: reduced field names also written themselves. Other reduced
+            fields are written only as their reductions.
+        """
+        self.reductions = list(reductions)
+        self.seconds = np.asarray(seconds)
+        self.write_fields = set(write_fields)
+        self.fields = set(reduction[1] for reduction in self.reductions)
+        self.totals = {}
+        self._history = {}
+        self._first = {}
+        # seconds of history each field keeps for its longest window
+        self._keep = {}
+        for _, field, _, hours in self.reductions:
+            if hours is not None:
+                self._keep[field] = max(self._keep.get(field, 0), hours * 3600)
+
+    def preload(self, dataset, start):
+        """
+        Continues the reductions of an output file written up to a time step, from the
+        fields and run reductions it holds
+        :param dataset: output netCDF4 Dataset on the input grid
+        :param start: first time step still to write
+        """
+        for name, field, _, hours in self.reductions:
+            if hours is None and name in dataset.variables:
+                self.totals[name] = np.ma.filled(
+                    np.ma.asarray(dataset.variables[name][:], dtype='f8'), np.nan)
+        for field, keep in self._keep.items():
+            if start == 0 or field not in dataset.variables:
+                continue
+            steps = np.flatnonzero(self.seconds[:start] > self.seconds[start] - keep)
+            if steps.size == 0:
+                continue
+            values = dataset.variables[field][steps[0]:start]
+            self._history[field] = dict(zip(steps, np.ma.filled(
+                np.ma.asarray(values, dtype='f8'), np.nan)))
+            self._first[field] = steps[0]
+
+    def update(self, outfile, name, values, dtype, dims, units, description, tslice=None):
+        """
+        Updates the reductions of a field with a slab and writes them, with the arguments
+        of output.OutputFile.write
+        """
+        values = np.ma.filled(np.ma.asarray(values, dtype='f8'), np.nan)
+        start = 0 if tslice is None else tslice.start
+        steps = np.arange(start, start + values.shape[0])
+        history = self._history.setdefault(name, {})
+        history.update(zip(steps, values))
+        first = self._first.setdefault(name, start)
+        # the window of a time is complete when it starts at or after the step before the
+        # earliest one held
+        covered = self.seconds[first - 1] if first > 0 else self.seconds[0]
+
+        for out_name, field, op, hours in self.reductions:
+            if field != name:
+                continue
+            reduce = _OPERATIONS[op]
+            if hours is None:
+                total = reduce.reduce(values, axis=0)
+                if out_name in self.totals:
+                    total = reduce(self.totals[out_name], total)
+                self.totals[out_name] = total
+                outfile.write(out_name, total, dtype, dims[1:], units,
+                              'Run ' + _DESCRIPTIONS[op] + ' of ' + description,
+                              slice(steps[-1], steps[-1] + 1))
+                continue
+            window = hours * 3600
+            reduced = np.full(values.shape, np.nan)
+            for i, step in enumerate(steps):
+                begin = self.seconds[step] - window
+                if begin < covered:
+                    continue
+                held = [history[k] for k in history if self.seconds[k] > begin and k <= step]
+                reduced[i] = reduce.reduce(np.stack(held), axis=0)
+            outfile.write(out_name, reduced, dtype, dims, units,
+                          str(hours) + ' hour ' + _DESCRIPTIONS[op] + ' of ' + description,
+                          tslice)
+
+        # keep only the steps later windows can reach
+        keep = self._keep.get(name, 0)
+        for step in list(history):
+            if self.seconds[step] <= self.seconds[steps[-1]] - keep:
+                del history[step]
+
+    def get_state(self):
+        """Gets the running state as a dictionary of arrays, see set_state"""
+        state = {}
+        for name, total in self.totals.items():
+            state['total:' + name] = total
+        for field, history in self._history.items():
+            state['first:' + field] = np.array(self._first[field])
+            for step, values in history.items():
+                state['history:' + field + ':' + str(step)] = values
+        return state
+
+    def set_state(self, state):
+        """
+        Restores the running state of an interrupted run
+        :param state: dictionary of arrays from get_state
+        """
+        self.totals = {}
+        self._history = {}
+        self._first = {}
+        for key, values in state.items():
+            parts = key.split(':')
+            if parts[0] == 'total':
+                self.totals[parts[1]] = values
+            elif parts[0] == 'first':
+                self._first[parts[1]] = int(values)
+            else:
+                self._history.setdefault(parts[1], {})[int(parts[2])] = values
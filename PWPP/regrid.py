@@ -0,0 +1,262 @@
+# Regridding of output fields to regular latitude-longitude grids
+
+import hashlib
+import os
+import numpy as np
+from scipy import sparse
+from scipy.spatial import cKDTree
+
+_METHODS = ('nearest', 'bilinear')
+
+# default directory of cached regridding weights and station indices
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'PWPP')
+
+# tolerance of the cell coordinates of points on cell edges
+_EPS = 1e-6
+
+
+def get_regular_grid(grid):
+    """
+    Gets the latitudes and longitudes of a regular grid
+    :param grid: tuple of (lat_min, lat_max, lon_min, lon_max, resolution) in degrees
+    :return: tuple of 1D latitude and longitude arrays
+    """
+    lat_min, lat_max, lon_min, lon_max, resolution = grid
+    if resolution <= 0 or lat_max < lat_min or lon_max < lon_min:
+        raise ValueError('Invalid regular grid '+str(grid))
+    nlat = int(round((lat_max - lat_min) / resolution)) + 1
+    nlon = int(round((lon_max - lon_min) / resolution)) + 1
+    return (lat_min + resolution * np.arange(nlat),
+            lon_min + resolution * np.arange(nlon))
+
+
+def to_xyz(lat, lon):
+    """Converts latitude and longitude in degrees to points on the unit sphere"""
+    lat = np.radians(lat)
+    lon = np.radians(lon)
+    return np.column_stack((np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon),
+                            np.sin(lat)))
+
+
+def _cell_coordinates(lat, lon, j, i, tlat, tlon, iterations=8):
+    """
+    Finds the position of target points in grid cells by inverting bilinear interpolation
+    in a plane tangent at each target
+    :param lat: 2D array of source latitudes
+    :param lon: 2D array of source longitudes
+    :param j: array of south_north index of the lower left corner of each cell
+    :param i: array of west_east index of the lower left corner of each cell
+    :param tlat: array of target latitudes
+    :param tlon: array of target longitudes
+    :return: tuple of west_east and south_north cell coordinates and whether each target
+        is inside its cell
+    """
+    scale = np.cos(np.radians(tlat))
+
+    def local(jj, ii):
+        x = ((lon[jj, ii] - tlon + 180.) % 360. - 180.) * scale
+        return np.stack((x, lat[jj, ii] - tlat))
+
+    p00 = local(j, i)
+    a = local(j, i + 1) - p00
+    b = local(j + 1, i) - p00
+    c = local(j + 1, i + 1) - p00 - a - b
+    s = np.full(tlat.shape, 0.5)
+    t = np.full(tlat.shape, 0.5)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for _ in range(iterations):
+            f = p00 + s * a + t * b + s * t * c
+            ds_col = a + t * c
+            dt_col = b + s * c
+            det = ds_col[0] * dt_col[1] - dt_col[0] * ds_col[1]
+            s = s - (f[0] * dt_col[1] - dt_col[0] * f[1]) / det
+            t = t - (ds_col[0] * f[1] - f[0] * ds_col[1]) / det
+        inside = ((s >= -_EPS) & (s <= 1 + _EPS) & (t >= -_EPS) & (t <= 1 + _EPS))
+    return np.clip(s, 0, 1), np.clip(t, 0, 1), inside
+
+
+def compute_weights(lat, lon, target_lats, target_lons, method='bilinear'):
+    """
+    Computes the sparse matrix remapping a curvilinear grid to a regular grid. Each target
+    point is located in a source cell among the cells around its nearest source point.
+    Target points outside the source grid have no weights.
+    :param lat: 2D array of source latitudes
+    :param lon: 2D array of source longitudes
+    :param target_lats: 1D array of target latitudes
+    :param target_lons: 1D array of target longitudes
+    :param method: 'nearest' or 'bilinear'
+    :return: scipy.sparse CSR matrix of shape (target points, source points)
+    """
+    if method not in _METHODS:
+        raise ValueError('Unknown regridding method '+str(method))
+    ny, nx = np.shape(lat)
+    tlat, tlon = np.meshgrid(target_lats, target_lons, indexing='ij')
+    tlat = tlat.ravel()
+    tlon = tlon.ravel()
+    nearest, found, j0, i0, s, t = locate_cells(lat, lon, tlat, tlon)
+
+    rows = np.flatnonzero(found)
+    if method == 'nearest':
+        cols = nearest[rows]
+        values = np.ones(rows.size)
+    else:
+        j0 = j0[rows]
+        i0 = i0[rows]
+        s = s[rows]
+        t = t[rows]
+        cols = np.concatenate((j0 * nx + i0, j0 * nx + i0 + 1, (j0 + 1) * nx + i0,
+                               (j0 + 1) * nx + i0 + 1))
+        values = np.concatenate(((1 - s) * (1 - t), s * (1 - t), (1 - s) * t, s * t))
+        rows = np.tile(rows, 4)
+    weights = sparse.csr_matrix((values, (rows, cols)), shape=(tlat.size, ny * nx))
+    # corners without weight must not spread missing values
+    weights.eliminate_zeros()
+    return weights
+
+
+def locate_cells(lat, lon, tlat, tlon):
+    """
+    Finds the grid cell holding each target point and its position in the cell, among the
+    cells around its nearest grid point
+    :param lat: 2D array of source latitudes
+    :param lon: 2D array of source longitudes
+    :param tlat: 1D array of target latitudes
+    :param tlon: 1D array of target longitudes
+    :return: tuple of the flat index of the nearest grid point, whether each target is
+        inside the grid, the south_north and west_east indices of the lower left corner of
+        its cell, and its west_east and south_north cell coordinates from 0 to 1
+    """
+    lat = np.asarray(lat, dtype='f8')
+    lon = np.asarray(lon, dtype='f8')
+    ny, nx = lat.shape
+    tree = cKDTree(to_xyz(lat.ravel(), lon.ravel()))
+    _, nearest = tree.query(to_xyz(tlat, tlon))
+    jn, in_ = np.divmod(nearest, nx)
+
+    # the cell holding a target has the nearest source point as a corner
+    j0 = np.zeros(tlat.size, dtype=int)
+    i0 = np.zeros(tlat.size, dtype=int)
+    s = np.zeros(tlat.size)
+    t = np.zeros(tlat.size)
+    found = np.zeros(tlat.size, dtype=bool)
+    for dj in (-1, 0):
+        for di in (-1, 0):
+            todo = np.flatnonzero(~found)
+            cj = np.clip(jn[todo] + dj, 0, ny - 2)
+            ci = np.clip(in_[todo] + di, 0, nx - 2)
+            cs, ct, inside = _cell_coordinates(lat, lon, cj, ci, tlat[todo], tlon[todo])
+            hit = todo[inside]
+            j0[hit] = cj[inside]
+            i0[hit] = ci[inside]
+            s[hit] = cs[inside]
+            t[hit] = ct[inside]
+            found[hit] = True
+    return nearest, found, j0, i0, s, t
+
+
+def grid_hash(lat, lon, target_lats, target_lons, method):
+    """Gets a key identifying the weights of a source grid, target grid, and method"""
+    digest = hashlib.sha1(method.encode())
+    for values in (lat, lon, target_lats, target_lons):
+        values = np.ascontiguousarray(values, dtype='f8')
+        digest.update(str(values.shape).encode())
+        digest.update(values.tobytes())
+    return digest.hexdigest()
+
+
+class Regridder(object):
+    """
+    Remaps fields from the WRF grid to a regular latitude-longitude grid with a sparse
+    matrix multiply. The weights of each source grid are computed once and saved in a
+    cache directory under a hash of the grids, so later runs on the same domain load them
+    instead. A moving domain has weights for each distinct grid.
+    """
+    # weights shared by every regridder of the process, set to a dictionary by long
+    # running servers so later runs on the same domain neither compute nor load them
+    shared = None
+
+    def __init__(self, target_lats, target_lons, method='bilinear', cache_dir=None):
+        """
+        :param target_lats: 1D array of target latitudes
+        :param target_lons: 1D array of target longitudes
+        :param method: 'nearest' or 'bilinear'
+        :param cache_dir: directory of cached weights. Default is ~/.cache/PWPP.
+        """
+        if method not in _METHODS:
+            raise ValueError('Unknown regridding method '+str(method))
+        self.target_lats = np.asarray(target_lats, dtype='f8')
+        self.target_lons = np.asarray(target_lons, dtype='f8')
+        self.method = method
+        self.cache_dir = CACHE_DIR if cache_dir is None else cache_dir
+        self.built = 0
+        self.loaded = 0
+        self._weights = {} if self.shared is None else self.shared
+        self._steps = {}
+
+    @property
+    def shape(self):
+        """Shape of the target grid"""
+        return self.target_lats.size, self.target_lons.size
+
+    def get_weights(self, lat, lon):
+        """
+        Gets the weights of a source grid, from memory, the cache directory, or computed
+        :param lat: 2D array of source latitudes
+        :param lon: 2D array of source longitudes
+        :return: scipy.sparse CSR matrix of weights
+        """
+        key = grid_hash(lat, lon, self.target_lats, self.target_lons, self.method)
+        if key in self._weights:
+            return self._weights[key]
+        path = os.path.join(self.cache_dir, key + '.npz')
+        if os.path.exists(path):
+            weights = sparse.load_npz(path).tocsr()
+            self.loaded += 1
+        else:
+            weights = compute_weights(lat, lon, self.target_lats, self.target_lons,
+                                      self.method)
+            self.built += 1
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # write then rename, so concurrent runs never read a partial file
+            tmp = os.path.join(self.cache_dir, key + '.' + str(os.getpid()) + '.npz')
+            sparse.save_npz(tmp, weights)
+            os.replace(tmp, path)
+        self._weights[key] = weights
+        return weights
+
+    def set_grids(self, lat, lon, tslice=None):
+        """
+        Sets the source grid of each time step of a slab
+        :param lat: array of source latitudes with time on axis 0
+        :param lon: array of source longitudes with time on axis 0
+        :param tslice: slice of time steps, or None for all times
+        """
+        start = 0 if tslice is None else tslice.start
+        self._steps = {}
+        for i in range(lat.shape[0]):
+            self._steps[start + i] = self.get_weights(lat[i], lon[i])
+
+    def apply(self, values, tslice=None):
+        """
+        Remaps a field of a slab set with set_grids
+        :param values: array with time on axis 0 and the horizontal dimensions last
+        :param tslice: slice of time steps, or None for all times
+        :return: float64 array on the target grid, NaN outside the source grid
+        """
+        values = np.ma.filled(np.ma.asarray(values, dtype='f8'), np.nan)
+        start = 0 if tslice is None else tslice.start
+        ntimes = values.shape[0]
+        out = np.empty(values.shape[:-2] + self.shape)
+        i = 0
+        while i < ntimes:
+            # steps sharing a grid are remapped in one multiply
+            weights = self._steps[start + i]
+            end = i + 1
+            while end < ntimes and self._steps[start + end] is weights:
+                end += 1
+            flat = values[i:end].reshape(-1, values.shape[-2] * values.shape[-1])
+            remapped = weights.dot(flat.T).T
+            remapped[:, np.diff(weights.indptr) == 0] = np.nan
+            out[i:end] = remapped.reshape(out[i:end].shape)
+            i = end
+        return out
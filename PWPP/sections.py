@@ -0,0 +1,167 @@
+# Extraction of vertical cross-sections along paths and soundings at sites
+
+import numpy as np
+from netCDF4 import stringtochar
+from .regrid import locate_cells, to_xyz
+from .stations import StationIndex, read_stations, _EARTH_RADIUS
+
+
+def read_paths(paths):
+    """
+    Reads cross-section paths and sounding sites
+    :param paths: path of a CSV file of id, lat, lon rows with an optional header, the rows
+        of an id being the vertices of its path in order, or list of (id, list of (lat,
+        lon) vertices) tuples. A path of one vertex is a sounding site.
+    :return: list of (id, array of vertex latitudes, array of vertex longitudes) tuples
+    """
+    if isinstance(paths, str):
+        vertices = {}
+        for name, lat, lon in zip(*read_stations(paths)):
+            vertices.setdefault(name, []).append((lat, lon))
+        paths = list(vertices.items())
+    out = []
+    for name, points in paths:
+        points = np.array(points, dtype='f8').reshape(-1, 2)
+        if points.shape[0] == 0:
+            raise ValueError('Path '+str(name)+' has no vertices')
+        out.append((str(name), points[:, 0], points[:, 1]))
+    if len(out) == 0:
+        raise ValueError('No paths given')
+    return out
+
+
+def get_path_points(lats, lons, spacing):
+    """
+    Gets points spaced evenly along the great circle segments of a path
+    :param lats: array of vertex latitudes
+    :param lons: array of vertex longitudes
+    :param spacing: distance in meters between points, shortened so the points end on
+        the last vertex
+    :return: tuple of arrays of point latitudes, longitudes, and distances along the path
+        in meters
+    """
+    xyz = to_xyz(lats, lons)
+    if xyz.shape[0] == 1:
+        return np.array(lats, dtype='f8'), np.array(lons, dtype='f8'), np.zeros(1)
+    angles = np.arccos(np.clip(np.sum(xyz[:-1] * xyz[1:], axis=1), -1., 1.))
+    cumulative = np.concatenate(([0.], np.cumsum(angles))) * _EARTH_RADIUS
+    npoints = max(int(round(cumulative[-1] / spacing)), 1) + 1
+    distances = np.linspace(0., cumulative[-1], npoints)
+    segment = np.clip(np.searchsorted(cumulative, distances, side='right') - 1, 0,
+                      angles.size - 1)
+    angle = angles[segment]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fraction = np.where(angle > 0, (distances - cumulative[segment]) /
+                            (angle * _EARTH_RADIUS), 0.)
+        # spherical linear interpolation between the vertices of each segment
+        sin = np.sin(angle)
+        start = np.where(sin > 0, np.sin((1 - fraction) * angle) / sin, 1 - fraction)
+        end = np.where(sin > 0, np.sin(fraction * angle) / sin, fraction)
+    points = start[:, np.newaxis] * xyz[segment] + end[:, np.newaxis] * xyz[segment + 1]
+    points /= np.linalg.norm(points, axis=1)[:, np.newaxis]
+    return (np.degrees(np.arcsin(np.clip(points[:, 2], -1., 1.))),
+            np.degrees(np.arctan2(points[:, 1], points[:, 0])), distances)
+
+
+class PathIndex(StationIndex):
+    """
+    Points spaced evenly along cross-section paths, and sounding sites, with the 4 grid
+    columns around each point and their bilinear weights. The columns are found once per
+    distinct grid and cached like station columns, under a hash of the grid and points.
+
+    The corner columns of every point are gathered into the pseudo-grid, so column
+    diagnostics are computed at those columns only, and fields are interpolated to the
+    points as they are written. Points outside the grid are missing in the output.
+    """
+    dim = 'point'
+    corners = 4
+    _fields = ('flat', 'weights', 'inside')
+
+    def __init__(self, paths, spacing, cache_dir=None):
+        """
+        :param paths: list of (id, vertex latitudes, vertex longitudes) tuples, see
+            read_paths
+        :param spacing: distance in meters between the points of a path
+        :param cache_dir: directory of cached indices. Default is ~/.cache/PWPP.
+        """
+        if spacing is None or spacing <= 0:
+            raise ValueError('Path point spacing must be positive')
+        points = [get_path_points(lats, lons, spacing) for _, lats, lons in paths]
+        self.path_ids = [path[0] for path in paths]
+        self.path = np.concatenate([np.full(point[0].size, i, dtype='i4')
+                                    for i, point in enumerate(points)])
+        self.distance = np.concatenate([point[2] for point in points])
+        self.spacing = spacing
+        ids = [self.path_ids[i] for i in self.path]
+        super(PathIndex, self).__init__(ids, np.concatenate([point[0] for point in points]),
+                                        np.concatenate([point[1] for point in points]),
+                                        cache_dir=cache_dir)
+
+    def locate(self, lat, lon):
+        """
+        Finds the corner columns of the points on a grid
+        :param lat: 2D array of grid latitudes
+        :param lon: 2D array of grid longitudes
+        :return: tuple of flat grid indices of the corners of every point, corner by
+            corner, the array of the 4 bilinear weights of each point, and whether each
+            point is inside the grid
+        """
+        nx = np.shape(lat)[1]
+        nearest, inside, j0, i0, s, t = locate_cells(lat, lon, self.lats, self.lons)
+        flat = np.concatenate((j0 * nx + i0, j0 * nx + i0 + 1, (j0 + 1) * nx + i0,
+                               (j0 + 1) * nx + i0 + 1))
+        # points outside the grid keep their nearest column, without weight, so the window
+        # of the columns stays around the points
+        flat = np.where(np.tile(inside, 4), flat, np.tile(nearest, 4))
+        weights = np.stack(((1 - s) * (1 - t), s * (1 - t), (1 - s) * t, s * t))
+        weights[:, ~inside] = 0.
+        return flat, weights, inside
+
+    def apply(self, values, tslice=None):
+        """
+        Interpolates a field on the pseudo-grid to the points for the output
+        :param values: array with time on axis 0 and the layout dimensions last
+        :param tslice: slice of time steps, or None for all times
+        :return: array with point on axis 0 and time on axis 1, NaN outside the grid
+        """
+        npoints = len(self.ids)
+        values = np.ma.filled(np.ma.asarray(values, dtype='f8'), np.nan)
+        values = values.reshape(values.shape[:-2] + (-1,))[..., :self.corners * npoints]
+        values = values.reshape(values.shape[:-1] + (self.corners, npoints))
+        start = 0 if tslice is None else tslice.start
+        out = []
+        for i in range(values.shape[0]):
+            _, weights, inside = self._steps[start + i]
+            # corners without weight must not spread missing values
+            point = np.sum(np.where(weights > 0, values[i] * weights, 0.), axis=-2)
+            point[..., ~inside] = np.nan
+            out.append(point)
+        return np.moveaxis(np.stack(out), -1, 0)
+
+
+def write_paths(dataset, paths):
+    """
+    Writes the coordinates of the points and the ids of their paths
+    :param dataset: output netCDF4 Dataset with the point dimension
+    :param paths: PathIndex
+    """
+    strlen = max(len(name) for name in paths.path_ids)
+    dataset.createDimension('path', len(paths.path_ids))
+    dataset.createDimension('name_strlen', strlen)
+    path_id = dataset.createVariable('path_id', 'S1', ('path', 'name_strlen'))
+    path_id.long_name = 'path or sounding site identifier'
+    path_id[:] = stringtochar(np.array(paths.path_ids, dtype='S'+str(strlen)))
+    point_path = dataset.createVariable('point_path', 'i4', ('point',))
+    point_path.long_name = 'index of the path of each point'
+    point_path[:] = paths.path
+    distance = dataset.createVariable('distance', 'f8', ('point',))
+    distance.units = 'm'
+    distance.long_name = 'distance along the path'
+    distance[:] = paths.distance
+    for name, values, units in (('latitude', paths.lats, 'degrees_north'),
+                                ('longitude', paths.lons, 'degrees_east')):
+        var = dataset.createVariable(name, 'f8', ('point',))
+        var.standard_name = name
+        var.units = units
+        var[:] = values
+    dataset.path_spacing = paths.spacing
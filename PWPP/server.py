@@ -0,0 +1,301 @@
+# Long running post processing server keeping the libraries and caches warm
+
+import argparse
+import json
+import os
+import socket
+import socketserver
+import sys
+import threading
+import time
+from multiprocessing import Pool
+
+DEFAULT_ADDRESS = os.path.join(os.path.expanduser('~'), '.cache', 'PWPP', 'server.sock')
+
+# number of grids of weights and station columns each worker keeps between jobs
+_MAX_GRIDS = 64
+
+
+def parse_address(address=None):
+    """
+    Parses a server address
+    :param address: path of a Unix socket, or 'host:port' of a local TCP socket. Default
+        is DEFAULT_ADDRESS.
+    :return: tuple of the socket family and its address
+    """
+    address = DEFAULT_ADDRESS if address is None else str(address)
+    host, _, port = address.rpartition(':')
+    if host and port.isdigit() and os.sep not in address:
+        return socket.AF_INET, (host, int(port))
+    return socket.AF_UNIX, address
+
+
+def encode(value):
+    """Converts keyword argument values, including unit quantities, to JSON types"""
+    if hasattr(value, 'magnitude') and hasattr(value, 'units'):
+        return {'__quantity__': [encode(value.magnitude), str(value.units)]}
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    if isinstance(value, dict):
+        return {key: encode(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [encode(item) for item in value]
+    return value
+
+
+def decode(value):
+    """Converts values from encode back, with unit quantities as MetPy quantities"""
+    if isinstance(value, dict):
+        if '__quantity__' in value:
+            import numpy as np
+            from metpy.units import units
+            magnitude, unit = value['__quantity__']
+            return units.Quantity(np.asarray(magnitude, dtype='f8'), unit)
+        return {key: decode(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [decode(item) for item in value]
+    return value
+
+
+def _init_worker(max_grids):
+    """Imports the post processor once per worker and keeps its caches between jobs"""
+    global _MAX_GRIDS
+    from .PWPP import wrfpost  # noqa: F401
+    from .regrid import Regridder
+    from .stations import StationIndex
+    _MAX_GRIDS = max_grids
+    Regridder.shared = {}
+    StationIndex.shared = {}
+
+
+def check_job(job):
+    """
+    Checks that a job can run in a daemonic worker process, which cannot start processes
+    of its own
+    :param job: dictionary of the inname, outname, variables, and kwargs of wrfpost
+    :return: error string, or None if the job can run
+    """
+    kwargs = job.get('kwargs', {})
+    names = []
+    for name in ('workers', 'compress_workers'):
+        if (kwargs.get(name) or 1) > 1:
+            names.append(name)
+    for name in ('tiles', 'pipeline'):
+        if kwargs.get(name) not in (None, False):
+            names.append(name)
+    if names:
+        return 'Server jobs cannot start worker processes, remove '+', '.join(names)
+    return None
+
+
+def _run_job(job):
+    """Runs wrfpost for a job in a worker"""
+    from .PWPP import wrfpost
+    from .regrid import Regridder
+    from .stations import StationIndex
+    start = time.time()
+    kwargs = dict(decode(job.get('kwargs', {})))
+    kwargs.setdefault('verbose', False)
+    wrfpost(job['inname'], job['outname'], job['variables'], **kwargs)
+    for shared in (Regridder.shared, StationIndex.shared):
+        if shared is not None and len(shared) > _MAX_GRIDS:
+            shared.clear()
+    return {'outname': job['outname'], 'seconds': time.time() - start, 'pid': os.getpid()}
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    """Reads one JSON request line and writes one JSON response line"""
+    def handle(self):
+        try:
+            message = json.loads(self.rfile.readline().decode())
+            response = self.server.pwpp.handle(message)
+        except Exception as err:
+            response = {'ok': False, 'error': repr(err)}
+        self.wfile.write((json.dumps(response) + '\n').encode())
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class _TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class Server(object):
+    """
+    Post processing server. A pool of worker processes imports wrf-python, MetPy, and
+    netCDF4 once and keeps regridding weights and station columns in memory between
+    jobs, so small runs do not pay the startup cost. Jobs wait in a queue bounded by
+    queue_size for a free worker, and are refused while the queue is full.
+
+    Jobs run in daemonic worker processes, so jobs using the workers, tiles, pipeline, or
+    compress_workers options of wrfpost are refused.
+    """
+    def __init__(self, address=None, workers=None, queue_size=16, max_grids=64):
+        """
+        :param address: Unix socket path or 'host:port'. Default is DEFAULT_ADDRESS.
+        :param workers: number of worker processes. Default is the number of CPUs.
+        :param queue_size: number of jobs that may wait for a worker
+        :param max_grids: number of grids of cached weights each worker keeps
+        """
+        self.family, self.address = parse_address(address)
+        self.workers = workers or os.cpu_count() or 1
+        self._slots = threading.BoundedSemaphore(self.workers + queue_size)
+        self._lock = threading.Lock()
+        self.counts = {'submitted': 0, 'running': 0, 'completed': 0, 'failed': 0,
+                       'refused': 0}
+        if self.family == socket.AF_UNIX:
+            directory = os.path.dirname(os.path.abspath(self.address))
+            os.makedirs(directory, exist_ok=True)
+            # a socket file left by a server that did not exit cleanly
+            if os.path.exists(self.address):
+                os.remove(self.address)
+            self._server = _UnixServer(self.address, _Handler)
+        else:
+            self._server = _TCPServer(self.address, _Handler)
+        self._server.pwpp = self
+        self._pool = Pool(self.workers, initializer=_init_worker, initargs=(max_grids,))
+
+    def handle(self, message):
+        """
+        Handles a request
+        :param message: dictionary with op 'submit', 'status', or 'shutdown'
+        :return: response dictionary with ok True, or False and an error
+        """
+        op = message.get('op')
+        if op == 'status':
+            with self._lock:
+                return dict(self.counts, ok=True, workers=self.workers, pid=os.getpid())
+        if op == 'shutdown':
+            threading.Thread(target=self._server.shutdown).start()
+            return {'ok': True}
+        if op != 'submit':
+            return {'ok': False, 'error': 'Unknown request '+str(op)}
+        error = check_job(message.get('job', {}))
+        if error is not None:
+            return {'ok': False, 'error': error}
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.counts['refused'] += 1
+            return {'ok': False, 'error': 'Job queue is full'}
+        try:
+            with self._lock:
+                self.counts['submitted'] += 1
+                self.counts['running'] += 1
+            try:
+                result = self._pool.apply_async(_run_job, (message['job'],)).get()
+            except Exception as err:
+                with self._lock:
+                    self.counts['failed'] += 1
+                return {'ok': False, 'error': repr(err)}
+            with self._lock:
+                self.counts['completed'] += 1
+            return dict(result, ok=True)
+        finally:
+            with self._lock:
+                self.counts['running'] -= 1
+            self._slots.release()
+
+    def serve_forever(self):
+        """Serves requests until a shutdown request, then stops the workers"""
+        try:
+            self._server.serve_forever()
+        finally:
+            self.close()
+
+    def close(self):
+        """Stops the workers and removes the socket"""
+        self._server.server_close()
+        self._pool.close()
+        self._pool.join()
+        if self.family == socket.AF_UNIX and os.path.exists(self.address):
+            os.remove(self.address)
+
+
+def request(message, address=None, timeout=None):
+    """
+    Sends a request to a server
+    :param message: request dictionary, see Server.handle
+    :param address: Unix socket path or 'host:port'. Default is DEFAULT_ADDRESS.
+    :param timeout: optional timeout in seconds
+    :return: response dictionary
+    """
+    family, address = parse_address(address)
+    with socket.socket(family, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(address)
+        sock.sendall((json.dumps(message) + '\n').encode())
+        with sock.makefile('rb') as reader:
+            line = reader.readline()
+    if not line:
+        raise RuntimeError('No response from the server')
+    return json.loads(line.decode())
+
+
+def submit(inname, outname, variables, address=None, timeout=None, **kwargs):
+    """
+    Runs wrfpost on a server and waits for it to finish
+    :param inname: string of input file path, as seen by the server
+    :param outname: string of output file path, as seen by the server
+    :param variables: list of desired variable strings
+    :param address: Unix socket path or 'host:port'. Default is DEFAULT_ADDRESS.
+    :param timeout: optional timeout in seconds
+    :param kwargs: other keyword arguments of wrfpost
+    :return: dictionary of the output name, run seconds, and worker process id
+    """
+    job = {'inname': os.path.abspath(inname), 'outname': os.path.abspath(outname),
+           'variables': list(variables), 'kwargs': encode(kwargs)}
+    response = request({'op': 'submit', 'job': job}, address, timeout)
+    if not response.pop('ok'):
+        raise RuntimeError(response['error'])
+    return response
+
+
+def main(argv=None):
+    """Command line entry point of the server and its client"""
+    parser = argparse.ArgumentParser(description='WRF post processor server and client')
+    parser.add_argument('--address', help='Unix socket path or host:port')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    serve = commands.add_parser('serve', help='run a server')
+    serve.add_argument('--workers', type=int)
+    serve.add_argument('--queue-size', type=int, default=16)
+    serve.add_argument('--max-grids', type=int, default=64)
+    run = commands.add_parser('submit', help='run wrfpost on a server')
+    run.add_argument('inname')
+    run.add_argument('outname')
+    run.add_argument('variables', nargs='+')
+    run.add_argument('--plevs', type=float, nargs='+', help='pressure levels in hPa')
+    run.add_argument('--hlevels', type=float, nargs='+', help='height levels in m')
+    run.add_argument('--thlevels', type=float, nargs='+', help='isentropic levels in K')
+    run.add_argument('--options', default='{}', help='JSON of other wrfpost arguments')
+    commands.add_parser('status', help='print the job counts of a server')
+    commands.add_parser('shutdown', help='stop a server')
+    args = parser.parse_args(argv)
+
+    if args.command == 'serve':
+        server = Server(args.address, args.workers, args.queue_size, args.max_grids)
+        print('Serving on '+str(server.address))
+        server.serve_forever()
+        return 0
+    try:
+        if args.command == 'submit':
+            kwargs = json.loads(args.options)
+            for name, unit in (('plevs', 'hPa'), ('hlevels', 'm'), ('thlevels', 'K')):
+                if getattr(args, name) is not None:
+                    kwargs[name] = {'__quantity__': [getattr(args, name), unit]}
+            response = submit(args.inname, args.outname, args.variables, args.address,
+                              **kwargs)
+        else:
+            response = request({'op': args.command}, args.address)
+    except (OSError, RuntimeError) as err:
+        print(err, file=sys.stderr)
+        return 1
+    print(json.dumps(response))
+    return 0 if response.get('ok', True) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
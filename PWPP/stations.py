@@ -0,0 +1,236 @@
+# Extraction of station time series from the WRF grid
+
+import csv
+import os
+import numpy as np
+from netCDF4 import stringtochar
+from scipy.spatial import cKDTree
+from .regrid import CACHE_DIR, grid_hash, to_xyz
+from .subset import Window
+
+_EARTH_RADIUS = 6370000.
+
+
+def read_stations(stations):
+    """
+    Reads a station list
+    :param stations: path of a CSV file of id, lat, lon rows with an optional header, or
+        list of (id, lat, lon) tuples
+    :return: tuple of list of station ids and arrays of latitudes and longitudes
+    """
+    if isinstance(stations, str):
+        with open(stations) as f:
+            rows = [row for row in csv.reader(f) if row]
+        try:
+            float(rows[0][1])
+        except ValueError:
+            rows = rows[1:]
+    else:
+        rows = list(stations)
+    if len(rows) == 0:
+        raise ValueError('No stations given')
+    ids = [str(row[0]).strip() for row in rows]
+    lats = np.array([float(row[1]) for row in rows])
+    lons = np.array([float(row[2]) for row in rows])
+    return ids, lats, lons
+
+
+def get_steps(tslice, ntimes):
+    """
+    Gets the time steps of values
+    :param tslice: slice of time steps, sorted array of time steps, or None for all times
+    :param ntimes: number of time steps of the values
+    :return: array of time step indices
+    """
+    if tslice is None:
+        return np.arange(ntimes)
+    if isinstance(tslice, slice):
+        return np.arange(ntimes) + tslice.start
+    return np.asarray(tslice)
+
+
+def locate_stations(lat, lon, station_lats, station_lons, max_distance=None):
+    """
+    Finds the nearest grid column of each station
+    :param lat: 2D array of grid latitudes
+    :param lon: 2D array of grid longitudes
+    :param station_lats: array of station latitudes
+    :param station_lons: array of station longitudes
+    :param max_distance: optional distance in meters past which a station is outside the
+        grid
+    :return: tuple of flat grid indices and whether each station is inside the grid
+    """
+    tree = cKDTree(to_xyz(np.ravel(lat), np.ravel(lon)))
+    chord, flat = tree.query(to_xyz(station_lats, station_lons))
+    inside = np.ones(flat.size, dtype=bool)
+    if max_distance is not None:
+        inside = chord * _EARTH_RADIUS <= max_distance
+    return flat, inside
+
+
+class StationIndex(object):
+    """
+    Nearest grid column of each station. Columns are found once per distinct grid with a
+    KD-tree and saved in a cache directory under a hash of the grid and stations, so later
+    runs on the same domain load them instead.
+
+    Station columns are gathered into a compact pseudo-grid of layout shape, so column
+    diagnostics can be computed with wrf-python at the stations only. Stations outside
+    the grid are missing in the output.
+    """
+    # columns shared by every index of the process, set to a dictionary by long running
+    # servers so later runs on the same domain neither compute nor load them
+    shared = None
+    # output dimension of the stations, and the grid columns gathered for each one
+    dim = 'station'
+    corners = 1
+    # names of the arrays of the columns of a grid in the cache directory
+    _fields = ('flat', 'inside')
+
+    def __init__(self, ids, lats, lons, max_distance=None, cache_dir=None):
+        """
+        :param ids: list of station id strings
+        :param lats: array of station latitudes
+        :param lons: array of station longitudes
+        :param max_distance: optional distance in meters past which a station is outside
+            the grid, such as the grid spacing
+        :param cache_dir: directory of cached indices. Default is ~/.cache/PWPP.
+        """
+        self.ids = list(ids)
+        self.lats = np.asarray(lats, dtype='f8')
+        self.lons = np.asarray(lons, dtype='f8')
+        self.max_distance = max_distance
+        self.cache_dir = CACHE_DIR if cache_dir is None else cache_dir
+        self.built = 0
+        self.loaded = 0
+        self._columns = {} if self.shared is None else self.shared
+        self._steps = {}
+        self.shape = None
+        # the pseudo-grid keeps two points in each direction, as wrf-python squeezes
+        # dimensions of size one
+        ncolumns = len(self.ids) * self.corners
+        nrow = max(int(np.ceil(np.sqrt(ncolumns))), 2)
+        self.layout = (nrow, max(int(np.ceil(ncolumns / float(nrow))), 2))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def locate(self, lat, lon):
+        """
+        Finds the station columns of a grid
+        :param lat: 2D array of grid latitudes
+        :param lon: 2D array of grid longitudes
+        :return: tuple of flat grid indices and whether each station is inside the grid
+        """
+        return locate_stations(lat, lon, self.lats, self.lons, self.max_distance)
+
+    def get_columns(self, lat, lon):
+        """
+        Gets the station columns of a grid, from memory, the cache directory, or computed
+        :param lat: 2D array of grid latitudes
+        :param lon: 2D array of grid longitudes
+        :return: tuple of arrays of the columns, see locate
+        """
+        key = grid_hash(lat, lon, self.lats, self.lons,
+                        self.dim + 's ' + str(self.max_distance))
+        if key in self._columns:
+            return self._columns[key]
+        path = os.path.join(self.cache_dir, key + '.npz')
+        if os.path.exists(path):
+            with np.load(path) as cached:
+                columns = tuple(cached[field] for field in self._fields)
+            self.loaded += 1
+        else:
+            columns = self.locate(lat, lon)
+            self.built += 1
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # write then rename, so concurrent runs never read a partial file
+            tmp = os.path.join(self.cache_dir, key + '.' + str(os.getpid()) + '.npz')
+            np.savez(tmp, **dict(zip(self._fields, columns)))
+            os.replace(tmp, path)
+        self._columns[key] = columns
+        return columns
+
+    def set_grids(self, lat, lon):
+        """
+        Sets the grid of every time step of the run
+        :param lat: array of grid latitudes with time on axis 0
+        :param lon: array of grid longitudes with time on axis 0
+        """
+        self.shape = lat.shape[1:]
+        self._steps = {}
+        for i in range(lat.shape[0]):
+            self._steps[i] = self.get_columns(lat[i], lon[i])
+
+    def get_window(self, halo=0):
+        """
+        Gets the window of the grid holding every station column of the run
+        :param halo: number of points to add around the columns
+        :return: subset.Window
+        """
+        flat = np.concatenate([columns[0] for columns in self._steps.values()])
+        rows, cols = np.divmod(flat, self.shape[1])
+        ny, nx = self.shape
+        return Window(slice(max(rows.min() - halo, 0), min(rows.max() + 1 + halo, ny)),
+                      slice(max(cols.min() - halo, 0), min(cols.max() + 1 + halo, nx)),
+                      1, ny, nx)
+
+    def gather(self, values, tslice=None, window=None, time_axis=0):
+        """
+        Gathers the station columns of a field into the pseudo-grid
+        :param values: array with the horizontal dimensions last
+        :param tslice: slice of time steps of values, sorted array of its time steps, or
+            None for all times
+        :param window: optional subset.Window values cover, instead of the whole grid
+        :param time_axis: position of the time dimension in values
+        :return: array with the horizontal dimensions replaced by the layout
+        """
+        values = np.moveaxis(np.asarray(values), time_axis, 0)
+        steps = get_steps(tslice, values.shape[0])
+        y0, x0 = (0, 0) if window is None else (window.ys.start, window.xs.start)
+        size = self.layout[0] * self.layout[1]
+        out = []
+        for i in range(values.shape[0]):
+            rows, cols = np.divmod(self._steps[steps[i]][0], self.shape[1])
+            # pad the layout with the last station
+            rows = np.append(rows, np.repeat(rows[-1], size - rows.size))
+            cols = np.append(cols, np.repeat(cols[-1], size - cols.size))
+            column = values[i][..., rows - y0, cols - x0]
+            out.append(column.reshape(column.shape[:-1] + self.layout))
+        return np.ascontiguousarray(np.moveaxis(np.stack(out), 0, time_axis))
+
+    def apply(self, values, tslice=None):
+        """
+        Extracts the stations from a field on the pseudo-grid for the output
+        :param values: array with time on axis 0 and the layout dimensions last
+        :param tslice: slice of time steps, or None for all times
+        :return: array with station on axis 0 and time on axis 1, NaN outside the grid
+        """
+        values = np.ma.filled(np.ma.asarray(values, dtype='f8'), np.nan)
+        values = values.reshape(values.shape[:-2] + (-1,))[..., :len(self.ids)]
+        start = 0 if tslice is None else tslice.start
+        for i in range(values.shape[0]):
+            values[i][..., ~self._steps[start + i][1]] = np.nan
+        return np.moveaxis(values, -1, 0)
+
+
+def write_stations(dataset, stations, profiles=False):
+    """
+    Writes the station coordinates and CF discrete sampling geometry attributes
+    :param dataset: output netCDF4 Dataset with the station dimension
+    :param stations: StationIndex
+    :param profiles: True if the output has isobaric profiles at each time
+    """
+    dataset.featureType = 'timeSeriesProfile' if profiles else 'timeSeries'
+    strlen = max(len(name) for name in stations.ids)
+    dataset.createDimension('name_strlen', strlen)
+    station_id = dataset.createVariable('station_id', 'S1', ('station', 'name_strlen'))
+    station_id.cf_role = 'timeseries_id'
+    station_id.long_name = 'station identifier'
+    station_id[:] = stringtochar(np.array(stations.ids, dtype='S'+str(strlen)))
+    for name, values, units in (('latitude', stations.lats, 'degrees_north'),
+                                ('longitude', stations.lons, 'degrees_east')):
+        var = dataset.createVariable(name, 'f8', ('station',))
+        var.standard_name = name
+        var.units = units
+        var[:] = values
@@ -0,0 +1,205 @@
+# Output storage profile definitions
+
+import numpy as np
+from .backends import is_zarr, open_output
+
+# horizontal tile size of chunks for time-series access
+_TILE_SIZE = 32
+
+# default int16 packing ranges for output variables, in the output units
+_PACK_RANGES = {
+    'uwnd': (-150., 150.),
+    'vwnd': (-150., 150.),
+    'wwnd': (-50., 50.),
+    'temp': (150., 350.),
+    'dewpt': (150., 350.),
+    'avor': (-1000., 1000.),
+    'height': (-1000., 40000.),
+    'mslp': (850., 1100.),
+    'temp_2m': (150., 350.),
+    'dewpt_2m': (150., 350.),
+    'q_2m': (0., 0.06),
+    'u_10m': (-100., 100.),
+    'v_10m': (-100., 100.),
+    'tot_pcp': (0., 5000.),
+    'timestep_pcp': (0., 500.),
+    'UH': (-500., 1500.),
+    'cape': (0., 10000.),
+    'cin': (0., 2000.),
+    'DBZ': (-40., 90.),
+}
+
+# default number of significant decimal digits kept by quantization
+_SIGNIFICANT_DIGITS = {
+    'uwnd': 2,
+    'vwnd': 2,
+    'wwnd': 3,
+    'temp': 2,
+    'dewpt': 2,
+    'avor': 2,
+    'height': 1,
+    'mslp': 2,
+    'temp_2m': 2,
+    'dewpt_2m': 2,
+    'q_2m': 5,
+    'u_10m': 2,
+    'v_10m': 2,
+    'tot_pcp': 2,
+    'timestep_pcp': 2,
+    'UH': 1,
+    'cape': 0,
+    'cin': 0,
+    'DBZ': 1,
+}
+
+
+def get_storage_profiles():
+    """
+    Function for getting the named output storage profiles
+        zlib: True or False : netCDF variable level compression
+        complevel: level of variable compression
+        shuffle: True or False : HDF5 shuffle filter before compression
+        chunks: None for library defaults, 'map' for one horizontal field per chunk,
+            'timeseries' for many times of a horizontal tile per chunk, or a tuple
+        least_significant_digit: None, number of decimal digits to keep, or 'auto' for
+            the per-variable default
+        pack: False, True for the per-variable default int16 range, or a (min, max) tuple
+        static_coords: True to write latitude and longitude once as 2D coordinates
+    :return: profile dictionary
+    """
+    profiles = {
+        'default': {'zlib': True, 'complevel': 4, 'shuffle': True, 'chunks': None,
+                    'least_significant_digit': None, 'pack': False, 'static_coords': False},
+        'map': {'zlib': True, 'complevel': 4, 'shuffle': True, 'chunks': 'map',
+                'least_significant_digit': None, 'pack': False, 'static_coords': True},
+        'timeseries': {'zlib': True, 'complevel': 4, 'shuffle': True, 'chunks': 'timeseries',
+                       'least_significant_digit': None, 'pack': False,
+                       'static_coords': True},
+        'archive': {'zlib': True, 'complevel': 6, 'shuffle': True, 'chunks': 'map',
+                    'least_significant_digit': 'auto', 'pack': False, 'static_coords': True},
+        'packed': {'zlib': True, 'complevel': 4, 'shuffle': True, 'chunks': 'map',
+                   'least_significant_digit': None, 'pack': True, 'static_coords': True},
+        'fast': {'zlib': False, 'complevel': 0, 'shuffle': False, 'chunks': 'map',
+                 'least_significant_digit': None, 'pack': False, 'static_coords': True},
+    }
+    return profiles
+
+
+def get_storage(profile, overrides=None, name=None):
+    """
+    Gets the storage settings of one output variable
+    :param profile: profile name or dictionary of profile settings
+    :param overrides: optional dictionary of variable name to dictionary of settings
+    :param name: output variable name
+    :return: dictionary of storage settings
+    """
+    if isinstance(profile, str):
+        try:
+            profile = get_storage_profiles()[profile]
+        except KeyError:
+            raise KeyError('Storage profile '+profile+' not found.')
+    storage = dict(get_storage_profiles()['default'])
+    storage.update(profile)
+    if overrides is not None and name in overrides:
+        storage.update(overrides[name])
+    return storage
+
+
+def get_chunksizes(chunks, dims, shape, ntimes):
+    """
+    Gets the chunk shape of an output variable
+    :param chunks: chunks storage setting
+    :param dims: tuple of output dimension names
+    :param shape: tuple of output dimension sizes, with the full number of times
+    :param ntimes: number of times in the run
+    :return: tuple of chunk sizes, or None for library defaults
+    """
+    if chunks is None or not isinstance(chunks, str):
+        return chunks
+    sizes = []
+    for dim, size in zip(dims, shape):
+        if dim in ('lat', 'lon'):
+            sizes.append(size if chunks == 'map' else min(size, _TILE_SIZE))
+        elif dim == 'time':
+            sizes.append(1 if chunks == 'map' else max(ntimes, 1))
+        elif dim in ('station', 'point'):
+            sizes.append(size)
+        else:
+            sizes.append(1)
+    if chunks not in ('map', 'timeseries'):
+        raise ValueError('Unknown chunk layout '+chunks)
+    return tuple(sizes)
+
+
+def get_packing(pack, name):
+    """
+    Gets the int16 scale_factor and add_offset of an output variable
+    :param pack: pack storage setting
+    :param name: output variable name
+    :return: tuple of (scale_factor, add_offset, min, max), or None if not packed
+    """
+    if pack is True:
+        if name not in _PACK_RANGES:
+            return None
+        pack = _PACK_RANGES[name]
+    elif not pack:
+        return None
+    vmin, vmax = pack
+    # keep -32768 free for the fill value
+    scale_factor = (vmax - vmin) / (2 ** 16 - 2)
+    add_offset = (vmax + vmin) / 2.
+    return scale_factor, add_offset, vmin, vmax
+
+
+def get_significant_digits(least_significant_digit, name):
+    """Gets the quantization setting of an output variable"""
+    if least_significant_digit == 'auto':
+        return _SIGNIFICANT_DIGITS.get(name)
+    return least_significant_digit
+
+
+def storage_report(outname, verbose=True):
+    """
+    Reports the bytes stored and compression ratio of each variable in an output file.
+    Stored sizes of netCDF4 files need h5py and are None without it.
+    :param outname: path of a closed netCDF4 output file or Zarr store
+    :param verbose: True to print a table of the report
+    :return: dictionary of variable name to dictionary of uncompressed bytes, stored bytes,
+        and compression ratio
+    """
+    h5py = None
+    if not is_zarr(outname):
+        try:
+            import h5py
+        except ImportError:
+            pass
+
+    data = open_output(outname)
+    report = {}
+    for name, var in data.variables.items():
+        # uncompressed size is that of the unpacked values
+        dtype = var.dtype
+        if 'scale_factor' in var.ncattrs():
+            dtype = np.asarray(var.scale_factor).dtype
+        report[name] = {'bytes': int(np.prod(var.shape)) * np.dtype(dtype).itemsize,
+                        'stored': None, 'ratio': None}
+        if is_zarr(outname):
+            report[name]['stored'] = var.nbytes_stored()
+    data.close()
+
+    if h5py is not None:
+        with h5py.File(outname, 'r') as h5:
+            for name in report:
+                if name in h5:
+                    report[name]['stored'] = h5[name].id.get_storage_size()
+    for row in report.values():
+        if row['stored']:
+            row['ratio'] = row['bytes'] / float(row['stored'])
+
+    if verbose:
+        print('{:<16}{:>16}{:>16}{:>10}'.format('variable', 'bytes', 'stored', 'ratio'))
+        for name, row in report.items():
+            print('{:<16}{:>16}{:>16}{:>10}'.format(
+                name, row['bytes'], '-' if row['stored'] is None else row['stored'],
+                '-' if row['ratio'] is None else '{:.2f}'.format(row['ratio'])))
+    return report
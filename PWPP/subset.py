@@ -0,0 +1,141 @@
+# Spatial subsetting and thinning of the horizontal grid
+
+import numpy as np
+
+# horizontal dimensions of the WRF mass grid and their staggered counterparts
+_HORIZONTAL_DIMS = {
+    'south_north': (0, False),
+    'south_north_stag': (0, True),
+    'west_east': (1, False),
+    'west_east_stag': (1, True),
+}
+
+
+def is_staggered(dims):
+    """Checks if a field is on a horizontally staggered grid from its dimension names"""
+    return any(_HORIZONTAL_DIMS.get(dim, (0, False))[1] for dim in dims)
+
+
+class Window(object):
+    """
+    Horizontal index window of the WRF mass grid with a stride. Fields are read either
+    thinned by the stride, or at full resolution over the window plus a halo of
+    neighbouring points for diagnostics that use horizontal stencils, and cropped to the
+    thinned window after they are computed.
+    """
+    def __init__(self, ys, xs, stride, ny, nx):
+        """
+        :param ys: slice of south_north indices
+        :param xs: slice of west_east indices
+        :param stride: integer step between kept points
+        :param ny: number of south_north points of the domain
+        :param nx: number of west_east points of the domain
+        """
+        self.ys = ys
+        self.xs = xs
+        self.stride = stride
+        self.ny = ny
+        self.nx = nx
+
+    @property
+    def shape(self):
+        """Shape of the thinned window"""
+        return (len(range(self.ys.start, self.ys.stop, self.stride)),
+                len(range(self.xs.start, self.xs.stop, self.stride)))
+
+    @property
+    def extent(self):
+        """Shape of the window at full resolution"""
+        return self.ys.stop - self.ys.start, self.xs.stop - self.xs.start
+
+    def _bounds(self, halo):
+        """Gets the read bounds of each horizontal axis of the mass grid"""
+        if halo is None:
+            return [self.ys, self.xs]
+        return [slice(max(self.ys.start - halo, 0), min(self.ys.stop + halo, self.ny)),
+                slice(max(self.xs.start - halo, 0), min(self.xs.stop + halo, self.nx))]
+
+    def index(self, dims, halo=None):
+        """
+        Gets the index of the window for the dimensions of a field
+        :param dims: tuple of field dimension names, without time
+        :param halo: None to read thinned by the stride, or number of halo points to read
+            at full resolution
+        :return: tuple of slices
+        """
+        bounds = self._bounds(halo)
+        index = []
+        for dim in dims:
+            if dim not in _HORIZONTAL_DIMS:
+                index.append(slice(None))
+                continue
+            axis, staggered = _HORIZONTAL_DIMS[dim]
+            bound = bounds[axis]
+            if halo is None:
+                # thinned staggered fields keep the point before each mass point
+                index.append(slice(bound.start, bound.stop + int(staggered), self.stride))
+            else:
+                index.append(slice(bound.start, bound.stop + int(staggered)))
+        return tuple(index)
+
+    def crop(self, values, halo=None):
+        """
+        Crops a field computed over the window and halo to the thinned window
+        :param values: array with the horizontal dimensions last
+        :param halo: the halo values were read with, see index
+        :return: array of the thinned window
+        """
+        if halo is None:
+            return values
+        ys, xs = self._bounds(halo)
+        y0 = self.ys.start - ys.start
+        x0 = self.xs.start - xs.start
+        return values[..., y0:y0 + self.ys.stop - self.ys.start:self.stride,
+                      x0:x0 + self.xs.stop - self.xs.start:self.stride]
+
+    def attributes(self):
+        """Gets global attributes recording the window in the output file"""
+        return {'window_south_north': np.array([self.ys.start, self.ys.stop, self.stride]),
+                'window_west_east': np.array([self.xs.start, self.xs.stop, self.stride])}
+
+
+def get_window(data, bbox=None, index_window=None, stride=1):
+    """
+    Gets the horizontal window of a run
+    :param data: input netCDF4 Dataset
+    :param bbox: optional (lat_min, lat_max, lon_min, lon_max) bounding box. The window is
+        the smallest index window holding every grid point inside the box, on the grid of
+        the first time.
+    :param index_window: optional (south_north start, stop, west_east start, stop) indices
+    :param stride: integer step between kept points
+    :return: Window, or None for the full grid
+    """
+    if bbox is None and index_window is None and stride == 1:
+        return None
+    if bbox is not None and index_window is not None:
+        raise ValueError('Give a bounding box or an index window, not both')
+    if int(stride) != stride or stride < 1:
+        raise ValueError('Stride must be a positive integer')
+    ny = data.dimensions['south_north'].size
+    nx = data.dimensions['west_east'].size
+    if bbox is not None:
+        lat_min, lat_max, lon_min, lon_max = bbox
+        lat = data.variables['XLAT'][0]
+        lon = data.variables['XLONG'][0]
+        inside = (lat >= lat_min) & (lat <= lat_max) & (lon >= lon_min) & (lon <= lon_max)
+        rows = np.flatnonzero(np.any(inside, axis=1))
+        cols = np.flatnonzero(np.any(inside, axis=0))
+        if rows.size == 0:
+            raise ValueError('No grid points inside bounding box '+str(bbox))
+        ys = slice(int(rows[0]), int(rows[-1]) + 1)
+        xs = slice(int(cols[0]), int(cols[-1]) + 1)
+    elif index_window is not None:
+        ys = slice(*slice(index_window[0], index_window[1]).indices(ny)[:2])
+        xs = slice(*slice(index_window[2], index_window[3]).indices(nx)[:2])
+    else:
+        ys = slice(0, ny)
+        xs = slice(0, nx)
+    window = Window(ys, xs, int(stride), ny, nx)
+    if min(window.shape) < 2:
+        raise ValueError('The window must keep at least 2 points in each direction')
+    return window
@@ -0,0 +1,148 @@
+##############################################################################################
+#
+# test_PWPP.py - Tests for top level post processor options
+#
+# by Tyler Wixtrom
+# Texas Tech University
+#
+##############################################################################################
+from PWPP import wrfpost
+import numpy as np
+import pytest
+from metpy.units import units
+from netCDF4 import Dataset, num2date
+from numpy.testing import assert_array_almost_equal
+
+datafile = 'PWPP/tests/testfile.nc'  # Taken from units testing on WRF-Python package
+truthfile = 'PWPP/tests/true_out.nc'
+variables = ['temp_2m', 'dewpt_2m', 'q_2m', 'v_10m', 'u_10m', 'mslp', 'UH', 'cape', 'cin',
+             'refl', 'temp', 'tot_pcp', 'timestep_pcp']
+out_variables = ['temp_2m', 'dewpt_2m', 'q_2m', 'v_10m', 'u_10m', 'mslp', 'UH', 'cape', 'cin',
+                 'DBZ', 'temp', 'tot_pcp', 'timestep_pcp', 'latitude', 'longitude']
+
+
+def subset_times(outname, tslice):
+    """Writes a copy of the test file with a subset of its time steps"""
+    src = Dataset(datafile)
+    out = Dataset(outname, 'w')
+    out.setncatts(src.__dict__)
+    for dim_name, dim in src.dimensions.items():
+        out.createDimension(dim_name, None if dim_name == 'Time' else dim.size)
+    for var_name, var in src.variables.items():
+        out_var = out.createVariable(var_name, var.dtype, var.dimensions)
+        out_var.setncatts(var.__dict__)
+        out_var[:] = var[tslice] if var.dimensions[0] == 'Time' else var[:]
+    out.close()
+    src.close()
+
+
+def test_streaming():
+    """Test that processing in slabs of time steps matches the all-at-once output"""
+    outfile = 'PWPP/tests/outfile.nc'
+    plevs = [500.] * units.hPa
+    # a tiny budget forces one time step per slab
+    wrfpost(datafile, outfile, variables, plevs=plevs, max_memory='1KB')
+    data = Dataset(outfile)
+    data_truth = Dataset(truthfile)
+    assert data.dimensions['time'].size == data_truth.dimensions['time'].size
+    for name in out_variables:
+        assert_array_almost_equal(data.variables[name][:], data_truth.variables[name][:], 4)
+    vtimes = data.variables['valid_time']
+    vtimes_truth = data_truth.variables['valid_time']
+    truth_times = num2date(vtimes_truth[:], vtimes_truth.units)
+    assert list(num2date(vtimes[:], vtimes.units)) == list(truth_times)
+    data.close()
+    data_truth.close()
+
+
+def test_streaming_bad_memory():
+    """Test that an unparseable memory budget raises an error"""
+    with pytest.raises(ValueError):
+        wrfpost(datafile, 'PWPP/tests/outfile.nc', ['temp_2m'], max_memory='lots')
+
+
+def test_append(tmpdir):
+    """Test that appending new times matches processing the whole file"""
+    partial = str(tmpdir.join('wrfout_partial'))
+    outfile = str(tmpdir.join('outfile.nc'))
+    plevs = [500.] * units.hPa
+    subset_times(partial, slice(0, 2))
+    wrfpost(partial, outfile, variables, plevs=plevs)
+    wrfpost(datafile, outfile, variables, plevs=plevs, append=True)
+    data = Dataset(outfile)
+    data_truth = Dataset(truthfile)
+    assert data.dimensions['time'].size == 4
+    for name in out_variables:
+        assert_array_almost_equal(data.variables[name][:], data_truth.variables[name][:], 4)
+    data.close()
+
+    # nothing new to add
+    wrfpost(datafile, outfile, variables, plevs=plevs, append=True)
+    data = Dataset(outfile)
+    assert data.dimensions['time'].size == 4
+    data.close()
+    data_truth.close()
+
+
+def test_append_mismatch(tmpdir):
+    """Test that appending to an output of a different run raises an error"""
+    later = str(tmpdir.join('wrfout_later'))
+    outfile = str(tmpdir.join('outfile.nc'))
+    subset_times(later, slice(2, 4))
+    wrfpost(later, outfile, ['temp_2m'])
+    with pytest.raises(ValueError):
+        wrfpost(datafile, outfile, ['temp_2m'], append=True)
+
+
+def test_parallel_groups(tmpdir):
+    """Test that computing variable groups in worker processes matches serial output"""
+    outfile = str(tmpdir.join('outfile.nc'))
+    wrfpost(datafile, outfile, variables, plevs=[500.] * units.hPa, workers=3,
+            max_memory='1KB')
+    data = Dataset(outfile)
+    data_truth = Dataset(truthfile)
+    for name in out_variables:
+        assert_array_almost_equal(data.variables[name][:], data_truth.variables[name][:], 4)
+    data.close()
+    data_truth.close()
+
+
+def test_vertical_coordinates(tmpdir):
+    """Test output on height above ground and isentropic levels beside pressure levels"""
+    outfile = str(tmpdir.join('outfile.nc'))
+    hlevels = [100., 1000., 3000.] * units.m
+    thlevels = [305., 315.] * units.K
+    wrfpost(datafile, outfile, ['temp', 'height', 'theta'], plevs=[500.] * units.hPa,
+            hlevels=hlevels, thlevels=thlevels, verbose=False)
+    data = Dataset(outfile)
+    data_truth = Dataset(truthfile)
+    assert_array_almost_equal(data.variables['temp'][:], data_truth.variables['temp'][:], 4)
+    assert data.variables['temp_agl'].dimensions == ('time', 'height_levels', 'lat', 'lon')
+    assert data.variables['temp_isen'].dimensions == ('time', 'isentropic_levels', 'lat',
+                                                      'lon')
+    assert_array_almost_equal(data.variables['hlevels'][:], [100., 1000., 3000.])
+    assert data.variables['plevels'].units == data_truth.variables['plevels'].units
+    assert data.variables['thlevels'].units == 'K'
+
+    # each coordinate interpolated to its own levels gives back the levels
+    inp = Dataset(datafile)
+    terrain = inp.variables['HGT'][:]
+    inp.close()
+    height = np.ma.filled(data.variables['height_agl'][:], np.nan)
+    valid = np.isfinite(height)
+    expected = np.broadcast_to((hlevels.m[:, None, None] + terrain[:, None]), height.shape)
+    assert valid.any()
+    assert_array_almost_equal(height[valid], expected[valid], 2)
+    theta = np.ma.filled(data.variables['theta_isen'][:], np.nan)
+    valid = np.isfinite(theta)
+    assert valid.any()
+    expected = np.broadcast_to(thlevels.m[:, None, None], theta.shape)
+    assert_array_almost_equal(theta[valid], expected[valid], 3)
+    data.close()
+    data_truth.close()
+
+
+def test_vertical_levels_missing(tmpdir):
+    """Test that variables on levels need at least one vertical coordinate"""
+    with pytest.raises(ValueError):
+        wrfpost(datafile, str(tmpdir.join('outfile.nc')), ['temp'], verbose=False)
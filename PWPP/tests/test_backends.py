@@ -0,0 +1,163 @@
+##############################################################################################
+#
+# test_backends.py - Tests for the netCDF4 and Zarr output backends
+#
+# by Tyler Wixtrom
+# Texas Tech University
+#
+##############################################################################################
+import numpy as np
+import os
+import pytest
+import xarray as xr
+from metpy.units import units
+from PWPP import wrfpost
+from PWPP.backends import ZarrDataset, open_output, quantize
+from PWPP.tests.test_PWPP import subset_times
+from numpy.testing import assert_array_equal
+
+datafile = 'PWPP/tests/testfile.nc'  # Taken from units testing on WRF-Python package
+variables = ['temp', 'mslp', 'cape', 'UH', 'tot_pcp']
+plevs = [850., 500.] * units.hPa
+
+
+class Interrupt(Exception):
+    pass
+
+
+def assert_same_output(name, expected_name):
+    """Checks that two outputs hold the same variables, dimensions, attributes, and values"""
+    expected = open_output(expected_name)
+    output = open_output(name)
+    assert set(output.variables) == set(expected.variables)
+    assert output.ncattrs() == expected.ncattrs()
+    for name, var in expected.variables.items():
+        out_var = output.variables[name]
+        assert out_var.dimensions == var.dimensions
+        assert out_var.dtype == var.dtype
+        for attr in var.ncattrs():
+            assert np.all(out_var.getncattr(attr) == var.getncattr(attr))
+        assert_array_equal(out_var[:], var[:])
+    output.close()
+    expected.close()
+
+
+def test_zarr_dataset(tmpdir):
+    """Test that a Zarr store is written and read like a netCDF4 Dataset"""
+    pytest.importorskip('zarr')
+    name = str(tmpdir.join('store.zarr'))
+    dataset = ZarrDataset(name, 'w', ntimes=3)
+    dataset.createDimension('time', None)
+    dataset.createDimension('x', 4)
+    dataset.title = 'test'
+    var = dataset.createVariable('field', 'f4', ('time', 'x'), zlib=True)
+    var.units = 'K'
+    packed = dataset.createVariable('packed', 'i2', ('time', 'x'), zlib=True,
+                                    fill_value=-32768)
+    packed.scale_factor = np.float32(0.5)
+    var[0:2] = np.ma.masked_invalid([[1., 2., np.inf, 4.], [5., 6., 7., 8.]])
+    packed[:] = np.full((3, 4), 2.)
+    assert dataset.dimensions['time'].size == 3 and dataset.dimensions['time'].isunlimited()
+    assert var.filters()['zlib'] and var.chunking() == [1, 4]
+    dataset.close()
+
+    dataset = open_output(name)
+    assert dataset.title == 'test' and dataset.variables['field'].units == 'K'
+    values = dataset.variables['field'][:]
+    assert values.mask.tolist() == [[False, False, True, False], [False] * 4, [True] * 4]
+    assert_array_equal(dataset.variables['packed'][:], 2.)
+    dataset.close()
+    with pytest.raises(OSError):
+        ZarrDataset(str(tmpdir.join('missing.zarr')), 'a')
+
+
+def test_quantize():
+    """Test that quantized values keep their decimal digits"""
+    values = np.array([1.23456, 287.654321])
+    assert np.all(np.abs(quantize(values, 2) - values) < 0.005)
+    assert quantize(values, 2)[0] != values[0]
+
+
+def test_zarr_output(tmpdir):
+    """Test that a Zarr store holds the same output as a netCDF4 file"""
+    pytest.importorskip('zarr')
+    for storage in ('default', 'archive'):
+        expected = str(tmpdir.join(storage+'.nc'))
+        outname = str(tmpdir.join(storage+'.zarr'))
+        wrfpost(datafile, expected, variables, plevs=plevs, storage=storage, verbose=False)
+        wrfpost(datafile, outname, variables, plevs=plevs, storage=storage, verbose=False,
+                format='ZARR')
+        assert_same_output(outname, expected)
+    with xr.open_dataset(expected) as netcdf, xr.open_zarr(outname) as store:
+        xr.testing.assert_equal(netcdf, store.load())
+
+
+def test_zarr_partial(tmpdir):
+    """Test that the times written are read from a Zarr store during the run"""
+    pytest.importorskip('zarr')
+    outname = str(tmpdir.join('outfile.zarr'))
+    seen = []
+    times = [None]
+
+    def hook(event):
+        if 'times' in event:
+            times[0] = event['times'][0]
+        if (event['event'] == 'start' and event.get('stage') == 'compute' and
+                times[0] == 2 and not seen):
+            # the metadata is consolidated when the run completes
+            with xr.open_zarr(outname, consolidated=False) as store:
+                mslp = store['mslp'].values
+            seen.append(mslp)
+    wrfpost(datafile, outname, ['mslp'], max_memory='1KB', verbose=False, format='ZARR',
+            hooks=[hook])
+    assert np.isfinite(seen[0][:2]).all() and np.isnan(seen[0][2:]).all()
+    with xr.open_zarr(outname) as store:
+        assert np.isfinite(store['mslp'].values).all()
+
+
+def test_zarr_workers(tmpdir):
+    """Test that worker processes writing their own chunks match a serial run"""
+    pytest.importorskip('zarr')
+    expected = str(tmpdir.join('serial.nc'))
+    outname = str(tmpdir.join('outfile.zarr'))
+    wrfpost(datafile, expected, variables, plevs=plevs, max_memory='1KB', verbose=False)
+    wrfpost(datafile, outname, variables, plevs=plevs, max_memory='1KB', verbose=False,
+            format='ZARR', workers=2)
+    assert_same_output(outname, expected)
+
+
+def test_zarr_resume(tmpdir):
+    """Test that an interrupted run into a Zarr store is resumed"""
+    pytest.importorskip('zarr')
+    expected = str(tmpdir.join('serial.nc'))
+    outname = str(tmpdir.join('outfile.zarr'))
+    wrfpost(datafile, expected, variables, plevs=plevs, max_memory='1KB', verbose=False)
+    times = [None]
+
+    def hook(event):
+        if 'times' in event:
+            times[0] = event['times'][0]
+        if (event['event'] == 'start' and event.get('stage') == 'compute' and
+                event['name'] == 'cape and cin' and times[0] == 2):
+            raise Interrupt()
+    with pytest.raises(Interrupt):
+        wrfpost(datafile, outname, variables, plevs=plevs, max_memory='1KB', verbose=False,
+                format='ZARR', hooks=[hook])
+    wrfpost(datafile, outname, variables, plevs=plevs, max_memory='1KB', verbose=False,
+            format='ZARR', resume=True)
+    assert not os.path.exists(outname + '.progress.json')
+    assert_same_output(outname, expected)
+
+
+def test_zarr_append(tmpdir):
+    """Test that the new times of the input are appended to a Zarr store"""
+    pytest.importorskip('zarr')
+    partial = str(tmpdir.join('wrfout_partial'))
+    expected = str(tmpdir.join('expected.nc'))
+    outname = str(tmpdir.join('outfile.zarr'))
+    subset_times(partial, slice(0, 2))
+    wrfpost(datafile, expected, variables, plevs=plevs, verbose=False)
+    wrfpost(partial, outname, variables, plevs=plevs, verbose=False, format='ZARR')
+    wrfpost(datafile, outname, variables, plevs=plevs, verbose=False, format='ZARR',
+            append=True)
+    assert_same_output(outname, expected)
@@ -0,0 +1,92 @@
+##############################################################################################
+#
+# test_batch.py - Tests for batch post processing
+#
+# by Tyler Wixtrom
+# Texas Tech University
+#
+##############################################################################################
+import os
+import pytest
+from PWPP import wrfpost, wrfpost_batch
+from PWPP.batch import merge_outputs
+from metpy.units import units
+from netCDF4 import Dataset, num2date
+from numpy.testing import assert_array_almost_equal
+
+datafile = 'PWPP/tests/testfile.nc'  # Taken from units testing on WRF-Python package
+truthfile = 'PWPP/tests/true_out.nc'
+variables = ['temp_2m', 'mslp', 'temp', 'tot_pcp', 'timestep_pcp']
+
+
+def split_times(outdir):
+    """Splits the test file into one file per time step"""
+    src = Dataset(datafile)
+    names = []
+    for t in range(src.dimensions['Time'].size):
+        name = os.path.join(outdir, 'wrfout_d01_' + str(t))
+        out = Dataset(name, 'w')
+        out.setncatts(src.__dict__)
+        for dim_name, dim in src.dimensions.items():
+            out.createDimension(dim_name, None if dim_name == 'Time' else dim.size)
+        for var_name, var in src.variables.items():
+            out_var = out.createVariable(var_name, var.dtype, var.dimensions)
+            out_var.setncatts(var.__dict__)
+            out_var[:] = var[t:t + 1] if var.dimensions[0] == 'Time' else var[:]
+        out.close()
+        names.append(name)
+    src.close()
+    return names
+
+
+def test_batch_per_file(tmpdir):
+    """Test per-file outputs from a pool of workers"""
+    innames = split_times(str(tmpdir))
+    outnames = wrfpost_batch(os.path.join(str(tmpdir), 'wrfout_d01_*'),
+                             os.path.join(str(tmpdir), 'post'), variables,
+                             plevs=[500.] * units.hPa, processes=2)
+    assert outnames == [os.path.join(str(tmpdir), 'post', os.path.basename(name) + '.nc')
+                        for name in innames]
+    data_truth = Dataset(truthfile)
+    for t, name in enumerate(outnames):
+        data = Dataset(name)
+        for var in ['temp_2m', 'mslp', 'temp', 'tot_pcp']:
+            truth = data_truth.variables[var][t:t + 1]
+            assert_array_almost_equal(data.variables[var][:], truth, 4)
+        data.close()
+    data_truth.close()
+
+
+def test_batch_merge(tmpdir):
+    """Test merging outputs along time in valid time order"""
+    innames = split_times(str(tmpdir))
+    outname = os.path.join(str(tmpdir), 'merged.nc')
+    wrfpost_batch(innames[::-1], outname, variables, plevs=[500.] * units.hPa, processes=2,
+                  merge=True)
+    data = Dataset(outname)
+    data_truth = Dataset(truthfile)
+    for var in variables:
+        assert_array_almost_equal(data.variables[var][:], data_truth.variables[var][:], 4)
+    vtimes = data.variables['valid_time']
+    vtimes_truth = data_truth.variables['valid_time']
+    truth_times = num2date(vtimes_truth[:], vtimes_truth.units)
+    assert list(num2date(vtimes[:], vtimes.units)) == list(truth_times)
+    data.close()
+    data_truth.close()
+    # the per-file outputs are removed after merging
+    assert sorted(os.listdir(str(tmpdir))) == sorted([os.path.basename(name)
+                                                      for name in innames] + ['merged.nc'])
+
+
+def test_merge_timestep_pcp_without_total(tmpdir):
+    """Test that merging timestep_pcp without tot_pcp is rejected"""
+    innames = split_times(str(tmpdir))
+    outname = os.path.join(str(tmpdir), 'merged.nc')
+    with pytest.raises(ValueError):
+        wrfpost_batch(innames, outname, ['timestep_pcp'], merge=True)
+    outnames = []
+    for inname in innames[:2]:
+        outnames.append(inname + '.nc')
+        wrfpost(inname, outnames[-1], ['timestep_pcp'], verbose=False)
+    with pytest.raises(ValueError):
+        merge_outputs(outnames, outname)
@@ -0,0 +1,65 @@
+##############################################################################################
+#
+# test_benchmark.py - Tests for the benchmark suite
+#
+# by Tyler Wixtrom
+# Texas Tech University
+#
+##############################################################################################
+import numpy as np
+import pytest
+from PWPP import wrfpost
+from PWPP.benchmark import make_wrfout, run_benchmark, compare_results
+from metpy.units import units
+from netCDF4 import Dataset
+
+
+def test_make_wrfout(tmpdir):
+    """Test that the synthetic file has the requested size and plausible diagnostics"""
+    inname = str(tmpdir.join('wrfout.nc'))
+    outname = str(tmpdir.join('out.nc'))
+    make_wrfout(inname, nx=20, ny=16, nz=12, nt=3)
+    data = Dataset(inname)
+    assert data.dimensions['west_east'].size == 20
+    assert data.dimensions['south_north'].size == 16
+    assert data.dimensions['bottom_top'].size == 12
+    assert data.dimensions['Time'].size == 3
+    data.close()
+    wrfpost(inname, outname, ['temp', 'mslp', 'cape', 'refl', 'tot_pcp'],
+            plevs=[500.] * units.hPa)
+    output = Dataset(outname)
+    mslp = output.variables['mslp'][:]
+    assert (mslp > 950.).all() and (mslp < 1050.).all()
+    temp = output.variables['temp'][:]
+    assert (temp > 230.).all() and (temp < 280.).all()
+    assert np.nanmax(output.variables['cape'][:].filled(np.nan)) > 100.
+    assert output.variables['DBZ'][:].max() > 20.
+    assert (np.diff(output.variables['tot_pcp'][:], axis=0) >= 0).all()
+    output.close()
+
+
+def test_run_benchmark(tmpdir):
+    """Test that a benchmark run records every metric"""
+    inname = str(tmpdir.join('wrfout.nc'))
+    make_wrfout(inname, nx=10, ny=8, nz=6, nt=2)
+    results = run_benchmark(inname, cases=['get_temp_2m'])
+    assert results['grid'] == {'nx': 10, 'ny': 8, 'nz': 6, 'nt': 2}
+    row = results['results']['get_temp_2m']
+    assert row['wall'] > 0
+    assert row['peak_rss'] > 0
+    assert row['write_bytes'] is None or row['write_bytes'] > 0
+    with pytest.raises(KeyError):
+        run_benchmark(inname, cases=['get_nothing'])
+
+
+def test_compare_results():
+    """Test that only increases beyond the tolerance are regressions"""
+    grid = {'nx': 10, 'ny': 8, 'nz': 6, 'nt': 2}
+    baseline = {'grid': grid, 'results': {'a': {'wall': 1., 'peak_rss': 100},
+                                          'b': {'wall': 1., 'peak_rss': 100}}}
+    results = {'grid': grid, 'results': {'a': {'wall': 1.1, 'peak_rss': 100},
+                                         'b': {'wall': 2., 'peak_rss': 90},
+                                         'c': {'wall': 5., 'peak_rss': 100}}}
+    assert compare_results(results, baseline) == [('b', 'wall', 1., 2.)]
+    with pytest.raises(ValueError):
+        compare_results(dict(results, grid=dict(grid, nx=20)), baseline)
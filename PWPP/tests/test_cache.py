@@ -0,0 +1,92 @@
+##############################################################################################
+#
+# test_cache.py - Tests for the diagnostic cache
+#
+# by Tyler Wixtrom
+# Texas Tech University
+#
+##############################################################################################
+import pytest
+from PWPP import calc
+from PWPP.cache import DiagnosticCache
+from metpy.units import units
+from netCDF4 import Dataset
+from numpy.testing import assert_array_almost_equal
+from wrf import getvar, ALL_TIMES
+
+datafile = 'PWPP/tests/testfile.nc'  # Taken from units testing on WRF-Python package
+
+
+def test_cache_reads_once():
+    """Test that every raw field is read from disk once for the full variable list"""
+    data = DiagnosticCache(Dataset(datafile))
+    outfile = Dataset('PWPP/tests/outfile.nc', 'w')
+    outfile.createDimension('time', None)
+    outfile.createDimension('lat', data.dimensions['south_north'].size)
+    outfile.createDimension('lon', data.dimensions['west_east'].size)
+    outfile.createDimension('pressure_levels', 1)
+    args = (outfile, 'f4', True, 4)
+    calc.get_isobaric_variables(data, ['uwnd', 'vwnd', 'wwnd', 'temp', 'dewpt', 'avor',
+                                       'height'], [500.] * units.hPa, *args)
+    calc.get_precip(data, *args, timestep=True, total=True)
+    for func in (calc.get_temp_2m, calc.get_dewpt_2m, calc.get_q_2m, calc.get_u_10m,
+                 calc.get_v_10m, calc.get_mslp, calc.get_uh, calc.get_cape, calc.get_dbz):
+        func(data, *args)
+    outfile.close()
+    stats = data.stats()
+    assert set(stats['reads'].values()) == {1}
+    assert stats['hits'] > 0
+    assert stats['evictions'] == 0
+    data.close()
+
+
+def test_cache_values():
+    """Test that cached diagnostics match wrf-python"""
+    nc = Dataset(datafile)
+    data = DiagnosticCache(nc)
+    truth = getvar(nc, 'slp', ALL_TIMES)
+    assert_array_almost_equal(data.getvar('slp'), truth, 4)
+    assert data.getvar('slp').units == truth.units
+    # a second request is a hit
+    data.getvar('slp')
+    assert data.stats()['hits'] >= 1
+    assert_array_almost_equal(data.getvar('slp', slice(1, 3)), truth[1:3], 4)
+    nc.close()
+
+
+def test_cache_eviction():
+    """Test that the cache stays under its byte limit"""
+    nc = Dataset(datafile)
+    size = nc.variables['T2'][:].nbytes
+    data = DiagnosticCache(nc, max_bytes=int(1.5 * size))
+    data.read('T2')
+    data.read('Q2')
+    stats = data.stats()
+    assert stats['evictions'] == 1
+    assert stats['nbytes'] <= 1.5 * size
+    # T2 was evicted, so it is read again
+    data.read('T2')
+    assert data.stats()['reads']['T2'] == 2
+    nc.close()
+
+
+def test_cache_add_again():
+    """Test that a field added again replaces the cached one in the byte count"""
+    nc = Dataset(datafile)
+    data = DiagnosticCache(nc)
+    values = nc.variables['T2'][0:2]
+    data.add('T2', slice(0, 2), values)
+    data.add('T2', slice(0, 2), values.copy())
+    assert data.stats()['nbytes'] == values.nbytes
+    assert data.read('T2', slice(0, 2)) is not values
+    nc.close()
+
+
+def test_cache_add_too_large():
+    """Test that a field read ahead but larger than the cache is reported"""
+    nc = Dataset(datafile)
+    data = DiagnosticCache(nc, max_bytes=1)
+    with pytest.warns(UserWarning):
+        data.add('T2', slice(0, 2), nc.variables['T2'][0:2])
+    assert data.stats()['nbytes'] == 0
+    nc.close()
@@ -0,0 +1,110 @@
+##############################################################################################
+#
+# test_checkpoint.py - Tests for resuming interrupted runs
+#
+# by Tyler Wixtrom
+# Texas Tech University
+#
+##############################################################################################
+import os
+import numpy as np
+import pytest
+from metpy.units import units
+from PWPP import wrfpost
+from PWPP.checkpoint import Checkpoint
+from netCDF4 import Dataset
+from numpy.testing import assert_array_equal
+
+datafile = 'PWPP/tests/testfile.nc'  # Taken from units testing on WRF-Python package
+variables = ['temp', 'mslp', 'cape', 'UH', 'UH_max', 'tot_pcp']
+plevs = [850., 500.] * units.hPa
+
+
+class Interrupt(Exception):
+    pass
+
+
+def interrupt_at(label, start):
+    """Makes a hook interrupting the run when a group starts computing a slab"""
+    times = [None]
+
+    def hook(event):
+        if 'times' in event:
+            times[0] = event['times'][0]
+        if (event['event'] == 'start' and event.get('stage') == 'compute' and
+                event['name'] == label and times[0] == start):
+            raise Interrupt()
+    return hook
+
+
+def computed(events):
+    """Gets the groups and slabs computed by a run"""
+    return [(event['name'], event['times'][0]) for event in events
+            if event['event'] == 'end' and event.get('stage') == 'compute']
+
+
+def test_resume(tmpdir):
+    """Test that a resumed run computes only what is missing and matches a full run"""
+    full = str(tmpdir.join('full.nc'))
+    outfile = str(tmpdir.join('outfile.nc'))
+    wrfpost(datafile, full, variables, plevs=plevs, max_memory='1KB', verbose=False)
+    assert not os.path.exists(full + '.progress.json')
+
+    with pytest.raises(Interrupt):
+        wrfpost(datafile, outfile, variables, plevs=plevs, max_memory='1KB', verbose=False,
+                hooks=[interrupt_at('cape and cin', 2)])
+    assert os.path.exists(outfile + '.progress.json')
+    events = []
+    wrfpost(datafile, outfile, variables, plevs=plevs, max_memory='1KB', verbose=False,
+            resume=True, hooks=[events.append])
+    done = computed(events)
+    assert ('cape and cin', 2) in done and ('cape and cin', 3) in done
+    assert all(start >= 2 for _, start in done)
+    assert len(done) < 2 * 6
+    assert not os.path.exists(outfile + '.progress.json')
+
+    expected = Dataset(full)
+    output = Dataset(outfile)
+    for name in expected.variables:
+        assert_array_equal(output.variables[name][:], expected.variables[name][:])
+    output.close()
+    expected.close()
+
+
+def test_resume_other_run(tmpdir):
+    """Test that markers of a different run are not used"""
+    outfile = str(tmpdir.join('outfile.nc'))
+    with pytest.raises(Interrupt):
+        wrfpost(datafile, outfile, ['mslp', 'cape'], max_memory='1KB', verbose=False,
+                hooks=[interrupt_at('cape and cin', 1)])
+    events = []
+    wrfpost(datafile, outfile, ['mslp', 'UH'], max_memory='1KB', verbose=False,
+            resume=True, hooks=[events.append])
+    assert len(computed(events)) == 8
+
+
+def test_validate(tmpdir):
+    """Test that markers of variables missing from the output are dropped"""
+    outfile = str(tmpdir.join('outfile.nc'))
+    data = Dataset(outfile, 'w')
+    data.createDimension('time', None)
+    data.createDimension('lat', 2)
+    var = data.createVariable('mslp', 'f4', ('time', 'lat'))
+    var[0:2] = np.zeros((2, 2))
+    checkpoint = Checkpoint(outfile, 'run')
+    checkpoint.mark(data, slice(0, 2), 'mslp', ['mslp'])
+    checkpoint.mark(data, slice(2, 4), 'mslp', ['mslp'])
+    checkpoint.mark(data, slice(0, 2), 'UH', ['UH'])
+    data.close()
+
+    checkpoint = Checkpoint(outfile, 'run')
+    assert checkpoint.load()
+    data = Dataset(outfile)
+    checkpoint.validate(data)
+    data.close()
+    assert checkpoint.is_done(slice(0, 2), 'mslp')
+    assert not checkpoint.is_done(slice(2, 4), 'mslp')
+    assert not checkpoint.is_done(slice(0, 2), 'UH')
+    assert not Checkpoint(outfile, 'other run').load()
+    checkpoint.remove()
+    assert not os.path.exists(outfile + '.progress.json')
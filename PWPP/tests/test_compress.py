@@ -0,0 +1,119 @@
+##############################################################################################
+#
+# test_compress.py - Tests for parallel compression of output chunks
+#
+# by Tyler Wixtrom
+# Texas Tech University
+#
+##############################################################################################
+import numpy as np
+import pytest
+from metpy.units import units
+from PWPP import wrfpost
+from PWPP.compress import (ChunkCompressor, compress_chunk, decompress_chunk,
+                           is_compressible)
+from netCDF4 import Dataset
+from numpy.testing import assert_array_equal
+
+datafile = 'PWPP/tests/testfile.nc'  # Taken from units testing on WRF-Python package
+variables = ['temp', 'mslp', 'cape', 'UH', 'UH_max', 'tot_pcp']
+plevs = [850., 500.] * units.hPa
+
+
+def assert_same_output(name, expected_name):
+    """Checks that two output files hold the same variables, filters, and values"""
+    expected = Dataset(expected_name)
+    output = Dataset(name)
+    assert set(output.variables) == set(expected.variables)
+    for var in expected.variables:
+        assert output.variables[var].filters() == expected.variables[var].filters()
+        assert output.variables[var].chunking() == expected.variables[var].chunking()
+        assert_array_equal(output.variables[var][:], expected.variables[var][:])
+    output.close()
+    expected.close()
+
+
+def test_compress_chunk():
+    """Test that chunks are shuffled and deflated reversibly"""
+    values = np.linspace(0., 1., 100, dtype='f4')
+    data = compress_chunk(values.tobytes(), 4, True, 4)
+    assert len(data) < values.nbytes
+    assert_array_equal(np.frombuffer(decompress_chunk(data, 4, True), dtype='f4'), values)
+
+
+def test_compressor(tmpdir):
+    """Test that chunks written in parts and written again are stored in the file"""
+    pytest.importorskip('h5py')
+    name = str(tmpdir.join('chunks.nc'))
+    compressor = ChunkCompressor(2)
+    dataset = Dataset(name, 'w')
+    dataset.createDimension('time', None)
+    dataset.createDimension('x', 10)
+    var = dataset.createVariable('field', 'f4', ('time', 'x'), zlib=True,
+                                 chunksizes=(3, 4))
+    packed = dataset.createVariable('packed', 'i2', ('time', 'x'), zlib=True)
+    packed.scale_factor = 0.1
+    assert is_compressible(var) and not is_compressible(packed)
+    compressor.add(var, (5, 10))
+    values = np.arange(50, dtype='f4').reshape(5, 10)
+    compressor.write('field', slice(0, 2), values[:2])
+    compressor.write('field', slice(2, 5), values[2:])
+    # part of completed chunks written again
+    compressor.write('field', (slice(1, 2), slice(2, 6)), -values[1:2, 2:6])
+    values[1, 2:6] *= -1
+    dataset.close()
+    compressor.flush(name)
+    dataset = Dataset(name)
+    assert_array_equal(dataset.variables['field'][:], values)
+    assert dataset.dimensions['time'].size == 5
+    dataset.close()
+
+
+def test_compressor_slabs(tmpdir):
+    """Test that completed chunks are written after each slab and kept when written again"""
+    pytest.importorskip('h5py')
+    name = str(tmpdir.join('chunks.nc'))
+    compressor = ChunkCompressor(2)
+    dataset = Dataset(name, 'w')
+    dataset.createDimension('time', None)
+    dataset.createDimension('x', 10)
+    var = dataset.createVariable('field', 'f4', ('time', 'x'), zlib=True,
+                                 chunksizes=(2, 4))
+    compressor.add(var, (5, 10))
+    values = np.arange(50, dtype='f4').reshape(5, 10)
+    compressor.write('field', slice(0, 3), values[:3])
+    dataset = compressor.write_completed(dataset)
+    # the chunks of the first two times are in the file, the third time is held
+    assert_array_equal(dataset.variables['field'][:2], values[:2])
+    compressor.write('field', (slice(1, 2), slice(2, 6)), -values[1:2, 2:6])
+    values[1, 2:6] *= -1
+    compressor.write('field', slice(3, 5), values[3:])
+    dataset = compressor.write_completed(dataset)
+    dataset.close()
+    compressor.flush(name)
+    dataset = Dataset(name)
+    assert_array_equal(dataset.variables['field'][:], values)
+    dataset.close()
+
+
+def test_compress_workers(tmpdir):
+    """Test that output compressed by worker processes matches the library"""
+    pytest.importorskip('h5py')
+    for kwargs in ({}, {'max_memory': '1KB'}, {'storage': 'timeseries', 'max_memory': '1KB'},
+                   {'storage': 'packed'}):
+        expected = str(tmpdir.join('expected.nc'))
+        outfile = str(tmpdir.join('outfile.nc'))
+        wrfpost(datafile, expected, variables, plevs=plevs, verbose=False, **kwargs)
+        wrfpost(datafile, outfile, variables, plevs=plevs, verbose=False, compress_workers=2,
+                **kwargs)
+        assert_same_output(outfile, expected)
+
+
+def test_compress_workers_options():
+    """Test that compression workers need a new netCDF4 output"""
+    with pytest.raises(ValueError):
+        wrfpost(datafile, 'unused.nc', ['mslp'], compress_workers=2, pipeline=True,
+                verbose=False)
+    with pytest.raises(ValueError):
+        wrfpost(datafile, 'unused.nc', ['mslp'], compress_workers=2, format='NETCDF3_64BIT',
+                verbose=False)
@@ -0,0 +1,98 @@
+##############################################################################################
+#
+# test_ensemble.py - Tests for streaming ensemble statistics
+#
+# by Tyler Wixtrom
+# Texas Tech University
+#
+##############################################################################################
+import os
+import shutil
+import warnings
+import numpy as np
+import pytest
+from PWPP import wrfpost, wrfpost_ensemble
+from PWPP.ensemble import RunningStats
+from metpy.units import units
+from netCDF4 import Dataset
+from numpy.testing import assert_array_almost_equal, assert_array_equal
+
+datafile = 'PWPP/tests/testfile.nc'  # Taken from units testing on WRF-Python package
+variables = ['temp_2m', 'mslp', 'temp', 'refl']
+plevs = np.array([850, 500]) * units('hPa')
+
+
+def make_members(outdir, count=3):
+    """Makes ensemble members by perturbing the temperature of the test file"""
+    names = []
+    for i in range(count):
+        name = os.path.join(str(outdir), 'member_' + str(i))
+        shutil.copy(datafile, name)
+        member = Dataset(name, 'a')
+        member.variables['T2'][:] = member.variables['T2'][:] + 0.5 * i
+        member.variables['T'][:] = member.variables['T'][:] - 0.25 * i * i
+        member.close()
+        names.append(name)
+    return names
+
+
+def test_running_stats():
+    """Test the running statistics against statistics of all members at once"""
+    rng = np.random.RandomState(0)
+    members = rng.normal(size=(7, 3, 4))
+    members[1:, 0, 0] = np.nan
+    members[:, 1, 1] = np.nan
+    stats = RunningStats([0., 1.])
+    for member in members:
+        stats.update(member)
+    # the numpy reductions over the all-NaN point are expected to warn
+    with np.errstate(invalid='ignore'), warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        count = np.isfinite(members).sum(axis=0)
+        assert_array_equal(stats.count, count)
+        assert_array_almost_equal(stats.mean[count > 0],
+                                  np.nanmean(members, axis=0)[count > 0])
+        assert_array_almost_equal(stats.spread[count > 1],
+                                  np.nanstd(members, axis=0, ddof=1)[count > 1])
+        assert_array_equal(stats.min[count > 0], np.nanmin(members, axis=0)[count > 0])
+        assert_array_equal(stats.probability(1)[count > 0],
+                           ((members > 1).sum(axis=0) / count)[count > 0])
+    assert np.isnan(stats.mean[1, 1]) and np.isnan(stats.spread[0, 0])
+    with pytest.raises(ValueError):
+        stats.update(np.zeros((2, 2)))
+
+
+def test_wrfpost_ensemble(tmpdir):
+    """Test that ensemble products equal statistics of the member outputs"""
+    names = make_members(tmpdir)
+    outname = str(tmpdir.join('ensemble.nc'))
+    count = wrfpost_ensemble(names, outname, variables, plevs=plevs, processes=2,
+                             thresholds={'temp_2m': [300.], 'DBZ': [10., 20.]},
+                             verbose=False)
+    assert count == 3
+
+    outputs = []
+    for name in names:
+        wrfpost(name, name + '.out.nc', variables, plevs=plevs, verbose=False)
+        outputs.append(Dataset(name + '.out.nc'))
+    out = Dataset(outname)
+    assert out.ensemble_members == 3
+    assert sorted(os.listdir(str(tmpdir))) == sorted(
+        [os.path.basename(name) for name in names] +
+        [os.path.basename(name) + '.out.nc' for name in names] + ['ensemble.nc'])
+    assert_array_equal(out.variables['valid_time'][:], outputs[0].variables['valid_time'][:])
+    for name in ('temp_2m', 'mslp', 'temp', 'DBZ'):
+        members = np.stack([np.ma.filled(output.variables[name][:].astype('f8'), np.nan)
+                            for output in outputs])
+        assert_array_almost_equal(out.variables[name+'_mean'][:], np.mean(members, axis=0), 3)
+        assert_array_almost_equal(out.variables[name+'_spread'][:],
+                                  np.std(members, axis=0, ddof=1), 3)
+        assert_array_almost_equal(out.variables[name+'_max'][:], np.max(members, axis=0), 3)
+        assert out.variables[name+'_mean'].units == outputs[0].variables[name].units
+    assert_array_almost_equal(out.variables['DBZ_prob_gt_20'][:],
+                              np.mean(members > 20., axis=0))
+    assert out.variables['temp_2m_prob_gt_300'].units == '1'
+    assert 'temp_2m' not in out.variables
+    out.close()
+    for output in outputs:
+        output.close()
@@ -0,0 +1,60 @@
+##############################################################################################
+#
+# test_instrument.py - Tests for the run instrumentation
+#
+# by Tyler Wixtrom
+# Texas Tech University
+#
+##############################################################################################
+import json
+import time
+from PWPP import wrfpost
+from PWPP.instrument import Instrument, timed
+from metpy.units import units
+
+datafile = 'PWPP/tests/testfile.nc'  # Taken from units testing on WRF-Python package
+
+
+def test_nested_stages():
+    """Test that the time of a stage excludes the stages inside it"""
+    events = []
+    instrument = Instrument([events.append])
+    with instrument.stage('compute', 'outer'):
+        with instrument.stage('write', 'inner') as record:
+            time.sleep(0.05)
+            record['nbytes'] = 10
+    ends = [event for event in events if event['event'] == 'end']
+    assert [event['name'] for event in ends] == ['inner', 'outer']
+    assert ends[0]['wall'] >= 0.05
+    assert ends[1]['wall'] < 0.05
+    assert ends[1]['total_wall'] >= 0.05
+    summary = instrument.summary()
+    assert summary[0]['nbytes'] == 10
+    assert summary[1]['count'] == 1
+    with timed(None, 'read', 'nothing') as record:
+        record['nbytes'] = 1
+
+
+def test_wrfpost_log(tmpdir):
+    """Test that a run writes one JSON event per stage"""
+    log = str(tmpdir.join('log.jsonl'))
+    events = []
+    wrfpost(datafile, str(tmpdir.join('out.nc')), ['temp', 'cape', 'tot_pcp'],
+            plevs=[500.] * units.hPa, max_memory='1KB', verbose=False, log=log,
+            hooks=[events.append])
+    with open(log) as lines:
+        logged = [json.loads(line) for line in lines]
+    assert len(logged) == len([event for event in events if event['event'] != 'start'])
+    stages = set((event['stage'], event['name']) for event in logged if 'stage' in event)
+    for stage in (('open', datafile), ('compute', 'vertical variables'),
+                  ('compute', 'cape and cin'), ('write', 'temp'), ('write', 'cape'),
+                  ('read', 'RAINNC'), ('coordinates', 'latitude')):
+        assert stage in stages
+    for event in logged:
+        if event['event'] == 'end':
+            assert event['wall'] >= 0 and event['peak_rss'] > 0
+            if event['stage'] == 'write':
+                assert event['nbytes'] > 0
+            if event['stage'] not in ('open', 'close'):
+                # one time step per slab
+                assert event['times'][1] - event['times'][0] == 1
@@ -0,0 +1,61 @@
+##############################################################################################
+#
+# test_interp.py - Tests for vertical interpolation
+#
+# by Tyler Wixtrom
+# Texas Tech University
+#
+##############################################################################################
+import numpy as np
+import pytest
+from metpy.interpolate import log_interpolate_1d
+from metpy.units import units
+from numpy.testing import assert_array_almost_equal
+from PWPP.interp import get_interp_weights, interp_with_weights
+
+
+def test_interp_matches_metpy():
+    """Test that weighted interpolation matches MetPy log interpolation"""
+    rng = np.random.RandomState(42)
+    # decreasing pressure with height, varying by column
+    p = np.linspace(1000., 100., 20)[np.newaxis, :, np.newaxis, np.newaxis]
+    p = p + rng.uniform(-5, 5, size=(2, 1, 3, 4))
+    plevs = np.array([850., 500., 250.])
+    weights = get_interp_weights(plevs, p, axis=1)
+    for _ in range(3):
+        var = rng.uniform(200., 300., size=p.shape)
+        truth = log_interpolate_1d(plevs * units.hPa, p * units.hPa, var, axis=1)
+        assert_array_almost_equal(interp_with_weights(var, weights, axis=1), truth, 8)
+
+
+def test_interp_out_of_bounds():
+    """Test that levels outside the column are filled with NaN"""
+    p = np.array([1000., 900., 800., 700.])
+    var = np.array([1., 2., 3., 4.])
+    with pytest.warns(UserWarning):
+        weights = get_interp_weights(np.array([1050., 850., 500.]), p, axis=0)
+    result = interp_with_weights(var, weights, axis=0)
+    assert np.isnan(result[0])
+    assert np.isnan(result[2])
+    assert_array_almost_equal(result[1], 2. + np.log(850. / 900.) / np.log(800. / 900.), 8)
+
+
+def test_interp_linear():
+    """Test linear interpolation in an increasing coordinate, such as height"""
+    rng = np.random.RandomState(3)
+    z = np.cumsum(rng.uniform(50., 500., size=(2, 15, 3, 4)), axis=1)
+    var = rng.uniform(200., 300., size=z.shape)
+    levels = np.array([600., 1500., 2500.])
+    weights = get_interp_weights(levels, z, axis=1, log=False)
+    result = interp_with_weights(var, weights, axis=1)
+    for t, j, i in np.ndindex(2, 3, 4):
+        assert_array_almost_equal(result[t, :, j, i], np.interp(levels, z[t, :, j, i],
+                                                                var[t, :, j, i]), 8)
+
+
+def test_interp_equal_levels():
+    """Test that adjacent levels with equal coordinates do not give missing values"""
+    theta = np.array([300., 305., 305., 310.])
+    var = np.array([1., 2., 3., 4.])
+    weights = get_interp_weights(np.array([305., 307.5]), theta, axis=0, log=False)
+    assert_array_almost_equal(interp_with_weights(var, weights, axis=0), [2., 3.5], 8)
@@ -0,0 +1,113 @@
+##############################################################################################
+#
+# test_lazy.py - Tests for lazy xarray Datasets of post-processed fields
+#
+# by Tyler Wixtrom
+# Texas Tech University
+#
+##############################################################################################
+import numpy as np
+import pytest
+import xarray as xr
+from metpy.units import units
+from PWPP import wrfpost
+from PWPP import calc
+from netCDF4 import Dataset
+from numpy.testing import assert_array_equal
+
+pytest.importorskip('dask')
+from PWPP.lazy import get_chunk_ranges, wrfpost_dataset  # noqa: E402
+
+datafile = 'PWPP/tests/testfile.nc'  # Taken from units testing on WRF-Python package
+variables = ['temp', 'mslp', 'cape', 'UH', 'UH_max', 'UH_max_1h', 'tot_pcp']
+plevs = [850., 500.] * units.hPa
+
+
+def test_chunk_ranges():
+    """Test splitting a dimension into chunks"""
+    assert get_chunk_ranges(4) == [(0, 4)]
+    assert get_chunk_ranges(4, 1) == [(0, 1), (1, 2), (2, 3), (3, 4)]
+    assert get_chunk_ranges(48, 20) == [(0, 20), (20, 40), (40, 48)]
+    # a last chunk of one point is joined to the one before it
+    assert get_chunk_ranges(41, 20, 2) == [(0, 20), (20, 41)]
+    assert get_chunk_ranges(41, 1, 2)[-1] == (38, 41)
+
+
+def test_to_netcdf(tmpdir):
+    """Test that a chunked lazy Dataset writes the same output as wrfpost"""
+    expected_name = str(tmpdir.join('expected.nc'))
+    outname = str(tmpdir.join('outfile.nc'))
+    wrfpost(datafile, expected_name, variables, plevs=plevs, verbose=False)
+    dataset = wrfpost_dataset(datafile, variables, plevs=plevs,
+                              chunks={'time': 3, 'lat': 20, 'lon': 30})
+    dataset.to_netcdf(outname)
+
+    expected = Dataset(expected_name)
+    output = Dataset(outname)
+    assert set(output.variables) == set(expected.variables)
+    assert output.dimensions['time'].isunlimited()
+    for name, var in expected.variables.items():
+        assert output.variables[name].dimensions == var.dimensions
+        assert output.variables[name].units == var.units
+        assert output.variables[name].description == var.description
+        assert output.variables[name].filters()['zlib'] == var.filters()['zlib']
+        assert_array_equal(output.variables[name][:], var[:])
+    assert output.ncattrs() == expected.ncattrs()
+    output.close()
+    expected.close()
+
+
+def test_window(tmpdir):
+    """Test that a lazy Dataset of a thinned window matches wrfpost"""
+    outname = str(tmpdir.join('outfile.nc'))
+    wrfpost(datafile, outname, ['mslp', 'UH'], verbose=False, index_window=(10, 30, 5, 41),
+            stride=2)
+    dataset = wrfpost_dataset(datafile, ['mslp', 'UH'], index_window=(10, 30, 5, 41),
+                              stride=2, chunks={'lat': 4, 'lon': 5})
+    expected = Dataset(outname)
+    for name in ('mslp', 'UH', 'latitude'):
+        assert_array_equal(dataset[name].values, expected.variables[name][:])
+    assert_array_equal(dataset.attrs['window_west_east'], [5, 41, 2])
+    expected.close()
+
+
+def test_lazy(monkeypatch):
+    """Test that only the chunks of a selection are computed"""
+    calls = []
+    get_mslp = calc.get_mslp
+
+    def counted(*args, **kwargs):
+        calls.append(kwargs['tslice'])
+        return get_mslp(*args, **kwargs)
+    dataset = wrfpost_dataset(datafile, ['mslp'], chunks={'time': 1, 'lat': 24, 'lon': 24})
+    monkeypatch.setattr(calc, 'get_mslp', counted)
+    values = dataset['mslp'][2, :10, :10].values
+    assert calls == [slice(2, 3)]
+    assert values.shape == (10, 10) and np.isfinite(values).all()
+
+
+def test_lazy_probe(monkeypatch):
+    """Test that the first chunk computed on opening is not computed again"""
+    calls = []
+    get_mslp = calc.get_mslp
+
+    def counted(*args, **kwargs):
+        calls.append(kwargs['tslice'])
+        return get_mslp(*args, **kwargs)
+    # the plan names the function of each group
+    counted.__name__ = 'get_mslp'
+    monkeypatch.setattr(calc, 'get_mslp', counted)
+    dataset = wrfpost_dataset(datafile, ['mslp'], chunks={'time': 1, 'lat': 24, 'lon': 24})
+    assert calls == [slice(0, 1)]
+    values = dataset['mslp'][0, :10, :10].values
+    assert calls == [slice(0, 1)]
+    assert values.shape == (10, 10) and np.isfinite(values).all()
+
+
+def test_lazy_threads():
+    """Test that chunks computed by threads match those computed in turn"""
+    chunks = {'time': 1, 'lat': 24, 'lon': 24}
+    expected = wrfpost_dataset(datafile, variables, plevs=plevs, chunks=chunks)
+    dataset = wrfpost_dataset(datafile, variables, plevs=plevs, chunks=chunks)
+    xr.testing.assert_equal(dataset.compute(scheduler='threads', num_workers=4),
+                            expected.compute(scheduler='sync'))
@@ -0,0 +1,106 @@
+##############################################################################################
+#
+# test_pipeline.py - Tests for overlapping reads and writes with compute
+#
+# by Tyler Wixtrom
+# Texas Tech University
+#
+##############################################################################################
+import os
+import pytest
+from metpy.units import units
+from PWPP import wrfpost
+from PWPP.cache import DiagnosticCache
+from PWPP.pipeline import Reader
+from netCDF4 import Dataset
+from numpy.testing import assert_array_equal
+
+datafile = 'PWPP/tests/testfile.nc'  # Taken from units testing on WRF-Python package
+variables = ['temp', 'mslp', 'cape', 'UH', 'UH_max', 'UH_max_1h', 'tot_pcp']
+plevs = [850., 500.] * units.hPa
+
+
+class Interrupt(Exception):
+    pass
+
+
+def assert_same_output(name, expected_name):
+    """Checks that two output files hold the same variables and values"""
+    expected = Dataset(expected_name)
+    output = Dataset(name)
+    assert set(output.variables) == set(expected.variables)
+    for var in expected.variables:
+        assert_array_equal(output.variables[var][:], expected.variables[var][:])
+    output.close()
+    expected.close()
+
+
+def test_reader():
+    """Test that the reader reads the fields of each slab ahead in order"""
+    slabs = [(slice(0, 2), [('T2', None), ('PSFC', None)]), (slice(2, 4), [('T2', None)])]
+    reader = Reader(datafile, slabs, depth=2)
+    data = DiagnosticCache(Dataset(datafile))
+    try:
+        for tslice, reads in slabs:
+            reader.load(data, tslice)
+            for name, _ in reads:
+                assert_array_equal(data.read(name, tslice),
+                                   data.dataset.variables[name][tslice])
+        assert data.stats()['reads'] == {'T2': 2, 'PSFC': 1}
+        with pytest.raises(RuntimeError):
+            reader.load(data, slice(4, 6))
+    finally:
+        reader.close()
+        data.close()
+
+
+def test_pipeline(tmpdir):
+    """Test that a pipelined run matches a serial run"""
+    serial = str(tmpdir.join('serial.nc'))
+    outfile = str(tmpdir.join('outfile.nc'))
+    wrfpost(datafile, serial, variables, plevs=plevs, max_memory='1KB', verbose=False)
+    wrfpost(datafile, outfile, variables, plevs=plevs, max_memory='1KB', verbose=False,
+            pipeline=2)
+    assert_same_output(outfile, serial)
+
+
+def test_pipeline_resume(tmpdir):
+    """Test that the writer process marks groups done for a resumed run"""
+    serial = str(tmpdir.join('serial.nc'))
+    outfile = str(tmpdir.join('outfile.nc'))
+    wrfpost(datafile, serial, variables, plevs=plevs, max_memory='1KB', verbose=False)
+
+    times = [None]
+
+    def hook(event):
+        if 'times' in event:
+            times[0] = event['times'][0]
+        if (event['event'] == 'start' and event.get('stage') == 'compute' and
+                event['name'] == 'cape and cin' and times[0] == 2):
+            raise Interrupt()
+    with pytest.raises(Interrupt):
+        wrfpost(datafile, outfile, variables, plevs=plevs, max_memory='1KB', verbose=False,
+                pipeline=True, hooks=[hook])
+    assert os.path.exists(outfile + '.progress.json')
+    wrfpost(datafile, outfile, variables, plevs=plevs, max_memory='1KB', verbose=False,
+            pipeline=True, resume=True)
+    assert not os.path.exists(outfile + '.progress.json')
+    assert_same_output(outfile, serial)
+
+
+def test_pipeline_window_reads(tmpdir):
+    """Test that the fields read ahead over a window are those the diagnostics look up"""
+    serial = str(tmpdir.join('serial.nc'))
+    outfile = str(tmpdir.join('outfile.nc'))
+    reads = set()
+
+    def hook(event):
+        if event['event'] != 'start' and event.get('stage') == 'read':
+            reads.add(event['name'])
+    wrfpost(datafile, serial, variables, plevs=plevs, max_memory='1KB', verbose=False,
+            index_window=(5, 30, 5, 30), stride=2)
+    wrfpost(datafile, outfile, variables, plevs=plevs, max_memory='1KB', verbose=False,
+            index_window=(5, 30, 5, 30), stride=2, pipeline=True, hooks=[hook])
+    assert_same_output(outfile, serial)
+    # only the coordinates and the accumulation starts before each slab are read here
+    assert reads == {'XLAT', 'XLONG', 'RAINNC', 'RAINSH'}
@@ -0,0 +1,64 @@
+##############################################################################################
+#
+# test_planner.py - Tests for the execution planner
+#
+# by Tyler Wixtrom
+# Texas Tech University
+#
+##############################################################################################
+import os
+import pytest
+from PWPP import wrfpost
+from PWPP.planner import make_plan, parse_variables
+from metpy.units import units
+from netCDF4 import Dataset
+
+datafile = 'PWPP/tests/testfile.nc'  # Taken from units testing on WRF-Python package
+variables = ['temp_2m', 'dewpt_2m', 'q_2m', 'v_10m', 'u_10m', 'mslp', 'UH', 'cape', 'cin',
+             'refl', 'temp', 'height', 'avor', 'tot_pcp', 'timestep_pcp', 'pcp_6h']
+
+
+def test_parse_variables():
+    """Test splitting variables into isobaric and other variables"""
+    iso_vars, other_vars = parse_variables(['temp', 'mslp', 'pcp_3h', 'uwnd'])
+    assert iso_vars == ['temp', 'uwnd']
+    assert other_vars == ['mslp', 'pcp_3h']
+    with pytest.raises(KeyError):
+        parse_variables(['temp', 'nothing'])
+
+
+def test_plan_reads_once():
+    """Test that every input is read once and freed after its last use"""
+    data = Dataset(datafile)
+    plan = make_plan(data, variables, [500.] * units.hPa)
+    assert len(plan) == 11
+    reads = [name for step in plan for name in step['reads'] + step['computes']]
+    assert len(reads) == len(set(reads))
+    freed = [name for step in plan for name in step['release']]
+    assert sorted(freed) == sorted(reads)
+    for i, step in enumerate(plan):
+        for name in step['release']:
+            assert all(name not in later['needs'] for later in plan.steps[i + 1:])
+    # missing optional fields are never read
+    assert 'QSNOW' not in reads
+    assert plan.steps[-1]['live'] == 0
+    assert plan.peak_bytes(2) == 2 * max(step['peak'] for step in plan)
+
+    # the ordered plan holds no more at once than the default group order
+    default = make_plan(data, variables, [500.] * units.hPa, order=False)
+    labels = [step['label'] for step in default]
+    assert labels[:2] == ['vertical variables', 'precipitation variables']
+    assert plan.peak_bytes() <= default.peak_bytes()
+    data.close()
+
+
+def test_dry_run(tmpdir):
+    """Test that a dry run returns the plan without writing output"""
+    outname = str(tmpdir.join('out.nc'))
+    plan = wrfpost(datafile, outname, variables + ['pres'], plevs=[500.] * units.hPa,
+                   dry_run=True)
+    assert plan.skipped == []
+    assert 'pres' in plan.steps[[step['label'] for step in plan].index(
+        'vertical variables')]['outputs']
+    assert 'Estimated peak bytes' in plan.describe()
+    assert not os.path.exists(outname)
@@ -0,0 +1,91 @@
+##############################################################################################
+#
+# test_precip.py - Tests for precipitation accumulation
+#
+# by Tyler Wixtrom
+# Texas Tech University
+#
+##############################################################################################
+import numpy as np
+from PWPP import wrfpost
+from PWPP.precip import parse_window, get_window_starts
+from netCDF4 import Dataset
+from numpy.testing import assert_array_almost_equal, assert_array_equal
+
+datafile = 'PWPP/tests/testfile.nc'  # Taken from units testing on WRF-Python package
+truthfile = 'PWPP/tests/true_out.nc'
+
+
+def test_parse_window():
+    """Test precipitation window variable names"""
+    assert parse_window('pcp_3h') == 3
+    assert parse_window('pcp_24h') == 24
+    assert parse_window('pcp_0h') is None
+    assert parse_window('tot_pcp') is None
+
+
+def test_window_starts():
+    """Test that windows start at an earlier input time or are missing"""
+    seconds = np.array([0, 3600, 7200, 14400])
+    starts = get_window_starts(seconds, np.arange(4), 7200)
+    assert_array_equal(starts, [-1, -1, 0, 2])
+
+
+def test_windows(tmpdir):
+    """Test windowed accumulations, all at once and streamed one time step per slab"""
+    outname = str(tmpdir.join('out.nc'))
+    variables = ['tot_pcp', 'timestep_pcp', 'pcp_1h', 'pcp_3h', 'pcp_6h']
+    wrfpost(datafile, outname, variables)
+    data = Dataset(outname)
+    tot = data.variables['tot_pcp'][:]
+    # the input is 3 hourly, so there are no 1 hour windows
+    assert np.isnan(data.variables['pcp_1h'][:]).all()
+    pcp_3h = data.variables['pcp_3h'][:]
+    assert np.isnan(pcp_3h[0]).all()
+    assert_array_almost_equal(pcp_3h[1:], tot[1:] - tot[:-1], 6)
+    assert_array_almost_equal(pcp_3h[1:], data.variables['timestep_pcp'][1:], 6)
+    pcp_6h = data.variables['pcp_6h'][:]
+    assert np.isnan(pcp_6h[:2]).all()
+    assert_array_almost_equal(pcp_6h[2:], tot[2:] - tot[:-2], 6)
+    assert data.variables['pcp_6h'].description == '6 Hour Accumulated Precipitation'
+    for name in variables:
+        assert data.variables[name].units == 'millimeter'
+
+    streamed = str(tmpdir.join('streamed.nc'))
+    wrfpost(datafile, streamed, variables, max_memory='1KB')
+    stream = Dataset(streamed)
+    for name in variables:
+        assert_array_equal(stream.variables[name][:], data.variables[name][:])
+    data.close()
+    stream.close()
+
+
+def test_buckets(tmpdir):
+    """Test that accumulations emptied into buckets are restored"""
+    inname = str(tmpdir.join('bucket.nc'))
+    outname = str(tmpdir.join('out.nc'))
+    src = Dataset(datafile)
+    out = Dataset(inname, 'w')
+    out.setncatts(src.__dict__)
+    out.BUCKET_MM = 0.01
+    for dim_name, dim in src.dimensions.items():
+        out.createDimension(dim_name, None if dim_name == 'Time' else dim.size)
+    for var_name, var in src.variables.items():
+        out_var = out.createVariable(var_name, var.dtype, var.dimensions)
+        out_var.setncatts(var.__dict__)
+        out_var[:] = var[:]
+    rain = src.variables['RAINNC'][:]
+    counts = np.floor(rain / 0.01)
+    assert counts.max() > 0
+    out.createVariable('I_RAINNC', 'i4', src.variables['RAINNC'].dimensions)[:] = counts
+    out.variables['RAINNC'][:] = rain - counts * np.float32(0.01)
+    out.close()
+    src.close()
+
+    wrfpost(inname, outname, ['tot_pcp', 'timestep_pcp'])
+    data = Dataset(outname)
+    truth = Dataset(truthfile)
+    for name in ('tot_pcp', 'timestep_pcp'):
+        assert_array_almost_equal(data.variables[name][:], truth.variables[name][:], 4)
+    data.close()
+    truth.close()
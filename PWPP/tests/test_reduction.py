@@ -0,0 +1,87 @@
+##############################################################################################
+#
+# test_reduction.py - Tests for streaming maximum and minimum reductions
+#
+# by Tyler Wixtrom
+# Texas Tech University
+#
+##############################################################################################
+import numpy as np
+import pytest
+from PWPP import wrfpost
+from PWPP.output import OutputRecorder
+from PWPP.reduction import Reducer, parse_reduction
+from PWPP.variable_def import get_variable
+from netCDF4 import Dataset
+from numpy.testing import assert_array_equal
+
+datafile = 'PWPP/tests/testfile.nc'  # Taken from units testing on WRF-Python package
+variables = ['UH', 'mslp', 'UH_max', 'UH_max_6h', 'refl_max_6h', 'mslp_min', 'mslp_min_3h',
+             'wspd_10m_max']
+
+
+def test_parse_reduction():
+    """Test parsing reduction variable names"""
+    assert parse_reduction('UH_max_1h') == ('UH', 'max', 1)
+    assert parse_reduction('mslp_min') == ('mslp', 'min', None)
+    assert parse_reduction('wspd_10m_max_24h') == ('wspd_10m', 'max', 24)
+    assert parse_reduction('UH_max_0h') is None
+    assert parse_reduction('temp_2m') is None
+    assert get_variable('refl_max_1h')['reduction'] == ('DBZ', 'max', 1)
+    assert get_variable('refl_max_1h')['group'] == 'refl'
+    with pytest.raises(KeyError):
+        get_variable('pres_max')
+
+
+def test_reducer_slabs():
+    """Test that reductions of slabs match reductions of the whole run"""
+    rng = np.random.RandomState(0)
+    seconds = np.arange(8) * 1800
+    field = rng.uniform(size=(8, 3, 4))
+    field[2, 1, 1] = np.nan
+    reductions = [('f_max_1h', 'f', 'max', 1), ('f_min', 'f', 'min', None)]
+    dims = ('time', 'lat', 'lon')
+    outputs = []
+    for slabs in ([slice(0, 8)], [slice(0, 3), slice(3, 5), slice(5, 8)]):
+        recorder = OutputRecorder()
+        reducer = Reducer(reductions, seconds)
+        for tslice in slabs:
+            reducer.update(recorder, 'f', field[tslice], 'f4', dims, 'm', 'f', tslice)
+        window = np.concatenate([record[1] for record in recorder.records
+                                 if record[0] == 'f_max_1h'])
+        outputs.append((window, recorder.records[-1][1]))
+        assert recorder.records[-1][3] == ('lat', 'lon')
+    assert_array_equal(outputs[0][0], outputs[1][0])
+    assert_array_equal(outputs[0][1], outputs[1][1])
+    window = outputs[0][0]
+    # the first two times have windows starting before the run
+    assert np.isnan(window[:2]).all()
+    assert_array_equal(window[2:], np.fmax(field[1:-1], field[2:]))
+    assert_array_equal(outputs[0][1], np.nanmin(field, axis=0))
+
+
+def test_wrfpost_reductions(tmpdir):
+    """Test that streamed reductions match reducing the written fields"""
+    outfile = str(tmpdir.join('outfile.nc'))
+    wrfpost(datafile, outfile, variables, verbose=False, max_memory='1KB')
+    data = Dataset(outfile)
+    uh = data.variables['UH'][:]
+    assert_array_equal(data.variables['UH_max'][:], uh.max(axis=0))
+    assert_array_equal(data.variables['mslp_min'][:], data.variables['mslp'][:].min(axis=0))
+    # 3 hourly output, so a 6 hour window holds two times
+    window = data.variables['UH_max_6h'][:]
+    assert np.isnan(window[:2]).all()
+    assert_array_equal(window[2:], np.maximum(uh[1:-1], uh[2:]))
+    assert_array_equal(data.variables['mslp_min_3h'][1:], data.variables['mslp'][1:])
+    assert data.variables['UH_max'].dimensions == ('lat', 'lon')
+    # reduced fields that are not requested are not written
+    assert 'DBZ' not in data.variables and 'wspd_10m' not in data.variables
+    expected = {name: data.variables[name][:] for name in data.variables}
+    data.close()
+
+    wrfpost(datafile, outfile, variables, verbose=False, reduced_only=True)
+    data = Dataset(outfile)
+    assert 'UH' not in data.variables and 'mslp' not in data.variables
+    for name in ('UH_max', 'UH_max_6h', 'refl_max_6h', 'mslp_min', 'wspd_10m_max'):
+        assert_array_equal(data.variables[name][:], expected[name])
+    data.close()
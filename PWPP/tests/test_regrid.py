@@ -0,0 +1,106 @@
+##############################################################################################
+#
+# test_regrid.py - Tests for regridding to regular latitude-longitude grids
+#
+# by Tyler Wixtrom
+# Texas Tech University
+#
+##############################################################################################
+import os
+import numpy as np
+import pytest
+from PWPP import wrfpost
+from PWPP.regrid import Regridder, compute_weights, get_regular_grid
+from netCDF4 import Dataset
+from numpy.testing import assert_array_equal, assert_array_almost_equal
+
+datafile = 'PWPP/tests/testfile.nc'  # Taken from units testing on WRF-Python package
+outname = 'PWPP/tests/outfile.nc'
+
+
+def read_grid(step=0):
+    """Reads the latitude and longitude of one time of the test file"""
+    data = Dataset(datafile)
+    lat = data.variables['XLAT'][step].astype('f8')
+    lon = data.variables['XLONG'][step].astype('f8')
+    data.close()
+    return lat, lon
+
+
+def test_get_regular_grid():
+    """Test the coordinates of a regular grid"""
+    lats, lons = get_regular_grid((20., 30., -95., -85.5, 0.5))
+    assert_array_almost_equal(lats, np.arange(20., 30.25, 0.5))
+    assert_array_almost_equal(lons, np.arange(-95., -85.25, 0.5))
+    with pytest.raises(ValueError):
+        get_regular_grid((20., 10., -95., -85., 0.5))
+
+
+def test_bilinear_weights():
+    """Test that bilinear weights reproduce the coordinates and are missing outside"""
+    lat, lon = read_grid()
+    lats, lons = get_regular_grid((21., 27., -93.5, -87., 0.25))
+    weights = compute_weights(lat, lon, lats, lons, 'bilinear')
+    tlat, tlon = np.meshgrid(lats, lons, indexing='ij')
+    inside = np.diff(weights.indptr) > 0
+    assert inside.any() and not inside.all()
+    assert_array_almost_equal(weights.sum(axis=1).A1[inside], 1.)
+    assert_array_almost_equal(weights.dot(lat.ravel())[inside], tlat.ravel()[inside], 3)
+    assert_array_almost_equal(weights.dot(lon.ravel())[inside], tlon.ravel()[inside], 3)
+    # targets past the domain edges have no weights
+    outside = ((tlat.ravel() < lat.min()) | (tlat.ravel() > lat.max()) |
+               (tlon.ravel() < lon.min()) | (tlon.ravel() > lon.max()))
+    assert not inside[outside].any()
+
+
+def test_nearest_weights():
+    """Test that nearest neighbour weights pick the closest source point"""
+    lat, lon = read_grid()
+    lats, lons = get_regular_grid((22.5, 25., -91.5, -89., 0.5))
+    weights = compute_weights(lat, lon, lats, lons, 'nearest')
+    assert (weights.getnnz(axis=1) == 1).all()
+    tlat, tlon = np.meshgrid(lats, lons, indexing='ij')
+    for point, col in zip(zip(tlat.ravel(), tlon.ravel()), weights.indices):
+        scale = np.cos(np.radians(point[0]))
+        distance = (lat - point[0]) ** 2 + ((lon - point[1]) * scale) ** 2
+        assert distance.ravel()[col] == pytest.approx(distance.min())
+
+
+def test_weights_cache(tmp_path):
+    """Test that weights are computed once per grid and loaded by later regridders"""
+    lat, lon = read_grid()
+    lats, lons = get_regular_grid((22., 26., -92., -88., 0.5))
+    regridder = Regridder(lats, lons, cache_dir=str(tmp_path))
+    regridder.set_grids(np.stack((lat, lat)), np.stack((lon, lon)))
+    assert regridder.built == 1
+    field = np.stack((lat, lat + 1.))
+    values = regridder.apply(field)
+
+    later = Regridder(lats, lons, cache_dir=str(tmp_path))
+    later.set_grids(lat[None], lon[None], slice(1, 2))
+    assert later.built == 0 and later.loaded == 1
+    assert_array_equal(later.apply(field[1:], slice(1, 2)), values[1:])
+    assert len(os.listdir(str(tmp_path))) == 1
+
+
+def test_wrfpost_regrid(tmp_path):
+    """Test the post processor writing a regular grid"""
+    grid = (22., 26., -92., -88., 0.25)
+    wrfpost(datafile, outname, ['temp_2m', 'mslp'], verbose=False, regrid=grid,
+            weights_dir=str(tmp_path))
+    output = Dataset(outname)
+    lats, lons = get_regular_grid(grid)
+    assert output.variables['temp_2m'].shape == (4, lats.size, lons.size)
+    assert_array_almost_equal(output.variables['latitude'][:], lats)
+    assert_array_almost_equal(output.variables['longitude'][:], lons)
+    assert output.regrid_method == 'bilinear'
+    first = output.variables['temp_2m'][:]
+    output.close()
+    # the moving domain has one set of weights per time
+    assert len(os.listdir(str(tmp_path))) == 4
+
+    wrfpost(datafile, outname, ['temp_2m', 'mslp'], verbose=False, regrid=grid,
+            weights_dir=str(tmp_path))
+    output = Dataset(outname)
+    assert_array_equal(output.variables['temp_2m'][:], first)
+    output.close()
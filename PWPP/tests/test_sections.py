@@ -0,0 +1,123 @@
+##############################################################################################
+#
+# test_sections.py - Tests for cross-section and sounding extraction
+#
+# by Tyler Wixtrom
+# Texas Tech University
+#
+##############################################################################################
+import numpy as np
+import pytest
+from metpy.units import units
+from PWPP import wrfpost
+from PWPP.sections import PathIndex, get_path_points, read_paths
+from netCDF4 import Dataset, chartostring
+from numpy.testing import assert_allclose, assert_array_equal
+
+datafile = 'PWPP/tests/testfile.nc'  # Taken from units testing on WRF-Python package
+variables = ['temp', 'pres', 'height', 'theta', 'uwnd', 'mslp', 'UH', 'tot_pcp']
+
+
+def read_grid():
+    """Reads the latitude and longitude of the first time of the test file"""
+    data = Dataset(datafile)
+    lat = data.variables['XLAT'][0]
+    lon = data.variables['XLONG'][0]
+    data.close()
+    return lat, lon
+
+
+def make_paths():
+    """Makes a path across the domain, a sounding site at a grid point, and one outside"""
+    lat, lon = read_grid()
+    return [('front', [(lat[5, 5], lon[5, 5]), (lat[40, 30], lon[40, 30]),
+                       (lat[40, 44], lon[40, 44])]),
+            ('site', [(lat[20, 20], lon[20, 20])]),
+            ('away', [(lat[20, 20] + 40., lon[20, 20])])]
+
+
+def read_all(name):
+    """Reads every variable of an output file"""
+    out = Dataset(name)
+    values = {key: var[:] for key, var in out.variables.items()}
+    out.close()
+    return values
+
+
+def test_path_points():
+    """Test that points are spaced evenly along a path and end on its vertices"""
+    lats, lons, distances = get_path_points([0., 0., 1.], [0., 1., 1.], 10000.)
+    assert_allclose(np.diff(distances), distances[1] - distances[0])
+    assert distances[1] <= 10000. * 1.05
+    assert_allclose((lats[0], lons[0]), (0., 0.), atol=1e-9)
+    assert_allclose((lats[-1], lons[-1]), (1., 1.), atol=1e-9)
+    # the corner vertex is one of the points, at the length of the first segment
+    corner = np.argmin(np.abs(lons - 1.) + np.abs(lats))
+    assert_allclose(distances[corner], 6370000. * np.radians(1.), rtol=1e-3)
+    lats, lons, distances = get_path_points([35.], [-97.], 10000.)
+    assert_array_equal(distances, [0.])
+
+
+def test_read_paths(tmpdir):
+    """Test reading paths from a CSV file, with the rows of an id in order"""
+    name = str(tmpdir.join('paths.csv'))
+    with open(name, 'w') as f:
+        f.write('id,lat,lon\nA,30,-90\nB,31,-91\nA,32,-92\n')
+    paths = read_paths(name)
+    assert [path[0] for path in paths] == ['A', 'B']
+    assert_array_equal(paths[0][1], [30., 32.])
+    assert_array_equal(paths[1][2], [-91.])
+    with pytest.raises(ValueError):
+        read_paths([])
+
+
+def test_sections(tmpdir):
+    """Test that fields are interpolated bilinearly from the full grid output to the points"""
+    full_name = str(tmpdir.join('full.nc'))
+    outname = str(tmpdir.join('sections.nc'))
+    plevs = [850., 500.] * units.hPa
+    wrfpost(datafile, full_name, variables, plevs=plevs, model_levels=True, verbose=False)
+    wrfpost(datafile, outname, variables, plevs=plevs, model_levels=True, verbose=False,
+            paths=make_paths(), weights_dir=str(tmpdir))
+    full = read_all(full_name)
+    out = read_all(outname)
+
+    data = Dataset(datafile)
+    lat = data.variables['XLAT'][:]
+    lon = data.variables['XLONG'][:]
+    data.close()
+    index = PathIndex(read_paths(make_paths()), 10000., cache_dir=str(tmpdir))
+    assert_array_equal(out['distance'], index.distance)
+    assert_array_equal(chartostring(out['path_id']), ['front', 'site', 'away'])
+    site = np.flatnonzero(out['point_path'] == 1)[0]
+    # a site on a grid point of the first time takes all its weight from that column
+    flat, weights, inside = index.locate(lat[0], lon[0])
+    flat = flat.reshape(4, -1)
+    corner = np.argmax(weights[:, site])
+    assert_allclose(weights[corner, site], 1., atol=1e-6)
+    assert flat[corner, site] == 20 * lat.shape[2] + 20
+    assert_allclose(out['temp_ml'][site, 0], full['temp_ml'][0, :, 20, 20], rtol=1e-5)
+    assert not inside[-1]
+
+    # the domain moves, so the points are located on the grid of each time
+    for t in range(lat.shape[0]):
+        flat, weights, inside = index.locate(lat[t], lon[t])
+        flat = flat.reshape(4, -1)
+        for name in ('temp', 'pres_ml', 'theta_ml', 'uwnd_ml', 'mslp', 'UH', 'tot_pcp'):
+            grid = np.ma.filled(full[name][t], np.nan)
+            grid = grid.reshape(grid.shape[:-2] + (-1,))
+            expected = np.moveaxis(np.sum(grid[..., flat] * weights, axis=-2), -1, 0)
+            values = np.ma.filled(out[name][:, t], np.nan)
+            assert values.shape == (len(index),) + full[name].shape[1:-2]
+            assert_allclose(values[inside], expected[inside], rtol=1e-4)
+            assert np.isnan(values[~inside]).all()
+
+
+def test_sections_options():
+    """Test that paths cannot be combined with stations or a window"""
+    with pytest.raises(ValueError):
+        wrfpost(datafile, 'unused.nc', ['mslp'], paths=make_paths(),
+                stations=[('S', 30., -90.)], verbose=False)
+    with pytest.raises(ValueError):
+        wrfpost(datafile, 'unused.nc', ['mslp'], paths=make_paths(), stride=2,
+                verbose=False)
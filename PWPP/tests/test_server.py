@@ -0,0 +1,106 @@
+##############################################################################################
+#
+# test_server.py - Tests for the post processing server and its client
+#
+# by Tyler Wixtrom
+# Texas Tech University
+#
+##############################################################################################
+import json
+import socket
+import subprocess
+import sys
+import threading
+import pytest
+from metpy.units import units
+from netCDF4 import Dataset
+from numpy.testing import assert_array_equal
+from PWPP import wrfpost
+from PWPP.regrid import Regridder, get_regular_grid
+from PWPP.server import Server, decode, encode, main, parse_address, request, submit
+
+datafile = 'PWPP/tests/testfile.nc'  # Taken from units testing on WRF-Python package
+variables = ['temp', 'mslp', 'tot_pcp']
+plevs = [850., 500.] * units.hPa
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7), reason='needs module __getattr__')
+def test_lazy_import():
+    """Test that optional entry points are imported on first use"""
+    pytest.importorskip('dask')
+    code = ('import sys, PWPP; imported = "PWPP.lazy" in sys.modules; PWPP.wrfpost_dataset; '
+            'print(json.dumps([imported, "PWPP.lazy" in sys.modules]))')
+    output = subprocess.check_output([sys.executable, '-c', 'import json; ' + code])
+    assert json.loads(output) == [False, True]
+
+
+def test_encode_quantities():
+    """Test that unit quantities survive the JSON encoding"""
+    kwargs = {'plevs': plevs, 'regrid': (22., 26., -92., -88., 0.25), 'stride': 2}
+    decoded = decode(json.loads(json.dumps(encode(kwargs))))
+    assert_array_equal(decoded['plevs'].to('Pa').m, [85000., 50000.])
+    assert decoded['regrid'] == [22., 26., -92., -88., 0.25]
+    assert decoded['stride'] == 2
+
+
+def test_parse_address():
+    """Test Unix socket and TCP addresses"""
+    assert parse_address('localhost:8765') == (socket.AF_INET, ('localhost', 8765))
+    assert parse_address('/tmp/pwpp.sock') == (socket.AF_UNIX, '/tmp/pwpp.sock')
+
+
+def test_shared_weights(tmp_path):
+    """Test that shared weights are reused by later regridders of the process"""
+    lats, lons = get_regular_grid((22., 26., -92., -88., 0.5))
+    data = Dataset(datafile)
+    lat = data.variables['XLAT'][0]
+    lon = data.variables['XLONG'][0]
+    data.close()
+    Regridder.shared = {}
+    try:
+        Regridder(lats, lons, cache_dir=str(tmp_path)).get_weights(lat, lon)
+        later = Regridder(lats, lons, cache_dir=str(tmp_path))
+        later.get_weights(lat, lon)
+        assert later.built == 0 and later.loaded == 0
+    finally:
+        Regridder.shared = None
+
+
+def test_server(tmp_path):
+    """Test that server jobs match direct runs and reuse warm workers"""
+    address = str(tmp_path / 'server.sock')
+    server = Server(address, workers=1, queue_size=1)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        direct = str(tmp_path / 'direct.nc')
+        wrfpost(datafile, direct, variables, plevs=plevs, verbose=False)
+        results = [submit(datafile, str(tmp_path / (str(i) + '.nc')), variables,
+                          address, plevs=plevs) for i in range(2)]
+        assert results[0]['pid'] == results[1]['pid']
+        truth = Dataset(direct)
+        for result in results:
+            output = Dataset(result['outname'])
+            for name in ('temp', 'mslp', 'tot_pcp'):
+                assert_array_equal(output.variables[name][:], truth.variables[name][:])
+            output.close()
+        truth.close()
+
+        with pytest.raises(RuntimeError):
+            submit(datafile, str(tmp_path / 'bad.nc'), ['nonsense'], address)
+        # options starting worker processes are refused before the job runs
+        for options in ({'workers': 2}, {'tiles': 2}, {'pipeline': True},
+                        {'compress_workers': 2}):
+            with pytest.raises(RuntimeError, match='cannot start worker processes'):
+                submit(datafile, str(tmp_path / 'refused.nc'), variables, address,
+                       **options)
+        assert main(['--address', address, 'submit', datafile, str(tmp_path / 'cli.nc'),
+                     'mslp']) == 0
+        status = request({'op': 'status'}, address)
+        assert status['completed'] == 3 and status['failed'] == 1
+        assert status['running'] == 0
+    finally:
+        request({'op': 'shutdown'}, address)
+        thread.join(60)
+    assert not thread.is_alive()
+    assert not (tmp_path / 'server.sock').exists()
@@ -0,0 +1,111 @@
+##############################################################################################
+#
+# test_stations.py - Tests for station time series extraction
+#
+# by Tyler Wixtrom
+# Texas Tech University
+#
+##############################################################################################
+import os
+import numpy as np
+import pytest
+from metpy.units import units
+from PWPP import wrfpost
+from PWPP.stations import StationIndex, locate_stations, read_stations
+from netCDF4 import Dataset, chartostring
+from numpy.testing import assert_array_equal
+
+datafile = 'PWPP/tests/testfile.nc'  # Taken from units testing on WRF-Python package
+outname = 'PWPP/tests/outfile.nc'
+variables = ['uwnd', 'vwnd', 'wwnd', 'temp', 'dewpt', 'avor', 'height', 'mslp', 'temp_2m',
+             'dewpt_2m', 'q_2m', 'u_10m', 'v_10m', 'tot_pcp', 'UH', 'cape', 'cin', 'refl']
+plevs = np.array([1000, 850, 700, 500, 300]) * units('hPa')
+
+
+def read_grid():
+    """Reads the latitude and longitude of the test file"""
+    data = Dataset(datafile)
+    lat = data.variables['XLAT'][:]
+    lon = data.variables['XLONG'][:]
+    dx = data.DX
+    data.close()
+    return lat, lon, dx
+
+
+def make_stations():
+    """Makes stations at grid points of the first time, including edges and one outside"""
+    lat, lon, _ = read_grid()
+    points = ((0, 5), (10, 20), (40, 47), (47, 0), (24, 24), (30, 3))
+    stations = [('S'+str(k), float(lat[0, j, i]), float(lon[0, j, i]))
+                for k, (j, i) in enumerate(points)]
+    return stations + [('FAR', 0., 0.)]
+
+
+def test_read_stations(tmp_path):
+    """Test reading station lists from CSV files and tuples"""
+    path = str(tmp_path / 'stations.csv')
+    with open(path, 'w') as f:
+        f.write('id,lat,lon\nKLBB,33.67,-101.82\nKAMA, 35.22,-101.71\n')
+    ids, lats, lons = read_stations(path)
+    assert ids == ['KLBB', 'KAMA']
+    assert_array_equal(lats, [33.67, 35.22])
+    assert_array_equal(lons, [-101.82, -101.71])
+    assert read_stations([('A', 1, 2)])[0] == ['A']
+    with pytest.raises(ValueError):
+        read_stations([])
+
+
+def test_index_cache(tmp_path):
+    """Test that station columns are found once per grid and loaded by later runs"""
+    lat, lon, dx = read_grid()
+    ids, lats, lons = read_stations(make_stations())
+    index = StationIndex(ids, lats, lons, dx, str(tmp_path))
+    index.set_grids(lat, lon)
+    assert index.built == 4
+    later = StationIndex(ids, lats, lons, dx, str(tmp_path))
+    later.set_grids(lat, lon)
+    assert later.built == 0 and later.loaded == 4
+    assert len(os.listdir(str(tmp_path))) == 4
+    flat, inside = later.get_columns(lat[0], lon[0])
+    assert_array_equal(flat[:-1], [5, 500, 1967, 2256, 1176, 1443])
+    assert list(inside) == [True] * 6 + [False]
+
+
+def test_wrfpost_stations(tmp_path):
+    """Test that station output equals the full grid output at the station columns"""
+    wrfpost(datafile, outname, variables, plevs=plevs, verbose=False)
+    full = Dataset(outname)
+    truth = {name: np.ma.filled(full.variables[name][:].astype('f8'), np.nan)
+             for name in full.variables}
+    full.close()
+
+    stations = make_stations()
+    wrfpost(datafile, outname, variables, plevs=plevs, verbose=False, stations=stations,
+            weights_dir=str(tmp_path))
+    output = Dataset(outname)
+    assert output.featureType == 'timeSeriesProfile'
+    assert output.variables['station_id'].cf_role == 'timeseries_id'
+    assert list(chartostring(output.variables['station_id'][:])) == [s[0] for s in stations]
+    assert_array_equal(output.variables['latitude'][:], [s[1] for s in stations])
+    assert output.variables['temp'].dimensions == ('station', 'time', 'pressure_levels')
+    assert 'station_id' in output.variables['mslp'].coordinates
+
+    lat, lon, dx = read_grid()
+    for step in range(4):
+        flat, inside = locate_stations(lat[step], lon[step], [s[1] for s in stations],
+                                       [s[2] for s in stations], dx)
+        rows, cols = np.divmod(flat, 48)
+        for name in variables:
+            name = 'DBZ' if name == 'refl' else name
+            values = np.ma.filled(output.variables[name][:, step].astype('f8'), np.nan)
+            expected = np.moveaxis(truth[name][step][..., rows, cols], -1, 0)
+            expected[~inside] = np.nan
+            assert_array_equal(values, expected)
+    output.close()
+
+
+def test_stations_errors():
+    """Test that stations cannot be combined with other grid options"""
+    with pytest.raises(ValueError):
+        wrfpost(datafile, outname, ['mslp'], verbose=False, stations=make_stations(),
+                regrid=(22., 26., -92., -88., 0.25))
@@ -0,0 +1,100 @@
+##############################################################################################
+#
+# test_storage.py - Tests for output storage profiles
+#
+# by Tyler Wixtrom
+# Texas Tech University
+#
+##############################################################################################
+import shutil
+from PWPP import wrfpost
+from PWPP.storage import get_storage, get_chunksizes, get_packing, storage_report
+import pytest
+from metpy.units import units
+from netCDF4 import Dataset
+from numpy.testing import assert_array_almost_equal
+
+datafile = 'PWPP/tests/testfile.nc'  # Taken from units testing on WRF-Python package
+truthfile = 'PWPP/tests/true_out.nc'
+variables = ['temp_2m', 'mslp', 'temp', 'tot_pcp']
+
+
+def test_get_storage():
+    """Test profile lookup and per-variable overrides"""
+    storage = get_storage('archive', {'temp': {'complevel': 9}}, 'temp')
+    assert storage['complevel'] == 9
+    assert storage['least_significant_digit'] == 'auto'
+    assert get_storage('archive', {'temp': {'complevel': 9}}, 'mslp')['complevel'] == 6
+    with pytest.raises(KeyError):
+        get_storage('tiny')
+
+
+def test_chunksizes():
+    """Test map and time-series chunk shapes"""
+    dims = ('time', 'pressure_levels', 'lat', 'lon')
+    shape = (24, 10, 100, 200)
+    assert get_chunksizes('map', dims, shape, 24) == (1, 1, 100, 200)
+    assert get_chunksizes('timeseries', dims, shape, 24) == (24, 1, 32, 32)
+    assert get_chunksizes(None, dims, shape, 24) is None
+
+
+def test_packing():
+    """Test int16 packing parameters cover the requested range"""
+    scale_factor, add_offset, vmin, vmax = get_packing((150., 350.), 'temp')
+    assert add_offset - 32767 * scale_factor == pytest.approx(150.)
+    assert add_offset + 32767 * scale_factor == pytest.approx(350.)
+    assert get_packing(False, 'temp') is None
+
+
+def fixed_domain(outname):
+    """Writes a copy of the moving test domain with the grid held at its first position"""
+    shutil.copy(datafile, outname)
+    data = Dataset(outname, 'a')
+    for name in ('XLAT', 'XLONG', 'XLAT_U', 'XLONG_U', 'XLAT_V', 'XLONG_V'):
+        data.variables[name][:] = data.variables[name][0]
+    data.close()
+
+
+def test_packed_profile(tmpdir):
+    """Test packed output with map chunks"""
+    outfile = str(tmpdir.join('outfile.nc'))
+    wrfpost(datafile, outfile, variables, plevs=[500.] * units.hPa, storage='packed',
+            storage_vars={'tot_pcp': {'pack': False}})
+    data = Dataset(outfile)
+    data_truth = Dataset(truthfile)
+    assert data.variables['temp_2m'].dtype == 'int16'
+    assert data.variables['tot_pcp'].dtype == 'float32'
+    assert data.variables['mslp'].chunking() == [1, 48, 48]
+    for name in variables:
+        assert_array_almost_equal(data.variables[name][:], data_truth.variables[name][:], 2)
+    # the test domain moves, so its coordinates are not static
+    assert data.variables['latitude'].dimensions == ('time', 'lat', 'lon')
+    data.close()
+    data_truth.close()
+
+
+def test_static_coords(tmpdir):
+    """Test that a fixed domain has 2D latitude and longitude"""
+    infile = str(tmpdir.join('wrfout_fixed'))
+    outfile = str(tmpdir.join('outfile.nc'))
+    fixed_domain(infile)
+    wrfpost(infile, outfile, ['temp_2m'], storage='map', max_memory='1KB')
+    data = Dataset(outfile)
+    data_truth = Dataset(truthfile)
+    assert data.variables['latitude'].dimensions == ('lat', 'lon')
+    assert_array_almost_equal(data.variables['latitude'][:],
+                              data_truth.variables['latitude'][0], 4)
+    assert_array_almost_equal(data.variables['temp_2m'][:],
+                              data_truth.variables['temp_2m'][:], 4)
+    data.close()
+    data_truth.close()
+
+
+def test_storage_report(tmpdir):
+    """Test the per-variable storage report"""
+    pytest.importorskip('h5py')
+    outfile = str(tmpdir.join('outfile.nc'))
+    wrfpost(datafile, outfile, ['temp_2m'], storage='archive')
+    report = storage_report(outfile, verbose=False)
+    assert report['temp_2m']['bytes'] == 4 * 48 * 48 * 4
+    assert report['temp_2m']['ratio'] > 1
@@ -0,0 +1,86 @@
+##############################################################################################
+#
+# test_subset.py - Tests for spatial subsetting and thinning of the horizontal grid
+#
+# by Tyler Wixtrom
+# Texas Tech University
+#
+##############################################################################################
+import numpy as np
+import pytest
+from metpy.units import units
+from PWPP import wrfpost
+from PWPP.cache import DiagnosticCache
+from PWPP.subset import get_window
+from netCDF4 import Dataset
+from numpy.testing import assert_array_equal
+
+datafile = 'PWPP/tests/testfile.nc'  # Taken from units testing on WRF-Python package
+outname = 'PWPP/tests/outfile.nc'
+variables = ['uwnd', 'vwnd', 'wwnd', 'temp', 'dewpt', 'avor', 'height', 'mslp', 'temp_2m',
+             'dewpt_2m', 'q_2m', 'u_10m', 'v_10m', 'tot_pcp', 'timestep_pcp', 'UH', 'cape',
+             'cin', 'refl']
+plevs = np.array([1000, 850, 700, 500, 300]) * units('hPa')
+
+
+def read_all(name):
+    """Reads every variable of an output file"""
+    out = Dataset(name)
+    values = {key: np.ma.filled(var[:].astype('f8'), np.nan)
+              for key, var in out.variables.items()}
+    attrs = {key: out.getncattr(key) for key in out.ncattrs()}
+    out.close()
+    return values, attrs
+
+
+def test_window_identical():
+    """Test that windowed and thinned output equals the full grid output at kept points"""
+    wrfpost(datafile, outname, variables, plevs=plevs, verbose=False)
+    full, _ = read_all(outname)
+    # an interior window, and one on the domain edges
+    for index_window, stride in (((10, 30, 5, 41), 1), ((10, 30, 5, 41), 3),
+                                 ((0, 20, 30, 48), 2)):
+        wrfpost(datafile, outname, variables, plevs=plevs, verbose=False,
+                index_window=index_window, stride=stride)
+        subset, attrs = read_all(outname)
+        ys = slice(index_window[0], index_window[1], stride)
+        xs = slice(index_window[2], index_window[3], stride)
+        for name in full:
+            if name in ('valid_time', 'plevels'):
+                assert_array_equal(subset[name], full[name])
+            else:
+                assert_array_equal(subset[name], full[name][..., ys, xs])
+        assert list(attrs['window_south_north']) == [ys.start, ys.stop, stride]
+        assert list(attrs['window_west_east']) == [xs.start, xs.stop, stride]
+
+
+def test_bbox():
+    """Test that a bounding box gives the smallest window holding its grid points"""
+    data = Dataset(datafile)
+    lat = data.variables['XLAT'][0]
+    lon = data.variables['XLONG'][0]
+    bbox = (lat[10, 20], lat[25, 20], lon[20, 8], lon[20, 30])
+    window = get_window(data, bbox)
+    inside = ((lat >= bbox[0]) & (lat <= bbox[1]) & (lon >= bbox[2]) & (lon <= bbox[3]))
+    assert inside[window.ys, window.xs].sum() == inside.sum()
+    for ys, xs in ((window.ys.start, window.xs), (window.ys.stop - 1, window.xs),
+                   (window.ys, window.xs.start), (window.ys, window.xs.stop - 1)):
+        assert inside[ys, xs].any()
+    assert get_window(data) is None
+    data.close()
+
+
+def test_window_errors():
+    """Test the errors of invalid windows"""
+    data = Dataset(datafile)
+    with pytest.raises(ValueError):
+        get_window(data, stride=0)
+    with pytest.raises(ValueError):
+        get_window(data, index_window=(10, 11, 0, 48))
+    with pytest.raises(ValueError):
+        get_window(data, bbox=(0, 1, 0, 1))
+    with pytest.raises(ValueError):
+        get_window(data, bbox=(0, 90, -180, 180), index_window=(0, 10, 0, 10))
+    with pytest.raises(ValueError):
+        DiagnosticCache(data, tiles=4, window=get_window(data, stride=2))
+    data.close()
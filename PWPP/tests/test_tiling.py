@@ -0,0 +1,58 @@
+##############################################################################################
+#
+# test_tiling.py - Tests for the tiled computation of column diagnostics
+#
+# by Tyler Wixtrom
+# Texas Tech University
+#
+##############################################################################################
+import numpy as np
+from PWPP import wrfpost
+from PWPP.cache import DiagnosticCache
+from PWPP.tiling import get_tiles, TILED_DIAGNOSTICS
+from netCDF4 import Dataset
+from numpy.testing import assert_array_equal, assert_array_almost_equal
+
+datafile = 'PWPP/tests/testfile.nc'  # Taken from units testing on WRF-Python package
+truthfile = 'PWPP/tests/true_out.nc'
+
+
+def test_get_tiles():
+    """Test that tiles cover the grid exactly once"""
+    covered = np.zeros((7, 10), dtype=int)
+    tiles = get_tiles(7, 10, 6)
+    assert len(tiles) == 6
+    for ys, xs in tiles:
+        covered[ys, xs] += 1
+    assert (covered == 1).all()
+    assert len(get_tiles(2, 3, (4, 4))) == 6
+
+
+def test_tiled_identical():
+    """Test that tiled diagnostics are identical to the whole-domain computation"""
+    for tslice in (None, slice(1, 3)):
+        tiled = DiagnosticCache(Dataset(datafile), tiles=(3, 2), workers=2)
+        whole = DiagnosticCache(Dataset(datafile))
+        for name in TILED_DIAGNOSTICS:
+            time_axis = 1 if name == 'cape_2d' else 0
+            truth = whole.getvar(name, tslice, time_axis)
+            values = tiled.getvar(name, tslice, time_axis)
+            assert_array_equal(values.data, truth.data)
+            assert values.dtype == truth.dtype
+            assert values.attrs['units'] == truth.attrs['units']
+            assert values.attrs['description'] == truth.attrs['description']
+        tiled.close()
+        whole.close()
+
+
+def test_wrfpost_tiles():
+    """Test the post processor with tiled column diagnostics"""
+    outname = 'PWPP/tests/outfile.nc'
+    wrfpost(datafile, outname, ['mslp', 'cape', 'cin', 'refl'], plevs=None, tiles=4,
+            workers=2)
+    output = Dataset(outname)
+    truth = Dataset(truthfile)
+    for name in ('mslp', 'cape', 'cin', 'DBZ'):
+        assert_array_almost_equal(output.variables[name][:], truth.variables[name][:], 4)
+    output.close()
+    truth.close()
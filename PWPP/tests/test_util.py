@@ -0,0 +1,29 @@
+##############################################################################################
+#
+# test_util.py - Tests for utility functions
+#
+# by Tyler Wixtrom
+# Texas Tech University
+#
+##############################################################################################
+from PWPP.util import parse_bytes, get_slabs
+import pytest
+
+
+def test_parse_bytes():
+    """Test parsing of memory sizes"""
+    assert parse_bytes(1000) == 1000
+    assert parse_bytes('512') == 512
+    assert parse_bytes('4GB') == 4 * 1024 ** 3
+    assert parse_bytes('1.5 MiB') == int(1.5 * 1024 ** 2)
+    assert parse_bytes('2k') == 2048
+    with pytest.raises(ValueError):
+        parse_bytes('4 parsecs')
+
+
+def test_get_slabs():
+    """Test splitting times into slabs"""
+    assert get_slabs(4, 4) == [None]
+    assert get_slabs(5, 2) == [slice(0, 2), slice(2, 4), slice(4, 5)]
+    assert get_slabs(5, 5, start=3) == [slice(3, 5)]
+    assert get_slabs(5, 5, start=5) == []
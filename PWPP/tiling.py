@@ -0,0 +1,175 @@
+# Horizontally tiled computation of column diagnostics
+
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import xarray as xr
+from netCDF4 import Dataset
+from wrf import getvar
+from .variable_def import get_intermediates
+
+# wrf-python diagnostics computed independently in each grid column, and the size of any
+# leading output dimension
+TILED_DIAGNOSTICS = {
+    'cape_2d': 4,
+    'slp': None,
+    'mdbz': None,
+}
+
+# input files opened by a worker process
+_datasets = {}
+
+
+def fill_masked(values):
+    """Fills masked points of wrf-python output with NaN, as its metadata path does"""
+    if np.ma.isMaskedArray(values):
+        return np.ma.filled(values, np.nan)
+    return values
+
+
+def get_tiles(ny, nx, tiles):
+    """
+    Splits the horizontal grid into tiles
+    :param ny: number of south_north points
+    :param nx: number of west_east points
+    :param tiles: number of tiles, or tuple of (south_north, west_east) tile counts
+    :return: list of (south_north slice, west_east slice) tuples
+    """
+    if np.isscalar(tiles):
+        ty = max(int(np.sqrt(tiles)), 1)
+        tiles = (ty, max(int(tiles) // ty, 1))
+    y_edges = np.linspace(0, ny, min(tiles[0], ny) + 1).astype(int)
+    x_edges = np.linspace(0, nx, min(tiles[1], nx) + 1).astype(int)
+    return [(slice(y_edges[j], y_edges[j + 1]), slice(x_edges[i], x_edges[i + 1]))
+            for j in range(len(y_edges) - 1) for i in range(len(x_edges) - 1)]
+
+
+class _TileLoader(dict):
+    """Mapping of raw field name to the part of the field over one tile at one time"""
+    def __init__(self, data, timeidx, ys, xs):
+        super(_TileLoader, self).__init__()
+        self.data = data
+        self.timeidx = timeidx
+        self.ys = ys
+        self.xs = xs
+
+    def __missing__(self, name):
+        # let wrf-python handle fields that are not in the file
+        if name not in self.data.variables:
+            raise KeyError(name)
+        var = self.data.variables[name]
+        index = [self.timeidx]
+        for dim in var.dimensions[1:]:
+            if dim == 'south_north':
+                index.append(self.ys)
+            elif dim == 'west_east':
+                index.append(self.xs)
+            elif dim == 'south_north_stag':
+                index.append(slice(self.ys.start, self.ys.stop + 1))
+            elif dim == 'west_east_stag':
+                index.append(slice(self.xs.start, self.xs.stop + 1))
+            else:
+                index.append(slice(None))
+        values = var[tuple(index)]
+        self[name] = values
+        return values
+
+
+def _tile_values(data, name, timeidx, ys, xs):
+    """Computes a diagnostic over one tile at one time"""
+    return fill_masked(getvar(data, name, timeidx, meta=False,
+                              cache=_TileLoader(data, timeidx, ys, xs)))
+
+
+def _put_tile(out, values, n, ys, xs, time_axis):
+    """Stores the values of a tile at one time in the output array"""
+    index = [slice(None)] * out.ndim
+    index[time_axis] = n
+    index[-2] = ys
+    index[-1] = xs
+    out[tuple(index)] = values
+
+
+def _compute_tile(inname, name, steps, ys, xs, shm_name, shape, dtype, time_axis, skip=0):
+    """
+    Computes a diagnostic over one tile in a worker process into shared memory
+    :param skip: number of leading steps already computed
+    """
+    if inname not in _datasets:
+        _datasets[inname] = Dataset(inname)
+    data = _datasets[inname]
+    shm = get_shared_memory().SharedMemory(name=shm_name)
+    try:
+        out = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        for n, i in enumerate(steps):
+            if n >= skip:
+                _put_tile(out, _tile_values(data, name, i, ys, xs), n, ys, xs, time_axis)
+        del out
+    finally:
+        shm.close()
+
+
+def get_shared_memory():
+    """
+    Imports the shared memory the tiles are computed into, only on the tiled code path
+    :return: multiprocessing.shared_memory module
+    """
+    try:
+        from multiprocessing import shared_memory
+    except ImportError:
+        raise RuntimeError('Tiled computations need Python 3.8 or later')
+    return shared_memory
+
+
+def get_tile_executor(workers=None):
+    """
+    Starts a pool of worker processes for tiled computations
+    :param workers: number of worker processes. Default is the number of CPUs.
+    :return: concurrent.futures.ProcessPoolExecutor
+    """
+    get_shared_memory()
+    return ProcessPoolExecutor(max_workers=workers)
+
+
+def getvar_tiled(data, name, executor, tiles, tslice=None, time_axis=0):
+    """
+    Gets a column diagnostic by computing horizontal tiles in worker processes
+    :param data: input netCDF4 Dataset
+    :param name: wrf-python variable name, one of TILED_DIAGNOSTICS
+    :param executor: executor from get_tile_executor
+    :param tiles: number of tiles, or tuple of (south_north, west_east) tile counts
+    :param tslice: slice of time steps, or None for all times
+    :param time_axis: position of the time dimension in the wrf-python output
+    :return: wrf-python variable with data, units, and description
+    """
+    leading = TILED_DIAGNOSTICS[name]
+    ntimes = data.dimensions['Time'].size
+    steps = list(range(*(tslice or slice(0, ntimes)).indices(ntimes)))
+    ny = data.dimensions['south_north'].size
+    nx = data.dimensions['west_east'].size
+    shape = [len(steps), ny, nx]
+    if leading is not None:
+        shape.insert(0, leading)
+    tile_list = get_tiles(ny, nx, tiles)
+
+    # the first tile at the first time is computed here, giving the output data type
+    first = _tile_values(data, name, steps[0], *tile_list[0])
+    dtype = first.dtype
+
+    # the workers write their tiles straight into one shared output array
+    shm = get_shared_memory().SharedMemory(create=True,
+                                           size=int(np.prod(shape)) * dtype.itemsize)
+    try:
+        _put_tile(np.ndarray(shape, dtype=dtype, buffer=shm.buf), first, 0, *tile_list[0],
+                  time_axis)
+        futures = [executor.submit(_compute_tile, data.filepath(), name, steps, ys, xs,
+                                   shm.name, shape, dtype.str, time_axis, int(n == 0))
+                   for n, (ys, xs) in enumerate(tile_list)]
+        for future in futures:
+            future.result()
+        values = np.ndarray(shape, dtype=dtype, buffer=shm.buf).copy()
+    finally:
+        shm.close()
+        shm.unlink()
+    definition = get_intermediates()[name]
+    return xr.DataArray(values, attrs={'units': definition['units'],
+                                       'description': definition['description']})
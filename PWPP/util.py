@@ -0,0 +1,74 @@
+# Utility functions for the WRF post processor
+
+import re
+
+# number of full 3D float64 work arrays held per time step by the heaviest diagnostics
+# (cape_2d, slp) before any isobaric variables are added
+_BASE_WORK_ARRAYS = 12
+
+_BYTE_UNITS = {
+    'b': 1,
+    'kb': 1024,
+    'mb': 1024 ** 2,
+    'gb': 1024 ** 3,
+    'tb': 1024 ** 4,
+}
+
+
+def parse_bytes(size):
+    """
+    Converts a memory size to a number of bytes
+    :param size: integer number of bytes or string such as '512MB' or '4GB'
+    :return: integer number of bytes
+    """
+    if isinstance(size, (int, float)):
+        return int(size)
+    match = re.match(r'^\s*([0-9.]+)\s*([a-zA-Z]*)\s*$', size)
+    if match is None:
+        raise ValueError('Could not parse memory size '+str(size))
+    value, unit = match.groups()
+    unit = unit.lower().replace('i', '')
+    if unit == '':
+        unit = 'b'
+    elif not unit.endswith('b'):
+        unit += 'b'
+    try:
+        return int(float(value) * _BYTE_UNITS[unit])
+    except KeyError:
+        raise ValueError('Unknown memory unit in '+str(size))
+
+
+def get_slab_size(data, n_iso, max_memory):
+    """
+    Estimates the number of time steps that can be processed at once within a memory budget
+    :param data: input netCDF4 Dataset
+    :param n_iso: number of requested isobaric variables
+    :param max_memory: memory budget, integer number of bytes or string such as '4GB'
+    :return: number of time steps per slab, at least 1
+    """
+    ntimes = data.dimensions['Time'].size
+    if max_memory is None:
+        return ntimes
+    window = getattr(data, 'window', None)
+    if window is None:
+        shape = data.dimensions['south_north'].size, data.dimensions['west_east'].size
+    else:
+        # diagnostics with halos are computed over the window at full resolution
+        shape = window.extent
+    column_size = data.dimensions['bottom_top_stag'].size * shape[0] * shape[1]
+    bytes_per_time = (_BASE_WORK_ARRAYS + 2 * n_iso) * column_size * 8
+    slab_size = parse_bytes(max_memory) // bytes_per_time
+    return int(min(max(slab_size, 1), ntimes))
+
+
+def get_slabs(ntimes, slab_size, start=0):
+    """
+    Splits the time dimension into slabs
+    :param ntimes: total number of time steps
+    :param slab_size: number of time steps per slab
+    :param start: first time step to process
+    :return: list of slices, or [None] if all times fit in one slab
+    """
+    if start == 0 and slab_size >= ntimes:
+        return [None]
+    return [slice(t, min(t + slab_size, ntimes)) for t in range(start, ntimes, slab_size)]
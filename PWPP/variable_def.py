@@ -1,31 +1,180 @@
 # Variable definition file
 
+from .precip import parse_window
+from .reduction import parse_reduction
+
+
+def get_intermediates():
+    """
+    Function for getting the dictionary of wrf-python diagnostics used as intermediates
+        fields: tuple of raw WRF fields the diagnostic reads. Fields missing from a file,
+            such as QSNOW, are skipped.
+        levels: 'model' for a field on model levels, or the number of 2D fields
+        units: units wrf-python gives the diagnostic
+        description: description wrf-python gives the diagnostic
+        halo: number of neighbouring points its horizontal stencil uses
+    :return: intermediate dictionary
+    """
+    intermediates = {
+        'p': _intermediate(('P', 'PB'), 'model', 'Pa', 'pressure'),
+        'ua': _intermediate(('U',), 'model', 'm s-1', 'destaggered u-wind component'),
+        'va': _intermediate(('V',), 'model', 'm s-1', 'destaggered v-wind component'),
+        'wa': _intermediate(('W',), 'model', 'm s-1', 'destaggered w-wind component'),
+        'temp': _intermediate(('T', 'P', 'PB'), 'model', 'K', 'temperature'),
+        'td': _intermediate(('P', 'PB', 'QVAPOR'), 'model', 'degC', 'dew point temperature'),
+        'avo': _intermediate(('U', 'V', 'MAPFAC_U', 'MAPFAC_V', 'MAPFAC_M', 'F'), 'model',
+                             '10-5 s-1', 'absolute vorticity', halo=1),
+        'z': _intermediate(('PH', 'PHB', 'HGT'), 'model', 'm',
+                           'model height - [MSL] (mass grid)'),
+        'slp': _intermediate(('T', 'P', 'PB', 'QVAPOR', 'PH', 'PHB'), 1, 'hPa',
+                             'sea level pressure'),
+        'updraft_helicity': _intermediate(('W', 'PH', 'PHB', 'MAPFAC_M', 'U', 'V'), 1,
+                                          'm2 s-2', 'updraft helicity', halo=2),
+        'cape_2d': _intermediate(('T', 'P', 'PB', 'QVAPOR', 'PH', 'PHB', 'HGT', 'PSFC'), 4,
+                                 'J kg-1 ; J kg-1 ; m ; m', 'mcape ; mcin ; lcl ; lfc'),
+        'mdbz': _intermediate(('T', 'P', 'PB', 'QVAPOR', 'QRAIN', 'QSNOW', 'QGRAUP'), 1,
+                              'dBZ', 'maximum radar reflectivity'),
+        'td2': _intermediate(('PSFC', 'Q2'), 1, 'degC', '2m dew point temperature'),
+        'theta': _intermediate(('T',), 'model', 'K', 'potential temperature'),
+    }
+    return intermediates
+
+
+def _intermediate(fields, levels, units, description, halo=0):
+    """Builds one intermediate definition"""
+    return {'fields': fields, 'levels': levels, 'units': units, 'description': description,
+            'halo': halo}
+
+
+def get_vertical_coordinates():
+    """
+    Function for getting the dictionary of vertical coordinates variables on levels can be
+    interpolated to, in output order
+        intermediate: wrf-python diagnostic of the coordinate on model levels, or None for
+            the model levels themselves, which variables are written on as computed
+        fields: tuple of raw WRF fields the coordinate also reads
+        above_ground: True to subtract the terrain height HGT
+        log: True to interpolate linearly in the log of the coordinate
+        dim: name of the output dimension of the levels
+        levels_var: name of the output variable of the levels
+        units: units attribute of the levels
+        convert_units: units the levels are converted to, when the units attribute is not
+            read by pint, otherwise the units attribute
+        description: description of the levels
+        suffix: suffix of the names of output variables on the levels
+        surfaces: name of the surfaces in output variable descriptions
+    :return: vertical coordinate dictionary
+    """
+    coordinates = {
+        'pressure': {'intermediate': 'p', 'fields': (), 'above_ground': False, 'log': True,
+                     'dim': 'pressure_levels', 'levels_var': 'plevels', 'units': 'Pascal',
+                     'convert_units': 'Pa', 'description': 'Isobaric Pressure Levels',
+                     'suffix': '', 'surfaces': 'isobaric surfaces'},
+        'height': {'intermediate': 'z', 'fields': ('HGT',), 'above_ground': True,
+                   'log': False, 'dim': 'height_levels', 'levels_var': 'hlevels',
+                   'units': 'm', 'description': 'Height Above Ground Levels',
+                   'suffix': '_agl', 'surfaces': 'height above ground levels'},
+        'theta': {'intermediate': 'theta', 'fields': (), 'above_ground': False, 'log': False,
+                  'dim': 'isentropic_levels', 'levels_var': 'thlevels', 'units': 'K',
+                  'description': 'Isentropic Levels', 'suffix': '_isen',
+                  'surfaces': 'isentropic surfaces'},
+        'model': {'intermediate': None, 'fields': (), 'above_ground': False, 'log': False,
+                  'dim': 'model_levels', 'levels_var': 'mlevels', 'units': '1',
+                  'description': 'Model Levels', 'suffix': '_ml',
+                  'surfaces': 'model levels'},
+    }
+    return coordinates
+
 
 def get_variables():
     """
     Function for getting the master variable dictionary
+        description: description of the variable
+        type: 0 for diagnostics, 1 for variables on vertical coordinate levels, 2 for
+            surface fields
+        wrf_name: wrf-python variable name, or None
+        group: name of the group of variables computed together by one calc function, or
+            None if the variable is not computed
+        fields: tuple of raw WRF fields read directly
+        intermediates: tuple of wrf-python diagnostics it is computed from, see
+            get_intermediates
     :return: variable dictionary
     """
+    iso = 'vertical variables'
+    pcp = 'precipitation variables'
+    pcp_fields = ('RAINNC', 'RAINSH', 'I_RAINNC')
     variables = {
-        'uwnd': ['U-component of wind on isobaric levels', 1, 'ua'],
-        'vwnd': ['V-component of wind on isobaric levels', 1, 'va'],
-        'wwnd': ['W-component of wind on isobaric levels', 1, 'wa'],
-        'temp': ['Temperature on isobaric levels', 1, 'temp'],
-        'dewpt': ['Dewpoint temperature on isobaric levels', 1, 'td'],
-        'avor': ['Absolute vorticity on isobaric levels', 1, 'avo'],
-        'height': ['Geopotential height of isobaric levels', 1, 'z'],
-        'pres': ['Pressure on model levels', 0, 'p'],
-        'mslp': ['Pressure reduced to mean sea level', 0, 'slp'],
-        'temp_2m': ['Temperature at 2m', 2, 'T2'],
-        'dewpt_2m': ['Dewpoint temperature at 2m', 2, 'td2'],
-        'q_2m': ['Specific humidity at 2m', 2, 'Q2'],
-        'u_10m': ['U-component of wind at 10m', 2, 'U10'],
-        'v_10m': ['V-component of wind at 10m', 2, 'V10'],
-        'tot_pcp': ['Total accumulated precipitation', 2, None],
-        'timestep_pcp': ['Total timestep accumulated precipitation', 2, None],
-        'UH': ['Updraft helicity', 0, 'updraft_helicity'],
-        'cape': ['2D convective available potetial energy', 0, 'cape_2d'],
-        'cin': ['2D convective inhibition', 0, 'cape_2d'],
-        'refl': ['Maximum reflectivity', 0, 'mdbz']
+        'uwnd': _define('U-component of wind on vertical levels', 1, 'ua', iso),
+        'vwnd': _define('V-component of wind on vertical levels', 1, 'va', iso),
+        'wwnd': _define('W-component of wind on vertical levels', 1, 'wa', iso),
+        'temp': _define('Temperature on vertical levels', 1, 'temp', iso),
+        'dewpt': _define('Dewpoint temperature on vertical levels', 1, 'td', iso),
+        'avor': _define('Absolute vorticity on vertical levels', 1, 'avo', iso),
+        'height': _define('Geopotential height of vertical levels', 1, 'z', iso),
+        'theta': _define('Potential temperature on vertical levels', 1, 'theta', iso),
+        'pres': _define('Pressure on vertical levels', 1, 'p', iso),
+        'mslp': _define('Pressure reduced to mean sea level', 0, 'slp', 'mslp'),
+        'temp_2m': _define('Temperature at 2m', 2, 'T2', 'temp_2m', ('T2',)),
+        'dewpt_2m': _define('Dewpoint temperature at 2m', 2, 'td2', 'dewpt_2m'),
+        'q_2m': _define('Specific humidity at 2m', 2, 'Q2', 'q_2m', ('Q2',)),
+        'u_10m': _define('U-component of wind at 10m', 2, 'U10', 'u_10m', ('U10',)),
+        'v_10m': _define('V-component of wind at 10m', 2, 'V10', 'v_10m', ('V10',)),
+        'wspd_10m': _define('Wind speed at 10m', 2, None, 'wspd_10m', ('U10', 'V10')),
+        'tot_pcp': _define('Total accumulated precipitation', 2, None, pcp, pcp_fields),
+        'timestep_pcp': _define('Total timestep accumulated precipitation', 2, None, pcp,
+                                pcp_fields),
+        'UH': _define('Updraft helicity', 0, 'updraft_helicity', 'UH'),
+        'cape': _define('2D convective available potetial energy', 0, 'cape_2d',
+                        'cape and cin'),
+        'cin': _define('2D convective inhibition', 0, 'cape_2d', 'cape and cin'),
+        'refl': _define('Maximum reflectivity', 0, 'mdbz', 'refl')
     }
     return variables
+
+
+def _define(description, var_type, wrf_name, group, fields=(), intermediates=()):
+    """Builds one variable definition, computed from its wrf-python diagnostic by default"""
+    if wrf_name in get_intermediates():
+        intermediates = tuple(intermediates) + (wrf_name,)
+    return {'description': description, 'type': var_type, 'wrf_name': wrf_name,
+            'group': group, 'fields': tuple(fields), 'intermediates': intermediates}
+
+
+def get_reduced_fields():
+    """
+    Function for getting the variables that have maximum and minimum reductions, such as
+    UH_max_1h or mslp_min, and the name of the output field each is written as
+    :return: dictionary of variable name to output field name
+    """
+    return {'UH': 'UH', 'refl': 'DBZ', 'wspd_10m': 'wspd_10m', 'mslp': 'mslp',
+            'u_10m': 'u_10m', 'v_10m': 'v_10m', 'temp_2m': 'temp_2m',
+            'dewpt_2m': 'dewpt_2m', 'q_2m': 'q_2m', 'cape': 'cape', 'cin': 'cin'}
+
+
+def get_variable(name):
+    """
+    Gets the definition of one output variable, including precipitation windows pcp_<N>h
+    and reductions <variable>_<max|min>[_<N>h]. A reduction is computed with the variable
+    it reduces, and has the key reduction of (output field name, operation, hours).
+    :param name: output variable name
+    :return: variable definition dictionary, see get_variables
+    """
+    hours = parse_window(name)
+    if hours is not None:
+        return _define(str(hours)+' hour accumulated precipitation', 2, None,
+                       'precipitation variables', ('RAINNC', 'RAINSH', 'I_RAINNC'))
+    reduction = parse_reduction(name)
+    if reduction is not None and reduction[0] in get_reduced_fields():
+        variable, op, hours = reduction
+        definition = dict(get_variables()[variable])
+        window = 'run' if hours is None else str(hours)+' hour'
+        definition['description'] = (window + ' ' + op + 'imum of ' +
+                                     definition['description'][0].lower() +
+                                     definition['description'][1:])
+        definition['type'] = 2
+        definition['reduction'] = (get_reduced_fields()[variable], op, hours)
+        return definition
+    try:
+        return get_variables()[name]
+    except KeyError:
+        raise KeyError('Definition for '+name+' not found.')
@@ -9,5 +9,5 @@ setup(
     author_email='tyler.wixtrom@ttu.edu',
     description='Python WRF Post Processor',
     packages=['PWPP'],
-    requires=['netcdf4', 'numpy', 'metpy', 'xarray']
+    requires=['netcdf4', 'numpy', 'metpy', 'xarray', 'dask', 'scipy']
 )